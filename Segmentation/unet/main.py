@@ -27,6 +27,10 @@ from skimage.morphology import watershed
 import subprocess
 import multiprocessing
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from scan_reader import ScanReader
+
 num_threads = 40
 
 # from tensorflow.compat.v1 import ConfigProto
@@ -518,11 +522,14 @@ def auto_canny(image, sigma=0.33):
 
 def divide_to_squares(in_dir, in_img, out_dim, stride, out_dir, scale_fac, detailEnhance=False, smooth=False, gray_scale=False):
     img_path = os.path.join(in_dir, in_img)
-    if gray_scale:
-        img = cv.imread(img_path, 0)  # pass 0 to convert into gray level
+    # gray_scale converts into gray level
+    reader = ScanReader(img_path, gray=gray_scale)
+    original_img_shape = reader.shape
+    if smooth or detailEnhance or scale_fac != 1:
+        img = reader.read()
     else:
-        img = cv.imread(img_path)
-    original_img_shape = img.shape
+        # the squares are read from the scan one by one
+        img = reader
     
     scale_fac_str = str(scale_fac).replace(".", "_")
     
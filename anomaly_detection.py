@@ -6,24 +6,35 @@ with warnings.catch_warnings():
     import numpy as np
     import cv2 as cv
     import matplotlib.pyplot as plt
-    from data_preparation import rescale_and_write_normalized_impurity, \
-        rescale_and_write_normalized_impurity_not_parallel
-    from use_model import predict, predict_not_parallel
-    import ray
+    from data_preparation import write_impurity_crop_archive, normalized_impurity_crops
+    from use_model import predict_archive, predict_crops
+    from crop_archive import CropArchive
     import time
     from area_anomaly import MarketClustering, order_clusters, color_sorted_clusters, print_clusters_of_img_in_order
     from absl import flags
     from absl import app
-    from spatial_anomaly import weighted_kth_nn, weighted_kth_nn_not_parallel
-    from shape_anomaly import get_circle_impurity_score, color_circle_diff_all_impurities
-    from impurity_extract import extract_impurities, normalize_all_impurities
+    from spatial_anomaly import weighted_kth_nn, weighted_kth_nn_sweep, rank_stability
+    from shape_anomaly import get_circle_impurity_score, color_circle_diff_all_impurities, descriptor_shape_scores, \
+        shape_calibration_report
+    from impurity_extract import extract_impurities, normalize_all_impurities, fast_markers_disagreement
+    from extraction_cache import clear_extraction_cache
+    from threshold_sweep import threshold_sweep
+    from scan_reader import ScanReader
+    from mosaic import read_mosaic_offsets, mosaic_spatial_scores
+    from neighbor_index import NeighborIndex
+    from overlay import score_colors, render_overlay, write_overlay
+    from executor import Executor, backends
     from glob import glob
     import gc
     # from tensorflow.keras.models import load_model
     import tensorflow as tf
 
     FLAGS = flags.FLAGS
-    flags.DEFINE_boolean('use_ray', True, 'Use ray parallelisation or not')
+    flags.DEFINE_boolean('use_ray', True, 'Use ray parallelisation or not (the ray or the serial backend, if '
+                                          '--executor is not given)')
+    flags.DEFINE_enum('executor', None, backends, 'The backend that runs the chunks of every parallel stage: serial, '
+                      'thread (a pool of threads), process (a pool of processes) or ray')
+    flags.DEFINE_integer('workers', None, 'The chunks that run at a time, by default the number of cores')
     flags.DEFINE_boolean('detect', True, 'True if anomaly detection is desired')
     flags.DEFINE_boolean('order', False, 'True if area clustering is desired')
     flags.DEFINE_boolean('print_order', False, 'True if printing the precents in which the input areas '
@@ -44,40 +55,105 @@ with warnings.catch_warnings():
 
     flags.DEFINE_string("model_name", "./model_ae_extended.h5", "Path for Autoencoder model")
     flags.DEFINE_integer("min_threshold", 0, "Minimum intensity value for threshold")
-
-
-
-def spatial_anomaly_detection(img, markers, imp_boxes, areas, indices, need_plot=True, k_list=None):
+    flags.DEFINE_integer("tile_size", None, "If given, the watershed runs on tiles of this size (for very large scans)")
+    flags.DEFINE_boolean("use_extraction_cache", True, "Load the extracted impurities of already extracted scans from "
+                                                       "the extraction cache")
+    flags.DEFINE_boolean("clear_extraction_cache", False, "Delete the extraction cache before running")
+    flags.DEFINE_string("extraction_cache_dir", "./cache/extraction/", "Directory of the extraction cache")
+    flags.DEFINE_list("threshold_sweep", None, "Thresholds for which the number of impurities of every input scan "
+                                               "is reported (from a single pass over each scan)")
+    flags.DEFINE_boolean("fast_labeling", False, "Label the impurities with connected components only, without the "
+                                                 "watershed")
+    flags.DEFINE_boolean("prune_small_impurities", True, "Remove the impurities with an area of at most 3 pixels right "
+                                                         "after the labeling")
+    flags.DEFINE_integer("knn_memory_cap", 1024, "Megabytes of weighted distances calculated at a time by the spatial "
+                                                 "anomaly detection")
+    flags.DEFINE_enum("knn_method", "blocked", ["blocked", "index", "approximate"], "How the spatial anomaly "
+                      "detection finds the weighted kth nearest neighbors: blocked - all the pairs of impurities, "
+                      "index - only the pairs near enough through an area-bucketed spatial index (for dense scans), "
+                      "with the same scores, approximate - only the pairs within --knn_window cells of the index, "
+                      "with reported bounds")
+    flags.DEFINE_integer("knn_window", 2, "Grid cells around each impurity searched by --knn_method=approximate")
+    flags.DEFINE_integer("knn_sweep", None, "If given, the spatial scores of every input scan are calculated for all "
+                                            "k up to this value and the shift of their ranks across k is reported")
+    flags.DEFINE_string("mosaic_offsets", None, "JSON file of the offsets {scan file name: [row, column]} of the input "
+                                                "scans in a mosaic. The spatial anomaly of each scan is then detected "
+                                                "against the impurities of all the scans")
+    flags.DEFINE_boolean("fast_labeling_diagnostic", False, "Report the pixels of every input scan labeled differently "
+                                                            "by the fast labeling and by the watershed")
+    flags.DEFINE_enum("shape_scorer", "autoencoder", ["autoencoder", "descriptors"], "How the shape anomaly of the "
+                      "impurities is scored: by the reconstruction loss of the autoencoder, or by classic shape "
+                      "descriptors (circle deficit, solidity, convexity defects, eccentricity and Hu moments), "
+                      "without writing the impurities and without the model")
+    flags.DEFINE_boolean("write_crops", False, "Write the normalized images of the impurities to a crop archive in "
+                                               "./data/test_<scan>/crops/ and predict the autoencoder scores from it, "
+                                               "instead of passing them to the autoencoder in memory")
+    flags.DEFINE_boolean("shape_calibration", False, "Score the shapes both ways and report how the descriptor scores "
+                                                     "agree with the autoencoder ones, for every input scan and for "
+                                                     "all of them")
+
+# scan path -> dictionary k -> spatial scores, for scans of a mosaic (--mosaic_offsets)
+mosaic_scores = {}
+# backend -> Executor, an executor is created once for all the stages
+executors = {}
+# (descriptor scores, autoencoder scores, descriptors) of the significant impurities of every scan, for
+# --shape_calibration
+shape_calibration_scores = []
+
+
+def flags_executor():
+    backend = FLAGS.executor
+    if backend is None:
+        backend = "ray" if FLAGS.use_ray else "serial"
+    if backend not in executors:
+        executors[backend] = Executor(backend, FLAGS.workers)
+    return executors[backend]
+
+
+def spatial_anomaly_detection(img, table, need_plot=True, k_list=None, img_path=None, neighbor_index=None):
     if k_list is None:
         k_list = [50]
-    if FLAGS.use_ray:
-        return weighted_kth_nn(imp_boxes, img, markers, k_list, areas, indices, need_plot)
+    if img_path in mosaic_scores:
+        impurity_neighbors_and_area = mosaic_scores[img_path]
     else:
-        return weighted_kth_nn_not_parallel(imp_boxes, img, markers, k_list, areas, indices, need_plot)
+        impurity_neighbors_and_area = weighted_kth_nn(table, img, k_list, need_plot,
+                                                      memory_cap=FLAGS.knn_memory_cap * 2 ** 20,
+                                                      method=FLAGS.knn_method, window=FLAGS.knn_window,
+                                                      neighbor_index=neighbor_index, executor=flags_executor())
+    for k in k_list:
+        table.spatial_scores[k] = np.asarray(impurity_neighbors_and_area[k])
+    return impurity_neighbors_and_area
 
 
 # split to smaller functions, and move to shape_anomaly.py
-def shape_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, dest_path,
-                            scan_name, model, need_to_write=False):
-
-    if need_to_write:
-        scores = get_circle_impurity_score(markers, imp_boxes, areas, indices)
-        img_name = os.path.splitext(os.path.basename(img_path))[0]
-        if not os.path.exists(dest_path + scan_name):
-            os.makedirs(dest_path + scan_name)
-
-        if FLAGS.use_ray:
-            rescale_and_write_normalized_impurity(img, markers, imp_boxes, areas, indices, scores, scan_name=img_name,
-                                                  write_all=True, dest_path_all=dest_path + scan_name)
+def shape_anomaly_detection(img, img_path, table, dest_path, scan_name, model, need_to_write=False):
+
+    if FLAGS.shape_scorer == "descriptors" or FLAGS.shape_calibration:
+        descriptor_loss, descriptors = descriptor_shape_scores(table, executor=flags_executor())
+
+    if FLAGS.shape_scorer == "autoencoder" or FLAGS.shape_calibration:
+        if FLAGS.write_crops:
+            if need_to_write:
+                table.circle_scores = get_circle_impurity_score(table, executor=flags_executor())
+                img_name = os.path.splitext(os.path.basename(img_path))[0]
+                if not os.path.exists(dest_path):
+                    os.makedirs(dest_path)
+
+                write_impurity_crop_archive(img, table, table.circle_scores, dest_path + "crops", scan_name=img_name,
+                                            executor=flags_executor())
+
+            ae_loss = predict_archive(CropArchive(dest_path + "crops"), impurities_num=len(table), model=model,
+                                      table=table, executor=flags_executor())
         else:
-            rescale_and_write_normalized_impurity_not_parallel(img, markers, imp_boxes, areas, indices,
-                                                               scores, scan_name=img_name, write_all=True,
-                                                               dest_path_all=dest_path + scan_name)
+            # the crops go straight into the autoencoder, nothing is written
+            crops, crop_impurities = normalized_impurity_crops(img, table, executor=flags_executor())
+            ae_loss = predict_crops(crops, crop_impurities, len(table), model=model, executor=flags_executor())
 
-    if FLAGS.use_ray:
-        shape_reconstruct_loss = predict(path=dest_path, impurities_num=imp_boxes.shape[0], model=model)
-    else:
-        shape_reconstruct_loss = predict_not_parallel(path=dest_path, impurities_num=imp_boxes.shape[0])
+    if FLAGS.shape_calibration:
+        shape_calibration_report(descriptor_loss, ae_loss, table.indices, descriptors, name=scan_name)
+        shape_calibration_scores.append((descriptor_loss[table.indices], ae_loss[table.indices], descriptors))
+
+    shape_reconstruct_loss = descriptor_loss if FLAGS.shape_scorer == "descriptors" else ae_loss
 
     nonzero_indx = np.ma.masked_greater(shape_reconstruct_loss, 0)
     finite_indx = np.isfinite(shape_reconstruct_loss)
@@ -122,82 +198,76 @@ def shape_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, d
     # shape_reconstruct_loss = shape_reconstruct_loss ** 2
     # shape_reconstruct_loss = (shape_reconstruct_loss - np.min(shape_reconstruct_loss)) / np.ptp(shape_reconstruct_loss)
 
+    table.shape_scores = shape_reconstruct_loss
     return shape_reconstruct_loss
 
 
 # split to smaller functions, and move to shape_anomaly.py
-def shape_and_spatial_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, dest_path,
-                                        scan_name, model, need_plot=False, wkthnn_k_list=None, need_to_write=False, plot_shape_and_spatial=None):
+def shape_and_spatial_anomaly_detection(img, img_path, table, dest_path,
+                                        scan_name, model, need_plot=False, wkthnn_k_list=None, need_to_write=False, plot_shape_and_spatial=None,
+                                        neighbor_index=None):
 
-    norm_reconstruct_loss = shape_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, dest_path,
+    norm_reconstruct_loss = shape_anomaly_detection(img, img_path, table, dest_path,
                                                     scan_name, model, need_to_write)
     if wkthnn_k_list is None:
         wkthnn_k_list = [50]
-    impurity_neighbors_and_area = spatial_anomaly_detection(img, markers, imp_boxes, areas, indices, need_plot=False,
-                                                            k_list=wkthnn_k_list)
+    impurity_neighbors_and_area = spatial_anomaly_detection(img, table, need_plot=False,
+                                                            k_list=wkthnn_k_list, img_path=img_path,
+                                                            neighbor_index=neighbor_index)
 
     norm_combined_scores = {}
     for k in wkthnn_k_list:
         combined_scores = impurity_neighbors_and_area[k][:] * norm_reconstruct_loss[:]
         norm_combined_scores[k] = (combined_scores - np.min(combined_scores)) / np.ptp(combined_scores)
+        table.combined_scores[k] = norm_combined_scores[k]
 
     if need_plot or plot_shape_and_spatial is not None:
-        color_shape_and_spatial_anomaly(imp_boxes, img, markers, wkthnn_k_list, areas, indices, norm_reconstruct_loss,
-                                        impurity_neighbors_and_area, plot_shape_and_spatial)
+        color_shape_and_spatial_anomaly(img, table, wkthnn_k_list, plot_shape_and_spatial)
     return norm_combined_scores
 
 
-def area_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, model, area_anomaly_dir,
+def area_anomaly_detection(img, img_path, table, model, area_anomaly_dir,
                            need_to_write_for_ae=False, plot_shape_and_spatial=None):
     if not os.path.exists(area_anomaly_dir):
         os.makedirs(area_anomaly_dir)
     path_base_name = os.path.basename(img_path)
     name_without_ext = os.path.splitext(path_base_name)[0]
-    scores = shape_and_spatial_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, "./data/test_" +
+    # the box distances of the scan, shared by the spatial anomaly detection and the clustering
+    neighbor_index = NeighborIndex(table.boxes, table.indices)
+    scores = shape_and_spatial_anomaly_detection(img, img_path, table, "./data/test_" +
                                                  name_without_ext + "/", scan_name=name_without_ext + "/",
                                                  model=model, need_plot=False, 
-                                                 need_to_write=need_to_write_for_ae, plot_shape_and_spatial=plot_shape_and_spatial)
+                                                 need_to_write=need_to_write_for_ae, plot_shape_and_spatial=plot_shape_and_spatial,
+                                                 neighbor_index=neighbor_index)
 
-    mc = MarketClustering(img.shape, indices, markers, imp_boxes, scores[50][:], k=10)
-    mc.make_clusters()
-    mc.update_clusters_score(areas=areas, imp_boxes=imp_boxes)
+    mc = MarketClustering(img.shape, table, scores[50][:], k=10, neighbor_index=neighbor_index)
+    mc.make_clusters(flags_executor())
+    mc.update_clusters_score(areas=table.areas, imp_boxes=table.boxes)
     mc.write_clusters_score(path_base_name, FLAGS.clusters_scores_log, FLAGS.plots_dir)
     # mc.color_clusters()
 
 
-def color_shape_and_spatial_anomaly(imp_boxes, img, markers, k_list, areas, indices, shape_scores,
-                                    impurity_neighbors_and_area, plot_path=None):
+def color_shape_and_spatial_anomaly(img, table, k_list, plot_path=None):
+    indices = table.indices
+    shape_scores = table.shape_scores
+    impurity_neighbors_and_area = table.spatial_scores
 
     blank_image = {}
-    blank_image_s = {}
     blank_image_l = {}
 
-    norm_combined_scores = {}
-
+    # the shape anomaly does not depend on k
+    blank_image_s = render_overlay(table, indices, score_colors(np.asarray(shape_scores)[indices]))
     for k in k_list:
-        blank_image[k] = np.zeros(img.shape, np.uint8)
-        blank_image[k][:, :] = (255, 255, 255)
-
-        blank_image_s[k] = np.zeros(img.shape, np.uint8)
-        blank_image_s[k][:, :] = (255, 255, 255)
-
-        blank_image_l[k] = np.zeros(img.shape, np.uint8)
-        blank_image_l[k][:, :] = (255, 255, 255)
-
         combined_scores = impurity_neighbors_and_area[k][:] * shape_scores[:]
-        norm_combined_scores[k] = (combined_scores - np.min(combined_scores)) / np.ptp(combined_scores)
-
-    jet = plt.get_cmap('jet')
-    for impurity in indices:
-        for k in k_list:
-            color = jet(norm_combined_scores[k][impurity])
-            blank_image[k][markers == impurity + 2] = (color[0] * 255, color[1] * 255, color[2] * 255)
+        norm_combined_scores = (combined_scores - np.min(combined_scores)) / np.ptp(combined_scores)
+        blank_image[k] = render_overlay(table, indices, score_colors(norm_combined_scores[indices]))
+        blank_image_l[k] = render_overlay(table, indices,
+                                          score_colors(np.asarray(impurity_neighbors_and_area[k])[indices]))
 
-            color_s = jet(shape_scores[impurity])
-            blank_image_s[k][markers == impurity + 2] = (color_s[0] * 255, color_s[1] * 255, color_s[2] * 255)
-
-            color_l = jet(impurity_neighbors_and_area[k][impurity])
-            blank_image_l[k][markers == impurity + 2] = (color_l[0] * 255, color_l[1] * 255, color_l[2] * 255)
+    if plot_path is not None:
+        # the overlay of the last k, written directly in the size of the scan
+        write_overlay(plot_path, blank_image[k_list[-1]], cmap='jet')
+        return
 
     for i in range(len(k_list)):
         plt.figure("k = " + str(k_list[i]) + ", Shape and Spatial anomalies combined")
@@ -206,55 +276,65 @@ def color_shape_and_spatial_anomaly(imp_boxes, img, markers, k_list, areas, indi
         plt.clim(0, 1)
         plt.title("k = " + str(k_list[i]) + ", Shape and Spatial anomalies combined")
 
-        if plot_path is None:
-            plt.figure("Shape anomaly")
-            plt.imshow(blank_image_s[k_list[i]], cmap='jet')
-            plt.colorbar()
-            plt.clim(0, 1)
-            plt.title("Shape anomaly")
-    
-            plt.figure("k = " + str(k_list[i]) + ", Spatial anomaly")
-            plt.imshow(blank_image_l[k_list[i]], cmap='jet')
-            plt.colorbar()
-            plt.clim(0, 1)
-            plt.title("k = " + str(k_list[i]) + ", Spatial anomaly")
-    
-            plt.figure("Input")
-            plt.imshow(img)
-            plt.title("Input")
-
-    if plot_path is None:
-        plt.show()
-    else:
-        plt.savefig(plot_path)
-        # cv.imwrite(plot_path, blank_image[k_list[0]])
-    # cv.imwrite('SHAPE_anomaly_detection.png', blank_image_s[k_list[0]])
-    # cv.imwrite('LOCAL_anomaly_detection.png', blank_image_l[k_list[0]])
+        plt.figure("Shape anomaly")
+        plt.imshow(blank_image_s, cmap='jet')
+        plt.colorbar()
+        plt.clim(0, 1)
+        plt.title("Shape anomaly")
+
+        plt.figure("k = " + str(k_list[i]) + ", Spatial anomaly")
+        plt.imshow(blank_image_l[k_list[i]], cmap='jet')
+        plt.colorbar()
+        plt.clim(0, 1)
+        plt.title("k = " + str(k_list[i]) + ", Spatial anomaly")
+
+        plt.figure("Input")
+        plt.imshow(img)
+        plt.title("Input")
+
+    plt.show()
+
+
+def extraction_cache_dir():
+    return FLAGS.extraction_cache_dir if FLAGS.use_extraction_cache else None
+
+
+def prune_min_area():
+    return 3 if FLAGS.prune_small_impurities else None
 
 
 def extract_impurities_and_detect_anomaly(img_path, model=None, need_to_write_for_ae=False, plot_shape_and_spatial=None):
-    img, ret, markers, imp_boxes, areas, indices = extract_impurities(img_path, FLAGS.use_ray, FLAGS.min_threshold, FLAGS.black_background)
-    area_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, model, FLAGS.area_anomaly_dir,
+    img, ret, markers, table = extract_impurities(img_path, flags_executor(), FLAGS.min_threshold,
+                                                  FLAGS.black_background, FLAGS.tile_size, extraction_cache_dir(),
+                                                  FLAGS.fast_labeling, prune_min_area())
+    area_anomaly_detection(img, img_path, table, model, FLAGS.area_anomaly_dir,
                            need_to_write_for_ae, plot_shape_and_spatial)
 
 
 def extract_impurities_and_detect_shape_spatial_anomaly(img_path, model=None, need_to_write_for_ae=False):
-    img, ret, markers, imp_boxes, areas, indices = extract_impurities(img_path, FLAGS.use_ray, FLAGS.min_threshold)
+    img, ret, markers, table = extract_impurities(img_path, flags_executor(), FLAGS.min_threshold,
+                                                  FLAGS.black_background, FLAGS.tile_size, extraction_cache_dir(),
+                                                  FLAGS.fast_labeling, prune_min_area())
     path_base_name = os.path.basename(img_path)
     name_without_ext = os.path.splitext(path_base_name)[0]
-    shape_and_spatial_anomaly_detection(img, img_path, markers, imp_boxes, areas, indices, "./data/test_" +
+    shape_and_spatial_anomaly_detection(img, img_path, table, "./data/test_" +
                                                  name_without_ext + "/", scan_name=name_without_ext + "/",
                                                  model=model, need_plot=True, need_to_write=need_to_write_for_ae)
 
 
 def extract_impurities_and_find_circle_diff(img_path):
-    img, ret, markers, imp_boxes, areas, indices = extract_impurities(img_path, FLAGS.use_ray, FLAGS.min_threshold)
-    color_circle_diff_all_impurities(img, markers, imp_boxes, areas, indices, "./logs/shape")
+    img, ret, markers, table = extract_impurities(img_path, flags_executor(), FLAGS.min_threshold,
+                                                  FLAGS.black_background, FLAGS.tile_size, extraction_cache_dir(),
+                                                  FLAGS.fast_labeling, prune_min_area())
+    color_circle_diff_all_impurities(img, table, "./logs/shape")
 
 
 def main(_):
-    if FLAGS.use_ray:
-        ray.init()
+    # ray is initialized by its executor
+    flags_executor()
+
+    if FLAGS.clear_extraction_cache:
+        clear_extraction_cache(FLAGS.extraction_cache_dir)
 
     if FLAGS.clusters_scores_log is None:
         FLAGS.clusters_scores_log = FLAGS.area_anomaly_dir + "clusters_scores.txt"
@@ -269,8 +349,39 @@ def main(_):
 
     files = glob(FLAGS.input_scans)
 
+    if FLAGS.threshold_sweep is not None:
+        thresholds = [int(t) for t in FLAGS.threshold_sweep]
+        for file in files:
+            threshold_sweep(file, thresholds, FLAGS.black_background)
+
+    if FLAGS.fast_labeling_diagnostic:
+        for file in files:
+            img = ScanReader(file, invert=FLAGS.black_background).read()
+            fast_markers_disagreement(img, FLAGS.min_threshold, os.path.splitext(os.path.basename(file))[0])
+
+    if FLAGS.knn_sweep is not None:
+        for file in files:
+            img, ret, markers, table = extract_impurities(file, flags_executor(), FLAGS.min_threshold,
+                                                          FLAGS.black_background, FLAGS.tile_size,
+                                                          extraction_cache_dir(), FLAGS.fast_labeling,
+                                                          prune_min_area())
+            kth_values, scores = weighted_kth_nn_sweep(table, FLAGS.knn_sweep, FLAGS.knn_memory_cap * 2 ** 20,
+                                                       FLAGS.knn_method, FLAGS.knn_window, flags_executor())
+            print(os.path.splitext(os.path.basename(file))[0] + ", spatial scores across k:")
+            rank_stability(scores, table.indices)
+
     if FLAGS.detect:
-        model = tf.keras.models.load_model(FLAGS.model_name)
+        model = None
+        if FLAGS.shape_scorer == "autoencoder" or FLAGS.shape_calibration:
+            model = tf.keras.models.load_model(FLAGS.model_name)
+
+        if FLAGS.mosaic_offsets is not None:
+            mosaic_scores.update(mosaic_spatial_scores(
+                files, read_mosaic_offsets(FLAGS.mosaic_offsets), [50],
+                lambda file: extract_impurities(file, flags_executor(), FLAGS.min_threshold, FLAGS.black_background,
+                                                FLAGS.tile_size, extraction_cache_dir(), FLAGS.fast_labeling,
+                                                prune_min_area())[3],
+                flags_executor(), FLAGS.knn_memory_cap * 2 ** 20, FLAGS.knn_method, FLAGS.knn_window))
 
         for file in files:
             if not os.path.exists(FLAGS.plots_dir + "/" + os.path.basename(file)):
@@ -281,11 +392,18 @@ def main(_):
                 extract_impurities_and_detect_anomaly(file, model=model, need_to_write_for_ae=True, plot_shape_and_spatial=plot_shape_and_spatial)
                 gc.collect()
 
+        if FLAGS.shape_calibration and len(shape_calibration_scores) > 0:
+            descriptor_scores, ae_scores, descriptors = [np.concatenate(scores) for scores in
+                                                         zip(*shape_calibration_scores)]
+            shape_calibration_report(descriptor_scores, ae_scores, np.arange(descriptor_scores.shape[0]),
+                                     descriptors, name="of all the scans")
+
     if FLAGS.order:
         print("~~~~ starting to order the clusters ~~~~")
 
         order_clusters(FLAGS.clusters_scores_log, FLAGS.ordered_clusters_scores,
-                       order_histograms_path=FLAGS.order_histogram, save_ordered_dir=FLAGS.save_ordered_dir)
+                       order_histograms_path=FLAGS.order_histogram, save_ordered_dir=FLAGS.save_ordered_dir,
+                       executor=flags_executor())
 
     if FLAGS.print_order:
         print("~~~~ starting to print number in orders ~~~~")
@@ -300,7 +418,7 @@ def main(_):
 
     if FLAGS.prepare_data:
         # prepare all data
-        normalize_all_impurities(FLAGS.prepare_data_path)
+        normalize_all_impurities(FLAGS.prepare_data_path, FLAGS.min_threshold, flags_executor())
 
 
 if __name__ == "__main__":
@@ -3,15 +3,18 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=FutureWarning)
     import numpy as np
     import statistics
-    from utils import impurity_dist, num_threads, find_diameter
-    import ray
+    from neighbor_index import NeighborIndex
+    from utils import find_diameter_blocked
+    from executor import Executor
     import time
     import json
     import matplotlib.pyplot as plt
     import matplotlib
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
     import cv2 as cv
     import os
     import gc
+    from overlay import score_colors, render_overlay, write_overlay
 
 
 class CheapImpCouple:
@@ -37,11 +40,17 @@ class CheapImpCouple:
 
 class MarketClustering:
 
-    def __init__(self, img_shape, indices, markers, imp_boxes, anomaly_scores, k=10):
+    def __init__(self, img_shape, table, anomaly_scores, k=10, neighbor_index=None):
+        """
+        :param neighbor_index: the NeighborIndex of the scan, built here if not given
+        """
         self.img_shape = img_shape
-        self.indices = indices
-        self.markers = markers
-        self.imp_boxes = imp_boxes
+        self.table = table
+        self.indices = table.indices
+        self.imp_boxes = table.boxes
+        if neighbor_index is None:
+            neighbor_index = NeighborIndex(table.boxes, self.indices)
+        self.neighbor_index = neighbor_index
         self.anomaly_scores = anomaly_scores
         self.k = k
         self.anomaly_clusters = [None] * self.k  # create k clusters
@@ -94,10 +103,10 @@ class MarketClustering:
         lowest_price = np.inf
         cheapest_impurity = None
         for impurity_inside in cluster["impurities_inside"]:
+            distance = self.neighbor_index.distance(impurity, impurity_inside)
             is_core_impurity_inside = True if impurity_inside in cluster["core_impurities"] \
                 else False
 
-            distance = impurity_dist(self.imp_boxes[impurity], self.imp_boxes[impurity_inside])
             f = 0.95
             scores_part = (1 - (self.anomaly_scores[impurity] * f) ** 0.5 *
                            (self.anomaly_scores[impurity_inside] * f) ** 0.5) ** 1.6
@@ -157,8 +166,7 @@ class MarketClustering:
                 return 1
         return 0
 
-    @ray.remote
-    def make_clusters_single(self, cluster, impurities_not_in_cluster_chunk):
+    def cheapest_couple_of_chunk(self, cluster, impurities_not_in_cluster_chunk):
         cheapest_impurity_couple = CheapImpCouple(cluster)
         for impurity in impurities_not_in_cluster_chunk:
             containing_cluster, is_core_impurity = self.find_containing_cluster(impurity)
@@ -171,8 +179,15 @@ class MarketClustering:
                                                             cheap_price_inside)
         return cheapest_impurity_couple
 
-    def make_clusters(self):
+    def make_clusters(self, executor=None):
+        """
+        :param executor: the Executor that prices the chunks of the impurities outside a cluster, serial if None.
+                         The cheapest couple of the first chunk wins a tie, so the clusters are the same on every
+                         backend.
+        """
         start = time.time()
+        if executor is None:
+            executor = Executor()
         # converged = False
         status = -1
         while status != 0:
@@ -184,57 +199,29 @@ class MarketClustering:
                     break
                 cheapest_impurity_couple = CheapImpCouple(cluster)
                 impurities_not_in_cluster = list(set(list(self.sorted_impurities)) - set(cluster["impurities_inside"]))
-                impurities_not_in_cluster_chunks = np.array_split(impurities_not_in_cluster, num_threads)
+                # find_cheapest_imp_in_cluster returns after the first impurity of the cluster, so every impurity is
+                # priced against it only, calculate its distances once (before self is sent to the workers). The
+                # distances to the other impurities of the cluster would be calculated pair by pair.
+                self.neighbor_index.distances_from(cluster["impurities_inside"][0])
 
-                tasks = list()
-                for i in range(num_threads):
-                    tasks.append(self.make_clusters_single.remote(self, cluster, impurities_not_in_cluster_chunks[i]))
-                couples_list = list()
-                for i in range(num_threads):
-                    couples_list.append(ray.get(tasks[i]))
+                impurities_not_in_cluster_chunks = executor.chunks(
+                    impurities_not_in_cluster, cost=len(cluster["impurities_inside"]) * 1e-6)
+                couples_list = executor.map(make_clusters_chunk, impurities_not_in_cluster_chunks, self, cluster)
 
                 cheapest_impurity_couple.merge_cheapest_couples(couples_list)
+                containing_cluster = cheapest_impurity_couple.containing_cluster_outside
+                if containing_cluster is not None and containing_cluster != -1:
+                    # the process and ray backends return copies of the clusters, expand through the cluster itself
+                    containing_cluster = self.anomaly_clusters[self.anomaly_clusters.index(containing_cluster)]
 
                 status = self.attempt_to_expand(
-                    cheapest_impurity_couple.containing_cluster_outside,
+                    containing_cluster,
                     cheapest_impurity_couple.cheapest_impurity_outside,
                     cheapest_impurity_couple.cheapest_impurity_inside,
                     cheapest_impurity_couple.lowest_price,
                     cluster)
         end = time.time()
-        print("time make_clusters parallel: " + str(end - start))
-
-    def make_clusters_not_parallel(self):
-        # converged = False
-        status = -1
-        while status != 0:
-            # converged = True
-            status = 0
-            # self.color_clusters()
-            self.anomaly_clusters.sort(key=lambda x: x["wallet"], reverse=True)
-            for cluster in self.anomaly_clusters:
-                if status == 2:   # clusters where combined, need to sort the clusters in the outer loop
-                    break
-                impurities_not_in_cluster = set(list(self.sorted_impurities)) - set(cluster["impurities_inside"])
-                cheapest_impurity_outside = None
-                containing_cluster_outside = None
-                cheapest_impurity_inside = None
-                lowest_price = np.inf
-                for impurity in impurities_not_in_cluster:
-                    containing_cluster, is_core_impurity = self.find_containing_cluster(impurity)
-                    #  calculate prices for all impurities in cluster to all impurities not in cluster,
-                    #  choose to add best one.
-
-                    cheap_impurity_inside, lowest_price_inside = self.find_cheapest_imp_in_cluster(cluster, impurity)
-                    if lowest_price_inside < lowest_price:
-                        cheapest_impurity_inside = cheap_impurity_inside
-                        cheapest_impurity_outside = impurity
-                        containing_cluster_outside = containing_cluster
-                        lowest_price = lowest_price_inside
-
-                status = self.attempt_to_expand(
-                    containing_cluster_outside, cheapest_impurity_outside, cheapest_impurity_inside, lowest_price,
-                    cluster)
+        print("time make_clusters (" + executor.backend + "): " + str(end - start))
 
     def update_clusters_score(self, areas=None, imp_boxes=None):
         clusters_order_in_scan = []
@@ -252,8 +239,7 @@ class MarketClustering:
                 cluster["order_keys"].append({"name": "areas_sum", "score": sum(areas_inside)})
 
             if imp_boxes is not None:
-                boxes_inside = [imp_boxes[i] for i in cluster["impurities_inside"]]
-                diameter = find_diameter(boxes_inside)
+                diameter = find_diameter_blocked(self.imp_boxes[cluster["impurities_inside"]])
                 cluster["order_keys"].append({"name": "diameter", "score": diameter})
                 if diameter != 0:
                     cluster["order_keys"].append({"name": "amount_div_diameter", "score": amount / diameter})
@@ -330,10 +316,11 @@ class MarketClustering:
                 cluster_json["cluster_name"] = cluster_name
                 cluster = self.anomaly_clusters[cluster_num]
                 cluster_json["order_keys"] = cluster["order_keys"]
-                cluster_json["core_impurities"] = [int(core_imp) for core_imp in cluster["core_impurities"]]
+                cluster_json["core_impurities"] = [int(self.table.ids[core_imp])
+                                                   for core_imp in cluster["core_impurities"]]
                 impurities_and_anomalies = []
                 for i in cluster["impurities_inside"]:
-                    impurities_and_anomalies.append({"id": int(i), "score": self.anomaly_scores[i]})
+                    impurities_and_anomalies.append({"id": int(self.table.ids[i]), "score": self.anomaly_scores[i]})
                 cluster_json["impurities"] = impurities_and_anomalies
                 scan_json["clusters"].append(cluster_json)
             data.append(scan_json)
@@ -346,12 +333,11 @@ class MarketClustering:
     def impurities_pixels_info(self, impurities_pixels_info_path):
         # 2 values: impurity id, impurity score
         pixels_out = np.full((self.img_shape[0], self.img_shape[1], 2), -1., dtype=float)
-        for i in range(len(self.anomaly_scores)):
-            imp_id = int(i)
-            imp_score = self.anomaly_scores[i]
-            argw = np.argwhere(self.markers == imp_id + 2)
-            argws = np.split(argw, 2, 1)
-            pixels_out[argws[0][:, 0], argws[1][:, 0], :] = [imp_id, imp_score]
+        # the id of the impurity of every pixel in the CSR pixel index
+        imp_ids = np.repeat(np.arange(len(self.anomaly_scores)), np.diff(self.table.pixel_offsets))
+        flat_pixels_out = pixels_out.reshape(-1, 2)
+        flat_pixels_out[self.table.pixels, 0] = self.table.ids[imp_ids]
+        flat_pixels_out[self.table.pixels, 1] = np.asarray(self.anomaly_scores)[imp_ids]
 
         # with open(impurities_pixels_info_path, 'w') as f:
         np.save(impurities_pixels_info_path, pixels_out)
@@ -359,29 +345,20 @@ class MarketClustering:
 
 
     def color_clusters(self, show_fig=True, save_plot_path=None):
-        blank_image = np.zeros(self.img_shape, np.uint8)
-        blank_image[:, :] = (255, 255, 255)
-
         # tab10 = plt.get_cmap('tab10')
         jet = plt.cm.get_cmap('jet', len(self.anomaly_clusters))
-        for impurity in self.indices:
-            blank_image[self.markers == impurity + 2] = (0, 0, 0)
-        for cluster_id, cluster in enumerate(self.anomaly_clusters):
-            if len(self.anomaly_clusters) == 1:
-                cluster_color = jet(1)
-            else:
-                cluster_color = jet(cluster_id / (len(self.anomaly_clusters) - 1))
-            for impurity in cluster["impurities_inside"]:
-                blank_image[self.markers == impurity + 2] = \
-                    (cluster_color[0] * 255, cluster_color[1] * 255, cluster_color[2] * 255)
-            # print("cluster id: " + str(cluster_id) + ", mean:" + str(cluster["score"]["mean"]) + ", median:" +
-            #       str(cluster["score"]["median"]))
+        if len(self.anomaly_clusters) == 1:
+            cluster_colors = score_colors([1], jet)
+        else:
+            cluster_colors = score_colors(np.arange(len(self.anomaly_clusters)) / (len(self.anomaly_clusters) - 1), jet)
+        impurities = [impurity for cluster in self.anomaly_clusters for impurity in cluster["impurities_inside"]]
+        cluster_ids = [cluster_id for cluster_id, cluster in enumerate(self.anomaly_clusters)
+                       for impurity in cluster["impurities_inside"]]
+        # the impurities out of the clusters are black
+        blank_image = render_overlay(self.table, np.concatenate((self.indices, impurities)).astype(int),
+                                     np.concatenate((np.zeros((len(self.indices), 3), np.uint8),
+                                                     cluster_colors[cluster_ids].reshape(-1, 3))))
 
-        plt.close()
-        matplotlib.rcParams.update({'font.size': 22})
-        fig = plt.figure("Area anomaly")
-        fig.set_size_inches(30, 20)
-        img = plt.imshow(blank_image, cmap='jet')
         if len(self.anomaly_clusters) == 1:
             ticks = [0, 1]
             delta = 0.5
@@ -389,6 +366,17 @@ class MarketClustering:
             ticks = list(np.array(range(len(self.anomaly_clusters))) / (len(self.anomaly_clusters) - 1))
             delta = 0.5 * (1 / (len(self.anomaly_clusters) - 1))
 
+        if not show_fig:
+            if save_plot_path is not None:
+                write_overlay(save_plot_path, blank_image, cmap=jet, ticks=ticks)
+            return
+
+        plt.close()
+        matplotlib.rcParams.update({'font.size': 22})
+        fig = plt.figure("Area anomaly")
+        fig.set_size_inches(30, 20)
+        img = plt.imshow(blank_image, cmap='jet')
+
         # bounds = ticks
         # bounds = ticks
         # np.append(bounds, 1)
@@ -398,12 +386,11 @@ class MarketClustering:
         # plt.clim(-delta, 1 + delta)
         plt.clim(0, 1)
         plt.title("Area anomaly")
+        plt.show()
 
-        if show_fig:
-            plt.show()
-        elif save_plot_path is not None:
-            # plt.savefig(save_plot_path, dpi=fig.dpi)
-            plt.savefig(save_plot_path)
+
+def make_clusters_chunk(impurities_not_in_cluster_chunk, market_clustering, cluster):
+    return market_clustering.cheapest_couple_of_chunk(cluster, impurities_not_in_cluster_chunk)
 
 
 def create_sub_histogram(histograms_sub_dir, name, scores):
@@ -457,7 +444,8 @@ def cluster_impurities_info(cluster_json, sorted_clusters_json, clusters_info_pa
         clusters_info_file.flush()
 
 def order_clusters(anomaly_clusters_json_file, ordered_clusters_json_file, order_histograms_path=None, order_keys=None,
-                   save_ordered_dir="./logs/area/ordered_clusters", clusters_info_path="./logs/area/clusters_impurities_info.txt"):
+                   save_ordered_dir="./logs/area/ordered_clusters", clusters_info_path="./logs/area/clusters_impurities_info.txt",
+                   executor=None):
     if not os.path.exists(order_histograms_path):
         os.makedirs(order_histograms_path)
     if not os.path.exists(save_ordered_dir):
@@ -528,7 +516,8 @@ def order_clusters(anomaly_clusters_json_file, ordered_clusters_json_file, order
         if not os.path.exists(save_ordered_dir + "/" + order["key_name"]):
             # check-point: color and save order keys with no existing directory (in case of OOM errors)
             color_sorted_clusters(order["sorted_clusters"], show_fig=False, save_ordered_dir=save_ordered_dir + "/"
-                                                                                             + order["key_name"])
+                                                                                             + order["key_name"],
+                                  executor=executor)
         gc.collect()
     with open(ordered_clusters_json_file, "w") as ordered_json_file:
         json.dump(sorted_clusters_json, ordered_json_file)
@@ -538,64 +527,43 @@ def order_clusters(anomaly_clusters_json_file, ordered_clusters_json_file, order
     return sorted_clusters
 
 
-@ray.remote
-def color_sorted_clusters_single(clusters_to_plot, indices_chunk, show_fig, save_ordered_dir):
-    for cluster_id, cluster in zip(indices_chunk, clusters_to_plot):
+def color_sorted_clusters_chunk(cluster_ids, clusters_to_plot, show_fig, save_ordered_dir):
+    for cluster_id in cluster_ids:
+        cluster = clusters_to_plot[cluster_id - 1]
         bgr_img = cv.imread(cluster["path"])
         img = cv.cvtColor(bgr_img, cv.COLOR_BGR2RGB)
-        plt.imshow(img, cmap='jet')
         cluster_name_id = cluster["cluster_name"][cluster["cluster_name"].find("_")+1:]
-        plt.title("#" + str(cluster_id) + ": " + cluster_name_id)
-                  # + "\n" + str(cluster["score"]))
+        title = "#" + str(cluster_id) + ": " + cluster_name_id
 
         if show_fig:
+            plt.imshow(img, cmap='jet')
+            plt.title(title)
             plt.show()
         elif save_ordered_dir is not None:
-            figure = plt.gcf()  # get current figure
-            figure.set_size_inches(30, 20)
-            plt.savefig(save_ordered_dir+"/"+str(cluster_id)+".png")
-            plt.close()
-
-
-def color_sorted_clusters(sorted_clusters, top_to_show=50, show_fig=True, save_ordered_dir=None):
-    if save_ordered_dir is not None:
-        if not os.path.exists(save_ordered_dir):
-            os.makedirs(save_ordered_dir)
-    plt.close()
-    clusters_to_plot = sorted_clusters[:top_to_show]
-    indices = range(1, top_to_show+1)
-    clusters_to_plot_chunks = np.array_split(clusters_to_plot, num_threads)
-    indices_chunks = np.array_split(indices, num_threads)
-
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(color_sorted_clusters_single.remote(clusters_to_plot_chunks[i], indices_chunks[i],
-                                                         show_fig, save_ordered_dir))
-    for i in range(num_threads):
-        ray.get(tasks[i])
-
-
-def color_sorted_clusters_not_parallel(sorted_clusters, top_to_show=150, show_fig=True, save_ordered_dir=None):
+            # a figure of its own and not the current figure of pyplot, so that the chunks may run in threads
+            figure = matplotlib.figure.Figure(figsize=(30, 20))
+            FigureCanvasAgg(figure)
+            axes = figure.add_subplot(111)
+            axes.imshow(img, cmap='jet')
+            axes.set_title(title)
+            figure.savefig(save_ordered_dir+"/"+str(cluster_id)+".png")
+
+
+def color_sorted_clusters(sorted_clusters, top_to_show=50, show_fig=True, save_ordered_dir=None, executor=None):
+    """
+    :param executor: the Executor that plots the chunks of the clusters, serial if None (or if show_fig, the figures
+                     are shown one after the other)
+    """
     if save_ordered_dir is not None:
         if not os.path.exists(save_ordered_dir):
             os.makedirs(save_ordered_dir)
     plt.close()
+    if executor is None or show_fig:
+        executor = Executor()
     clusters_to_plot = sorted_clusters[:top_to_show]
-    for cluster_id, cluster in enumerate(clusters_to_plot, start=1):
+    cluster_ids_chunks = executor.chunks(np.arange(1, len(clusters_to_plot) + 1), cost=1.)
+    executor.map(color_sorted_clusters_chunk, cluster_ids_chunks, clusters_to_plot, show_fig, save_ordered_dir)
 
-        bgr_img = cv.imread(cluster["path"])
-        img = cv.cvtColor(bgr_img, cv.COLOR_BGR2RGB)
-        plt.imshow(img, cmap='jet')
-        cluster_name_id = cluster["cluster_name"][cluster["cluster_name"].find("_")+1:]
-        plt.title("#" + str(cluster_id) + ": " + cluster_name_id)
-                  # + "\n" + str(cluster["score"]))
-
-        if show_fig:
-            plt.show()
-        elif save_ordered_dir is not None:
-            figure = plt.gcf()  # get current figure
-            figure.set_size_inches(30, 20)
-            plt.savefig(save_ordered_dir+"/"+str(cluster_id)+".png")
 
 def clusters_pixels_info(ordered_clusters_json, order_name, scan_file_name, clusters_pixels_info_path):
     input_scan_name = os.path.splitext(os.path.basename(scan_file_name))[0]
@@ -0,0 +1,149 @@
+import os
+import json
+import zlib
+import shutil
+import numpy as np
+
+
+class CropArchive:
+    """
+    The normalized crops of the impurities of a single scan in a single file instead of a PNG file per impurity, with
+    an index of their ids, scores and areas.
+    The crops are kept as the grayscale the autoencoder reads (uint8, see grayscale_crop), in chunks of a few crops
+    that are compressed (zlib) one after the other into crops.bin. The file is memory-mapped, so reading a crop by its
+    id reads and decompresses only its chunk.
+    """
+
+    def __init__(self, dir_path, mmap_mode='r'):
+        """
+        Opens an archive written by write_crop_archive.
+        """
+        with open(os.path.join(dir_path, "archive.json"), "r") as json_file:
+            info = json.load(json_file)
+        self.dir_path = dir_path
+        self.scan_name = info["scan_name"]
+        self.height = info["height"]
+        self.width = info["width"]
+
+        def column(name):
+            return np.load(os.path.join(dir_path, name + ".npy"), mmap_mode=mmap_mode)
+
+        self.ids = column("ids")
+        self.scores = column("scores")
+        self.areas = column("areas")
+        # the bytes of chunk j are data[chunk_offsets[j]:chunk_offsets[j + 1]], its crops are the crops of the
+        # positions chunk_positions[j]:chunk_positions[j + 1]
+        self.chunk_offsets = column("chunk_offsets")
+        self.chunk_positions = column("chunk_positions")
+        if self.chunk_offsets[-1] > 0:
+            self.data = np.memmap(os.path.join(dir_path, "crops.bin"), dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def positions_of_ids(self, ids):
+        """
+        The positions in the archive of the crops of impurities given by their ids.
+        """
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self)
+        found[found] = self.ids[positions[found]] == ids[found]
+        if not np.all(found):
+            raise KeyError("no crops in " + self.dir_path + " for the impurities " + str(ids[~found].tolist()))
+        return positions
+
+    def read_chunk(self, chunk):
+        """
+        The crops of a chunk, (number of crops, height, width) uint8.
+        """
+        data = self.data[self.chunk_offsets[chunk]:self.chunk_offsets[chunk + 1]]
+        return np.frombuffer(zlib.decompress(data.tobytes()), np.uint8).reshape(-1, self.height, self.width)
+
+    def read(self, ids=None):
+        """
+        The crops of impurities by their ids (all the crops if None), every chunk is decompressed once.
+        :return: (number of ids, height, width) uint8 array
+        """
+        positions = np.arange(len(self)) if ids is None else self.positions_of_ids(ids)
+        crops = np.zeros((positions.shape[0], self.height, self.width), np.uint8)
+        chunks = np.searchsorted(self.chunk_positions, positions, side='right') - 1
+        for chunk in np.unique(chunks):
+            members = np.flatnonzero(chunks == chunk)
+            crops[members] = self.read_chunk(chunk)[positions[members] - self.chunk_positions[chunk]]
+        return crops
+
+    def model_input(self, ids=None):
+        """
+        The crops as the input of the autoencoder, (number of ids, height, width, 1) float32 in [0, 1].
+        """
+        return (self.read(ids).astype(np.float32) / 255.)[:, :, :, np.newaxis]
+
+    def image(self, impurity_id):
+        """
+        The crop of a single impurity as a (BGR) image, e.g. for cv.imwrite or plt.imshow.
+        """
+        return np.repeat(self.read([impurity_id])[0][:, :, np.newaxis], 3, axis=2)
+
+
+def write_crop_archive(dir_path, chunks, ids, scores, areas, height, width, scan_name=""):
+    """
+    Writes a CropArchive. It is written to a temporary directory first, so an interrupted run does not leave a broken
+    archive, and replaces an older archive in dir_path.
+    :param chunks: the compressed chunks of the crops (see compress_crops), in the order of the ids
+    :param ids: the ids of the impurities of the crops, sorted
+    :param scores: the score of every crop (e.g. its circle score)
+    :param areas: the area of the impurity of every crop
+    """
+    tmp_dir = dir_path.rstrip("/") + ".tmp" + str(os.getpid())
+    os.makedirs(tmp_dir)
+    chunk_offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    chunk_positions = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(os.path.join(tmp_dir, "crops.bin"), "wb") as crops_file:
+        for j, (data, crops_num) in enumerate(chunks):
+            crops_file.write(data)
+            chunk_offsets[j + 1] = chunk_offsets[j] + len(data)
+            chunk_positions[j + 1] = chunk_positions[j] + crops_num
+    np.save(os.path.join(tmp_dir, "chunk_offsets.npy"), chunk_offsets)
+    np.save(os.path.join(tmp_dir, "chunk_positions.npy"), chunk_positions)
+    np.save(os.path.join(tmp_dir, "ids.npy"), np.asarray(ids, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "scores.npy"), np.asarray(scores, dtype=float))
+    np.save(os.path.join(tmp_dir, "areas.npy"), np.asarray(areas, dtype=float))
+    # archive.json is written last, an archive without it is not complete
+    with open(os.path.join(tmp_dir, "archive.json"), "w") as json_file:
+        json.dump({"scan_name": scan_name, "height": height, "width": width}, json_file)
+    if os.path.exists(dir_path):
+        shutil.rmtree(dir_path, ignore_errors=True)
+    os.rename(tmp_dir, dir_path)
+
+
+def compress_crops(crops, chunk_size=64, level=6):
+    """
+    Compresses crops ((number of crops, height, width) uint8) in chunks of chunk_size crops.
+    :return: list of (compressed bytes, number of crops) of the chunks
+    """
+    return [(zlib.compress(np.ascontiguousarray(crops[i:i + chunk_size]).tobytes(), level),
+             crops[i:i + chunk_size].shape[0]) for i in range(0, crops.shape[0], chunk_size)]
+
+
+def archive_training_set(archive_dirs, normal_max_score=0.3, anomaly_min_score=0.55, min_area=50):
+    """
+    The training set of the autoencoder from the crop archives of scans (written by normalize_all_impurities): the
+    crops of the impurities of an area above min_area that are close to circles (normal, a circle score of at most
+    normal_max_score) or far from them (anomaly, a circle score above anomaly_min_score).
+    :return: (crops, labels) - (number of crops, height, width, 1) uint8 crops (as the PNG files, for a generator
+             that rescales them), and the label of every crop, 1 for normal and 0 for anomaly (as the classes of
+             flow_from_directory)
+    """
+    crops = []
+    labels = []
+    for archive_dir in archive_dirs:
+        archive = CropArchive(archive_dir)
+        big = np.asarray(archive.areas) > min_area
+        normal = big & (np.asarray(archive.scores) <= normal_max_score)
+        anomaly = big & (np.asarray(archive.scores) > anomaly_min_score)
+        crops.append(archive.read(archive.ids[normal | anomaly])[:, :, :, np.newaxis])
+        labels.append(normal[normal | anomaly].astype(np.float32))
+    return np.concatenate(crops), np.concatenate(labels)
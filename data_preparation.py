@@ -1,7 +1,7 @@
 import numpy as np
 import cv2 as cv
-from utils import num_threads
-import ray
+from executor import Executor
+from crop_archive import write_crop_archive, compress_crops
 
 """ not used anymore """
 def normalize_circle_boxes(img, markers, imp_boxes, areas, indices, scores, dr_max=300, dc_max=300,
@@ -85,195 +85,113 @@ def normalize_circle_boxes(img, markers, imp_boxes, areas, indices, scores, dr_m
         print ("too big impurites: " + str(too_big_counter))
     return normalized
 
-@ray.remote
-def rescale_and_write_normalized_impurity_single(img, markers, imp_boxes, areas, impurities_chunk,
-                                                 scores, height, width,
-                                                 proportion_impurity_of_image, scan_name, dest_path_normal,
-                                                 dest_path_anomaly, write_all, dest_path_all):
-    for i in range(len(impurities_chunk)):
-        impurity = impurities_chunk[i]
-        # if impurity == 717:
-        #     print("in imp 717")
-        # take only circle impurities OR
-        # take only non-circle impurities as anomalies OR
-        # take all significant impurities
-
-        rmin, rmax, cmin, cmax = imp_boxes[impurity]
-        dr = int(rmax - rmin)
-        dc = int(cmax - cmin)
-        blank_image = np.zeros((dr, dc, 3), np.uint8)
-        blank_image[:, :] = (255, 255, 255)
-
-        image = np.zeros(img.shape, np.uint8)
-        image[:, :] = (255, 255, 255)
-        # take only the indices of the impurity
-        image[markers == impurity + 2] = img[markers == impurity + 2]
-        # take the bounding box of the impurity
-        blank_image[:, :] = image[int(rmin):int(rmax), int(cmin):int(cmax)]
-        # blank_image = blank_image / 255.0  # conversion for opencv images
+def normalized_impurity_images(img, table, impurities, height, width, proportion_impurity_of_image):
+    """
+    The images of a batch of impurities, each cut from its bounding box on a white background, rescaled to proportion
+    of (height, width) keeping its aspect ratio and centered. Only the box of every impurity is read: its pixels are
+    copied to a white box of its size, which is resized into its place in a preallocated white batch.
+    :return: (images, valid) - (number of impurities, height, width, 3) uint8 images, and whether each impurity could
+             be rescaled (the images of the too thin ones are blank)
+    """
+    images = np.full((len(impurities), height, width, 3), 255, np.uint8)
+    valid = np.zeros(len(impurities), dtype=bool)
+    for i, impurity in enumerate(impurities):
+        rmin, rmax, cmin, cmax = [int(x) for x in table.boxes[impurity]]
+        dr = rmax - rmin
+        dc = cmax - cmin
         scale_factor_r = height * proportion_impurity_of_image / dr
         scale_factor_c = width * proportion_impurity_of_image / dc
         scale_factor = min(scale_factor_r, scale_factor_c)
 
         h = int(dr * scale_factor)
         w = int(dc * scale_factor)
-        dim = (w, h)
-
         if h == 0 or w == 0:
             continue
 
-        scaled_image = cv.resize(blank_image, dim)
-
-        normalized_scaled_image = np.zeros((height, width, 3), np.uint8)
-        normalized_scaled_image[:, :] = (255, 255, 255)
+        # the box is padded by a pixel, which may be outside of the scan
+        box = np.full((dr, dc, 3), 255, np.uint8)
+        rows, cols = np.divmod(np.asarray(table.impurity_pixels(impurity)), img.shape[1])
+        box[rows - rmin, cols - cmin] = img[rows, cols]
 
         pad_r = int((height - h) // 2)
         pad_c = int((width - w) // 2)
-        normalized_scaled_image[pad_r:pad_r + h, pad_c:pad_c + w] = scaled_image[:, :]
+        images[i, pad_r:pad_r + h, pad_c:pad_c + w] = cv.resize(box, (w, h))
+        valid[i] = True
+    return images, valid
 
-        string_score = str(scores[impurity])
-        string_score.replace('.', '_')
-        # normal impurity
-        if write_all is False:
-            if scores[impurity] <= 0.3 and areas[impurity] > 50:
-                cv.imwrite(dest_path_normal + string_score +
-                           scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
-            # anomalous impurity
-            elif scores[impurity] > 0.55 and areas[impurity] > 50:
-                cv.imwrite(dest_path_anomaly + string_score +
-                           scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
-        else:
-            cv.imwrite(dest_path_all + string_score +
-                       scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
 
-
-def rescale_and_write_normalized_impurity(img, markers, imp_boxes, areas, indices, scores, height=100, width=100,
-                                          proportion_impurity_of_image=0.8,
-                                          scan_name="",
-                                          dest_path_normal="./data/rescaled/normal/",
-                                          dest_path_anomaly="./data/rescaled/anomaly/",
-                                          write_all=False,
-                                          dest_path_all="./data/rescaled/all/"):
+def grayscale(image):
     """
-    rescale the impurity images into a fixed size, and standardize the impurities to be in the center.
-    :param img: original image
-    :param markers: the markers from get_markers function
-    :param imp_boxes: the bounding boxes of the impurities
-    :param areas: the ares of the impurities
-    :param indices: the indices of the significant impurities (the ones with a not too-small size)
-    :param scores: the anomaly scores of the impurities. used for writing the score to the name of the file
-    :param dr_max: optional, the maximum difference of rows (height) of the impurity that is tolerated
-    :param dc_max: optional, the maximum difference of columns (width) of the impurity that is tolerated
-    :param write_to_files: True - write the impurities to files, False - do not write.
-    :param scan_name: optional - the name of the scan.
-    :param number_of_impurities_to_write: optional - maximum impurities allowed to be written
-    :param write_circles: True - if writing impurities that are closed to circles is desired.
-                          False - for writing anomaly impurities (not closed to circles)
-    :param write_all: True only if writing all significant impurities from a specific scan is intended
-    :param dest_path: The base destination path of the directory in which the output should be written to
+    The grayscale of (BGR) impurity images, the same as PIL reads from the PNG that cv.imwrite writes from an image
+    (the ITU-R 601-2 luma).
+    :param image: (..., height, width, 3) uint8 array
+    :return: (..., height, width) uint8 array
     """
+    image = image.astype(np.uint32)
+    return ((image[..., 2] * 19595 + image[..., 1] * 38470 + image[..., 0] * 7471 + 0x8000) >> 16).astype(np.uint8)
 
-    print("Starting to write normalized impurities of ", scan_name)
-    # normalized = np.zeros(imp_boxes.shape[0])
-
-    chunk_size = int(np.ceil(len(indices) / num_threads))
-    impurities_chunks = np.array_split(indices, num_threads)
 
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(rescale_and_write_normalized_impurity_single.remote(img, markers, imp_boxes, areas,
-                                                                         impurities_chunks[i], scores, height, width,
-                                                                         proportion_impurity_of_image, scan_name,
-                                                                         dest_path_normal, dest_path_anomaly,
-                                                                         write_all, dest_path_all))
-    for i in range(num_threads):
-        ray.get(tasks[i])
-
-
-
-def rescale_and_write_normalized_impurity_not_parallel(img, markers, imp_boxes, areas, indices, scores,
-                                                       height=100, width=100, proportion_impurity_of_image=0.8,
-                                                       scan_name="",
-                                                       dest_path_normal="./data/rescaled/normal/",
-                                                       dest_path_anomaly="./data/rescaled/anomaly/",
-                                                       write_all=False,
-                                                       dest_path_all="./data/rescaled/all/"):
+def grayscale_crop(image):
     """
-    rescale the impurity images into a fixed size, and standardize the impurities to be in the center.
-    :param img: original image
-    :param markers: the markers from get_markers function
-    :param imp_boxes: the bounding boxes of the impurities
-    :param areas: the ares of the impurities
-    :param indices: the indices of the significant impurities (the ones with a not too-small size)
-    :param scores: the anomaly scores of the impurities. used for writing the score to the name of the file
-    :param dr_max: optional, the maximum difference of rows (height) of the impurity that is tolerated
-    :param dc_max: optional, the maximum difference of columns (width) of the impurity that is tolerated
-    :param write_to_files: True - write the impurities to files, False - do not write.
-    :param scan_name: optional - the name of the scan.
-    :param number_of_impurities_to_write: optional - maximum impurities allowed to be written
-    :param write_circles: True - if writing impurities that are closed to circles is desired.
-                          False - for writing anomaly impurities (not closed to circles)
-    :param write_all: True only if writing all significant impurities from a specific scan is intended
-    :param dest_path: The base destination path of the directory in which the output should be written to
+    The grayscale of (BGR) impurity images scaled to [0, 1], the same as the model input of the PNG that cv.imwrite
+    writes from an image, loaded by load_image.
+    :param image: (..., height, width, 3) uint8 array
+    :return: (..., height, width, 1) float32 array
     """
+    return (grayscale(image).astype(np.float32) / 255.)[..., np.newaxis]
 
-    print("Starting to write normalized impurities of ", scan_name)
-    # normalized = np.zeros(imp_boxes.shape[0])
-
-    number_of_written_impurities = 0
-    for impurity in indices:
-        # if impurity == 717:
-        #     print("in imp 717")
-        # take only circle impurities OR
-        # take only non-circle impurities as anomalies OR
-        # take all significant impurities
-
-        rmin, rmax, cmin, cmax = imp_boxes[impurity]
-        dr = int(rmax - rmin)
-        dc = int(cmax - cmin)
-        blank_image = np.zeros((dr, dc, 3), np.uint8)
-        blank_image[:, :] = (255, 255, 255)
 
-        image = np.zeros(img.shape, np.uint8)
-        image[:, :] = (255, 255, 255)
-        # take only the indices of the impurity
-        image[markers == impurity + 2] = img[markers == impurity + 2]
-        # take the bounding box of the impurity
-        blank_image[:, :] = image[int(rmin):int(rmax), int(cmin):int(cmax)]
-        # blank_image = blank_image / 255.0  # conversion for opencv images
-        scale_factor_r = height * proportion_impurity_of_image / dr
-        scale_factor_c = width * proportion_impurity_of_image / dc
-        scale_factor = min(scale_factor_r, scale_factor_c)
-
-        h = int(dr * scale_factor)
-        w = int(dc * scale_factor)
-        dim = (w, h)
-
-        if h == 0 or w == 0:
-            continue
+def normalized_impurity_crops_chunk(impurities_chunk, img, table, height, width, proportion_impurity_of_image):
+    images, valid = normalized_impurity_images(img, table, impurities_chunk, height, width,
+                                               proportion_impurity_of_image)
+    return grayscale_crop(images[valid]), np.asarray(impurities_chunk, dtype=int)[valid]
 
-        scaled_image = cv.resize(blank_image, dim)
 
-        normalized_scaled_image = np.zeros((height, width, 3), np.uint8)
-        normalized_scaled_image[:, :] = (255, 255, 255)
-
-        pad_r = int((height - h) // 2)
-        pad_c = int((width - w) // 2)
-        normalized_scaled_image[pad_r:pad_r + h, pad_c:pad_c + w] = scaled_image[:, :]
-
-        string_score = str(scores[impurity])
-        string_score.replace('.', '_')
-        # normal impurity
-        if write_all is False:
-            if scores[impurity] <= 0.3 and areas[impurity] > 50:
-                cv.imwrite(dest_path_normal + string_score +
-                           scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
-                number_of_written_impurities += 1
-            # anomalous impurity
-            elif scores[impurity] > 0.55 and areas[impurity] > 50:
-                cv.imwrite(dest_path_anomaly + string_score +
-                           scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
-                number_of_written_impurities += 1
-        else:
-            cv.imwrite(dest_path_all + string_score +
-                       scan_name + "_impurity_" + str(impurity) + ".png", normalized_scaled_image)
+def normalized_impurity_crops(img, table, height=100, width=100, proportion_impurity_of_image=0.8, executor=None):
+    """
+    The normalized images of all the significant impurities of a scan (see normalized_impurity_images), in memory as
+    the input of the autoencoder.
+    :param executor: the Executor that rescales the chunks of the impurities, serial if None
+    :return: (crops, impurities) - (number of crops, height, width, 1) float32 array of the crops and the impurities
+             (rows of the table) of the crops, the impurities too thin to be rescaled have no crop
+    """
+    if executor is None:
+        executor = Executor()
+    # about 0.1 milliseconds per impurity
+    impurities_chunks = executor.chunks(table.indices, cost=0.0001)
+    chunks_out = executor.map(normalized_impurity_crops_chunk, impurities_chunks, img, table, height, width,
+                              proportion_impurity_of_image)
+    crops = np.concatenate([np.zeros((0, height, width, 1), np.float32)] + [crops for crops, _ in chunks_out])
+    impurities = np.concatenate([np.zeros(0, dtype=int)] + [impurities for _, impurities in chunks_out])
+    return crops, impurities
+
+
+def impurity_crop_archive_chunk(impurities_chunk, img, table, height, width, proportion_impurity_of_image,
+                                chunk_size):
+    images, valid = normalized_impurity_images(img, table, impurities_chunk, height, width,
+                                               proportion_impurity_of_image)
+    return compress_crops(grayscale(images[valid]), chunk_size), np.asarray(impurities_chunk, dtype=int)[valid]
+
+
+def write_impurity_crop_archive(img, table, scores, dir_path, height=100, width=100, proportion_impurity_of_image=0.8,
+                                scan_name="", chunk_size=64, executor=None):
+    """
+    Writes the normalized images of all the significant impurities of a scan (see normalized_impurity_images), as
+    grayscale, into a single CropArchive in dir_path, instead of a PNG file per impurity.
+    :param scores: the scores of the impurities, kept in the index of the archive
+    :param chunk_size: the crops compressed together, the crops read together when a crop is read by its id
+    :param executor: the Executor that rescales and compresses the chunks of the impurities, serial if None
+    """
+    print("Starting to archive normalized impurities of ", scan_name)
+    if executor is None:
+        executor = Executor()
+    indices = np.asarray(table.indices, dtype=int)
+    # every task compresses whole chunks of the archive
+    archive_chunks = np.array_split(indices, max((indices.shape[0] + chunk_size - 1) // chunk_size, 1))
+    archive_chunks_chunks = executor.chunks(np.arange(len(archive_chunks)), cost=chunk_size * 0.0002)
+    impurities_chunks = [np.concatenate([archive_chunks[j] for j in chunk]) for chunk in archive_chunks_chunks]
+    chunks_out = executor.map(impurity_crop_archive_chunk, impurities_chunks, img, table, height, width,
+                              proportion_impurity_of_image, chunk_size)
+    impurities = np.concatenate([np.zeros(0, dtype=int)] + [impurities for _, impurities in chunks_out])
+    write_crop_archive(dir_path, [chunk for chunks, _ in chunks_out for chunk in chunks], table.ids[impurities],
+                       np.asarray(scores)[impurities], table.areas[impurities], height, width, scan_name)
@@ -0,0 +1,218 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import numpy as np
+    import cv2 as cv
+    import time
+    from itertools import combinations
+    from executor import Executor
+
+# the tolerance of a point on the circle, as in smallestenclosingcircle
+_multiplicative_epsilon = 1 + 1e-14
+
+
+def impurity_row_extremes(table, impurities):
+    """
+    The first and the last pixel of every row of each of the impurities, found for all of them in a single pass over
+    their (row-major) pixels. The convex hull of an impurity is the convex hull of these points, and so is its
+    minimum enclosing circle.
+    :return: (points, offsets) - (number of points, 2) array of the (row, column) of the points, the points of
+             impurities[i] are points[offsets[i]:offsets[i + 1]]
+    """
+    impurities = np.asarray(impurities, dtype=np.int64)
+    pixels, owners = table.impurities_pixels(impurities)
+    rows, cols = np.divmod(pixels, table.image_shape[1])
+
+    # the runs of pixels of the same impurity and the same row
+    new_run = np.ones(owners.shape[0], dtype=bool)
+    new_run[1:] = (owners[1:] != owners[:-1]) | (rows[1:] != rows[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.append(run_starts[1:], owners.shape[0]) - 1
+    # a run of a single pixel has a single point
+    extremes = np.sort(np.concatenate((run_starts, run_ends[run_ends != run_starts])))
+    points = np.stack((rows[extremes], cols[extremes]), axis=1)
+    offsets = np.zeros(impurities.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners[extremes], minlength=impurities.shape[0]), out=offsets[1:])
+    return points, offsets
+
+
+def _outside(circle, points):
+    return np.hypot(points[:, 0] - circle[0], points[:, 1] - circle[1]) > circle[2] * _multiplicative_epsilon
+
+
+def _first_outside(circle, points, start):
+    outside = np.flatnonzero(_outside(circle, points[start:]))
+    return start + outside[0] if outside.shape[0] > 0 else -1
+
+
+def _cross_product(p, q, points):
+    return (q[0] - p[0]) * (points[:, 1] - p[1]) - (q[1] - p[1]) * (points[:, 0] - p[0])
+
+
+def _diameter_circle(a, b):
+    cx = (a[0] + b[0]) / 2.0
+    cy = (a[1] + b[1]) / 2.0
+    return cx, cy, max(np.hypot(cx - a[0], cy - a[1]), np.hypot(cx - b[0], cy - b[1]))
+
+
+def _circumcircles(a, b, c):
+    """
+    The circumcircles of the points a, b and c (arrays of points that broadcast together), as make_circumcircle of
+    smallestenclosingcircle.
+    :return: (centers, radii, valid) - the circles of collinear points are not valid
+    """
+    ox = (np.minimum(np.minimum(a[..., 0], b[..., 0]), c[..., 0]) +
+          np.maximum(np.maximum(a[..., 0], b[..., 0]), c[..., 0])) / 2.0
+    oy = (np.minimum(np.minimum(a[..., 1], b[..., 1]), c[..., 1]) +
+          np.maximum(np.maximum(a[..., 1], b[..., 1]), c[..., 1])) / 2.0
+    ax = a[..., 0] - ox
+    ay = a[..., 1] - oy
+    bx = b[..., 0] - ox
+    by = b[..., 1] - oy
+    cx = c[..., 0] - ox
+    cy = c[..., 1] - oy
+    d = (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by)) * 2.0
+    valid = d != 0.0
+    d = np.where(valid, d, 1.0)
+    x = ox + ((ax * ax + ay * ay) * (by - cy) + (bx * bx + by * by) * (cy - ay) + (cx * cx + cy * cy) * (ay - by)) / d
+    y = oy + ((ax * ax + ay * ay) * (cx - bx) + (bx * bx + by * by) * (ax - cx) + (cx * cx + cy * cy) * (bx - ax)) / d
+    radii = np.maximum(np.maximum(np.hypot(x - a[..., 0], y - a[..., 1]), np.hypot(x - b[..., 0], y - b[..., 1])),
+                       np.hypot(x - c[..., 0], y - c[..., 1]))
+    return np.stack((x, y), axis=-1), radii, valid
+
+
+def min_enclosing_radii(points, block_size=2048):
+    """
+    The radii of the minimum enclosing circles of many small sets of points of the same size at once: the circle of
+    a set is the smallest of the circles through two of its points (as a diameter) or three of them that encloses
+    all of them.
+    :param points: (number of sets, points per set, 2) float array
+    """
+    sets_num, points_num = points.shape[:2]
+    if points_num == 1:
+        return np.zeros(sets_num)
+    pairs = np.array(list(combinations(range(points_num), 2)))
+    triples = np.array(list(combinations(range(points_num), 3))).reshape(-1, 3)
+    radii = np.zeros(sets_num)
+    for block_start in range(0, sets_num, block_size):
+        block = points[block_start:block_start + block_size]
+        a = block[:, pairs[:, 0]]
+        b = block[:, pairs[:, 1]]
+        centers = (a + b) / 2.0
+        candidates_radii = np.maximum(np.hypot(centers[..., 0] - a[..., 0], centers[..., 1] - a[..., 1]),
+                                      np.hypot(centers[..., 0] - b[..., 0], centers[..., 1] - b[..., 1]))
+        if triples.shape[0] > 0:
+            triples_centers, triples_radii, valid = _circumcircles(block[:, triples[:, 0]], block[:, triples[:, 1]],
+                                                                   block[:, triples[:, 2]])
+            centers = np.concatenate((centers, triples_centers), axis=1)
+            candidates_radii = np.concatenate((candidates_radii, np.where(valid, triples_radii, np.inf)), axis=1)
+        # (sets, candidates, points)
+        distances = np.hypot(block[:, np.newaxis, :, 0] - centers[:, :, np.newaxis, 0],
+                             block[:, np.newaxis, :, 1] - centers[:, :, np.newaxis, 1])
+        encloses = np.all(distances <= candidates_radii[:, :, np.newaxis] * _multiplicative_epsilon, axis=2)
+        radii[block_start:block_start + block.shape[0]] = np.min(np.where(encloses, candidates_radii, np.inf), axis=1)
+    return radii
+
+
+def _circle_two_points(points, p, q):
+    circle = _diameter_circle(p, q)
+    others = points[_outside(circle, points)]
+    if others.shape[0] == 0:
+        return circle
+
+    # the circumcircles on the left and on the right of pq, the left one farthest to the left and the right one
+    # farthest to the right
+    cross = _cross_product(p, q, others)
+    centers, radii, valid = _circumcircles(p, q, others)
+    centers_cross = _cross_product(p, q, centers)
+    left = valid & (cross > 0.0)
+    right = valid & (cross < 0.0)
+    left_circle = right_circle = None
+    if np.any(left):
+        i = np.argmax(np.where(left, centers_cross, -np.inf))
+        left_circle = (centers[i, 0], centers[i, 1], radii[i])
+    if np.any(right):
+        i = np.argmin(np.where(right, centers_cross, np.inf))
+        right_circle = (centers[i, 0], centers[i, 1], radii[i])
+
+    if left_circle is None and right_circle is None:
+        return circle
+    elif left_circle is None:
+        return right_circle
+    elif right_circle is None:
+        return left_circle
+    return left_circle if left_circle[2] <= right_circle[2] else right_circle
+
+
+def _circle_one_point(points, p):
+    circle = (p[0], p[1], 0.0)
+    i = _first_outside(circle, points, 0)
+    while i != -1:
+        if circle[2] == 0.0:
+            circle = _diameter_circle(p, points[i])
+        else:
+            circle = _circle_two_points(points[:i + 1], p, points[i])
+        i = _first_outside(circle, points, i + 1)
+    return circle
+
+
+def min_enclosing_circle(points):
+    """
+    The smallest circle that encloses all the points, by the algorithm of make_circle of smallestenclosingcircle
+    (Welzl's), where the points that a circle should enclose are checked at once. The points are taken in the given
+    order, which should be random for an expected linear time.
+    :param points: (number of points, 2) float array
+    :return: (center x, center y, radius)
+    """
+    circle = (points[0, 0], points[0, 1], 0.0)
+    i = _first_outside(circle, points, 1)
+    while i != -1:
+        circle = _circle_one_point(points[:i + 1], points[i])
+        i = _first_outside(circle, points, i + 1)
+    return circle
+
+
+def min_enclosing_circles_chunk(positions_chunk, points, offsets, keys, small_hull_size=10):
+    """
+    The radii of the minimum enclosing circles of a chunk of the impurities, from the vertices of their convex hulls:
+    of the hulls of up to small_hull_size vertices together by min_enclosing_radii, and of the bigger ones by
+    min_enclosing_circle.
+    :param keys: a random key for every point, the vertices of a hull are taken in the order of their keys
+    """
+    hulls = []
+    for position in positions_chunk:
+        impurity_points = points[offsets[position]:offsets[position + 1]]
+        vertices = np.arange(impurity_points.shape[0])
+        if impurity_points.shape[0] > 2:
+            vertices = cv.convexHull(impurity_points.astype(np.int32), returnPoints=False).ravel()
+        vertices = vertices[np.argsort(keys[offsets[position] + vertices], kind='stable')]
+        hulls.append(impurity_points[vertices].astype(float))
+
+    radii = np.zeros(len(hulls))
+    sizes = np.array([hull.shape[0] for hull in hulls], dtype=int)
+    for size in np.unique(sizes[sizes <= small_hull_size]):
+        members = np.flatnonzero(sizes == size)
+        radii[members] = min_enclosing_radii(np.stack([hulls[i] for i in members]))
+    for i in np.flatnonzero(sizes > small_hull_size):
+        radii[i] = min_enclosing_circle(hulls[i])[2]
+    return radii
+
+
+def min_enclosing_circles(table, impurities, seed=0, executor=None):
+    """
+    The radii of the minimum enclosing circles of the pixels (their row and column) of the impurities, calculated from
+    the vertices of their convex hulls only.
+    :param seed: the seed of the random order of the vertices, the radii are the same for every number of chunks
+    :param executor: the Executor that runs the chunks of the impurities, serial if None
+    """
+    start = time.time()
+    if executor is None:
+        executor = Executor()
+    points, offsets = impurity_row_extremes(table, impurities)
+    keys = np.random.RandomState(seed).random_sample(points.shape[0])
+    positions_chunks = executor.chunks(np.arange(len(impurities)), cost=0.0002)
+    radii = np.concatenate([np.zeros(0)] + executor.map(min_enclosing_circles_chunk, positions_chunks, points, offsets,
+                                                        keys))
+    end = time.time()
+    print("time min_enclosing_circles: " + str(end - start))
+    return radii
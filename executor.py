@@ -0,0 +1,92 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import os
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    import ray
+
+backends = ["serial", "thread", "process", "ray"]
+
+# about the seconds that a task costs a backend (scheduling, and sending the arguments and the results of the process
+# and ray backends), a chunk of work should cost many times more
+task_overheads = {"serial": 0., "thread": 0.0001, "process": 0.01, "ray": 0.01}
+
+
+class Executor:
+    """
+    Runs the chunks of a stage (e.g. the impurities of a scan) by a function on one of the backends:
+    - serial: one chunk after the other, in the calling process
+    - thread: a pool of threads, for the stages whose work is mostly in numpy or OpenCV (which release the GIL)
+    - process: a pool of processes, the arguments and the results are pickled for every chunk
+    - ray: ray tasks (ray is initialized if it was not), the arguments are put in the object store once per map
+    Every stage has a single implementation - a function of a chunk, and the same chunks give the same results on
+    every backend.
+    """
+
+    def __init__(self, backend="serial", workers=None, chunks_per_worker=4):
+        """
+        :param workers: the chunks run at a time, by default the number of cores (of the ray cluster for ray)
+        :param chunks_per_worker: the chunks of a stage per worker, more chunks balance uneven chunks better
+        """
+        if backend not in backends:
+            raise ValueError("unknown executor backend " + str(backend) + ", expected one of " + str(backends))
+        self.backend = backend
+        if backend == "ray" and not ray.is_initialized():
+            ray.init()
+        if backend == "serial":
+            workers = 1
+        elif workers is None:
+            workers = os.cpu_count() or 1
+            if backend == "ray":
+                workers = int(ray.cluster_resources().get("CPU", workers))
+        self.workers = max(int(workers), 1)
+        self.chunks_per_worker = chunks_per_worker
+        self._pool = None
+        self._remote_functions = {}
+
+    def chunks(self, items, cost=None):
+        """
+        Splits items (e.g. impurities) into chunks: chunks_per_worker chunks per worker, but fewer if a chunk would
+        cost less than 10 times the overhead of a task, and a single chunk for the serial backend.
+        :param cost: the estimated seconds of work per item, if known
+        :return: list of arrays
+        """
+        items = np.asarray(items)
+        chunks_num = 1 if self.workers == 1 else self.workers * self.chunks_per_worker
+        if cost is not None and task_overheads[self.backend] > 0:
+            chunks_num = min(chunks_num, int(items.shape[0] * cost / (10 * task_overheads[self.backend])))
+        chunks_num = max(min(chunks_num, items.shape[0]), 1)
+        return np.array_split(items, chunks_num)
+
+    def memory_share(self, memory_cap):
+        """
+        The bytes a chunk may take, so that all the chunks that run at a time take at most memory_cap bytes.
+        """
+        return memory_cap // self.workers
+
+    def map(self, func, chunks, *args):
+        """
+        func(chunk, *args) for every chunk. func should be a function of a module (and not a lambda or a method), so
+        that the process and ray backends can send it.
+        :return: list of the results, in the order of the chunks
+        """
+        if self.backend == "serial" or len(chunks) <= 1:
+            return [func(chunk, *args) for chunk in chunks]
+        if self.backend == "ray":
+            if func not in self._remote_functions:
+                self._remote_functions[func] = ray.remote(func)
+            arg_ids = [ray.put(arg) for arg in args]
+            return ray.get([self._remote_functions[func].remote(chunk, *arg_ids) for chunk in chunks])
+        if self._pool is None:
+            if self.backend == "thread":
+                self._pool = ThreadPoolExecutor(self.workers)
+            else:
+                self._pool = ProcessPoolExecutor(self.workers)
+        futures = [self._pool.submit(func, chunk, *args) for chunk in chunks]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from impurity_table import ImpurityTable
+
+# bump when the extraction or the cached format changes, so the old entries are not used anymore
+EXTRACTION_CACHE_VERSION = 2
+
+
+def scan_file_sha(img_path):
+    """
+    A hash of the bytes of a scan file.
+    """
+    sha = hashlib.sha1()
+    with open(img_path, "rb") as img_file:
+        for block in iter(lambda: img_file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def extraction_cache_key(img_path, min_threshold, black_background, tile_size=None, fast=False, prune_min_area=None,
+                         file_sha=None):
+    """
+    The key of a scan in the cache: a hash of the bytes of the scan file together with the extraction parameters.
+    :param file_sha: the scan_file_sha of the scan, if already calculated
+    """
+    if file_sha is None:
+        file_sha = scan_file_sha(img_path)
+    params = {"version": EXTRACTION_CACHE_VERSION, "min_threshold": min_threshold,
+              "black_background": bool(black_background), "tile_size": tile_size, "fast": bool(fast),
+              "prune_min_area": prune_min_area}
+    return hashlib.sha1((file_sha + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+
+def remove_stale_tmp_dirs(cache_dir):
+    """
+    Removes the temporary directories of entries (<key>.tmp<pid>) left by runs that were interrupted while saving, the
+    ones of runs that are still running are kept.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        pid = name.rpartition(".tmp")[2]
+        if ".tmp" not in name or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            running = int(pid) != os.getpid()
+        except ProcessLookupError:
+            running = False
+        except OSError:
+            # the process exists, but belongs to another user
+            running = True
+        if not running:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def remove_replaced_entries(cache_dir, img_path, version, info_name="extraction.json", version_name="file_sha"):
+    """
+    Removes the entries (directories) of a cache that were saved from another version of the scan img_path, e.g.
+    before it was edited or exported again. The json info_name of every entry has the (absolute) path of its scan and
+    the version of the scan (version_name), the entries without it are kept.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    abs_img_path = os.path.abspath(img_path)
+    for name in os.listdir(cache_dir):
+        info_path = os.path.join(cache_dir, name, info_name)
+        if not os.path.exists(info_path):
+            continue
+        with open(info_path, "r") as json_file:
+            info = json.load(json_file)
+        if info.get("img_path") == abs_img_path and info.get(version_name) != version:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def load_extraction(cache_dir, key):
+    """
+    Loads the markers and the ImpurityTable of a scan from the cache. The arrays are memory-mapped, so they are read
+    from the disk only when accessed.
+    :return: (ret, markers, table), or None if the scan is not in the cache
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    # extraction.json is written last, an entry without it is not complete
+    if not os.path.exists(os.path.join(entry_dir, "extraction.json")):
+        return None
+    with open(os.path.join(entry_dir, "extraction.json"), "r") as json_file:
+        info = json.load(json_file)
+    markers = np.load(os.path.join(entry_dir, "markers.npy"), mmap_mode='r')
+    table = ImpurityTable.load(os.path.join(entry_dir, "table"))
+    return info["ret"], markers, table
+
+
+def save_extraction(cache_dir, key, img_path, ret, markers, table, file_sha=None):
+    """
+    Saves the markers and the ImpurityTable of a scan to the cache. The older entries of the same scan path with other
+    contents are removed (the entries of the same contents with other parameters are kept), and so are the temporary
+    directories of interrupted runs.
+    :param file_sha: the scan_file_sha of the scan, if already calculated
+    """
+    if file_sha is None:
+        file_sha = scan_file_sha(img_path)
+    remove_stale_tmp_dirs(cache_dir)
+    remove_replaced_entries(cache_dir, img_path, file_sha)
+
+    # write to a temporary directory first, so that an interrupted run does not leave a broken entry
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = entry_dir + ".tmp" + str(os.getpid())
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "markers.npy"), markers)
+    table.save(os.path.join(tmp_dir, "table"))
+    with open(os.path.join(tmp_dir, "extraction.json"), "w") as json_file:
+        json.dump({"img_path": os.path.abspath(img_path), "file_sha": file_sha, "ret": int(ret)}, json_file)
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+    os.rename(tmp_dir, entry_dir)
+
+
+def clear_extraction_cache(cache_dir):
+    """
+    Deletes the cache, together with the decoded scans that ScanReader spools into it (its scans directory).
+    """
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
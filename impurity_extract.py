@@ -4,20 +4,23 @@ with warnings.catch_warnings():
     import os
     import numpy as np
     import cv2 as cv
-    from data_preparation import rescale_and_write_normalized_impurity
+    from scipy import ndimage
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from data_preparation import write_impurity_crop_archive
     from shape_anomaly import get_circle_impurity_score
-    from utils import num_threads
-    import ray
+    from impurity_table import ImpurityTable
+    from extraction_cache import scan_file_sha, extraction_cache_key, load_extraction, save_extraction
+    from scan_reader import ScanReader
+    from executor import Executor
     import time
     from absl import app
 
-def get_markers(img, min_threshold, img_name):
+def get_sure_fg(img, min_threshold):
     """
-    Get the impurities arranged with unique indices from an image (img).
-    Applies image processing.
+    The thresholded and closed image, in which every impurity is certainly foreground.
     """
-    image = img.copy()
-    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
 
     ret, thresh = cv.threshold(gray, min_threshold, 255, cv.THRESH_BINARY_INV)
 
@@ -25,13 +28,21 @@ def get_markers(img, min_threshold, img_name):
     kernel = np.ones((3, 3), np.uint8)
 
     opening = cv.morphologyEx(thresh, cv.MORPH_CLOSE, kernel, iterations=1)
-    # sure background area
-    sure_bg = cv.dilate(opening, kernel, iterations=3)
+    return np.uint8(opening)
 
-    sure_fg = opening
+
+def watershed_markers(img, min_threshold):
+    """
+    Applies the image processing of get_markers (threshold, closing, dilation and watershed) to an image.
+    :return: the number of labels, the markers and the sure foreground
+    """
+    sure_fg = get_sure_fg(img, min_threshold)
+
+    # sure background area
+    kernel = np.ones((3, 3), np.uint8)
+    sure_bg = cv.dilate(sure_fg, kernel, iterations=3)
 
     # Finding unknown region
-    sure_fg = np.uint8(sure_fg)
     unknown = cv.subtract(sure_bg, sure_fg)
 
     # Marker labelling
@@ -41,13 +52,175 @@ def get_markers(img, min_threshold, img_name):
     # Now, mark the region of unknown with zero
     markers[unknown == 255] = 0
 
-    markers = cv.watershed(image, markers)
-    image[markers == -1] = [0, 0, 255]
+    markers = cv.watershed(img, markers)
+    return ret, markers, sure_fg
+
+
+def get_markers(img, min_threshold, img_name, tile_size=None, halo=16, executor=None):
+    """
+    Get the impurities arranged with unique indices from an image (img).
+    Applies image processing.
+    If tile_size is given, the image is processed in overlapping tiles, see get_markers_tiled.
+    """
+    if tile_size is not None:
+        return get_markers_tiled(img, min_threshold, img_name, tile_size, halo, executor)
+
+    ret, markers, _ = watershed_markers(img, min_threshold)
 
     print(img_name + ", number of impurities: " + str(ret))
     return ret, markers
 
 
+def get_markers_fast(img, min_threshold, img_name):
+    """
+    Get the impurities arranged with unique indices from an image (img), labeling the sure foreground of get_markers
+    with connected components only. The watershed of get_markers only resolves the thin unknown band around each
+    impurity, so on many scans the markers are almost the same (see fast_markers_disagreement), but the band pixels
+    stay background and there are no -1 boundaries.
+    :return: the number of labels, the markers, and the boxes (as in save_boxes), areas and (row, column) centroids of
+             the impurities, which come for free from the components statistics
+    """
+    sure_fg = get_sure_fg(img, min_threshold)
+    ret, markers, stats, centroids = cv.connectedComponentsWithStats(sure_fg)
+    markers += 1
+
+    left, top = stats[1:, cv.CC_STAT_LEFT], stats[1:, cv.CC_STAT_TOP]
+    width, height = stats[1:, cv.CC_STAT_WIDTH], stats[1:, cv.CC_STAT_HEIGHT]
+    # the same padding as bbox
+    imp_boxes = np.stack((top - 1, top + height, left - 1, left + width), axis=1).astype(float)
+    areas = stats[1:, cv.CC_STAT_AREA].astype(float)
+
+    print(img_name + ", number of impurities: " + str(ret))
+    return ret, markers, imp_boxes, areas, centroids[1:, ::-1]
+
+
+def fast_markers_disagreement(img, min_threshold, img_name):
+    """
+    Compares the markers of get_markers_fast with the markers of get_markers (watershed), for validating the fast mode
+    on a dataset. Both number the impurities in the same order, so the labels are compared directly.
+    :return: the number of pixels with another impurity (or no impurity) in the two markers, their share of the
+             impurity pixels, and the number of impurities with any disagreeing pixel
+    """
+    ret, markers = get_markers(img, min_threshold, img_name)
+    _, fast_markers, _, _, _ = get_markers_fast(img, min_threshold, img_name)
+    # the background, the unknown region and the boundaries (1, 0, -1) are all not impurity
+    labels = np.where(markers >= 2, markers, 1)
+    fast_labels = np.where(fast_markers >= 2, fast_markers, 1)
+    disagree = labels != fast_labels
+    disagree_pixels = int(np.count_nonzero(disagree))
+    impurity_pixels = int(np.count_nonzero(np.logical_or(labels >= 2, fast_labels >= 2)))
+    disagree_impurities = np.union1d(labels[disagree], fast_labels[disagree])
+    disagree_impurities_num = int(np.count_nonzero(disagree_impurities >= 2))
+    share = disagree_pixels / impurity_pixels if impurity_pixels > 0 else 0.
+    print("{}, fast labeling disagreement: {} pixels ({:.4%} of the impurity pixels), {} of {} impurities".format(
+        img_name, disagree_pixels, share, disagree_impurities_num, ret - 1))
+    return {"pixels": disagree_pixels, "share": share, "impurities": disagree_impurities_num}
+
+
+def get_markers_tile(img, min_threshold, rows, cols, halo):
+    """
+    Runs watershed_markers on the tile img[rows[0]:rows[1], cols[0]:cols[1]] extended by halo pixels in each direction.
+    :return: the number of labels, the markers and the sure foreground of the tile itself (without the halo), and the
+             labels and flat image positions of the sure foreground pixels in the inner half of the halo, used for
+             stitching the tiles
+    """
+    r0, r1 = rows
+    c0, c1 = cols
+    hr0, hr1 = max(r0 - halo, 0), min(r1 + halo, img.shape[0])
+    hc0, hc1 = max(c0 - halo, 0), min(c1 + halo, img.shape[1])
+    ret, markers, sure_fg = watershed_markers(np.ascontiguousarray(img[hr0:hr1, hc0:hc1]), min_threshold)
+
+    # the morphology is not exact near the border of the extended tile, so only the inner half of the halo is used
+    ring = np.zeros(markers.shape, dtype=bool)
+    ring[max(r0 - halo // 2, 0) - hr0:min(r1 + halo // 2, img.shape[0]) - hr0,
+         max(c0 - halo // 2, 0) - hc0:min(c1 + halo // 2, img.shape[1]) - hc0] = True
+    ring[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0] = False
+    ring_rows, ring_cols = np.nonzero(np.logical_and(ring, sure_fg > 0))
+    ring_labels = markers[ring_rows, ring_cols]
+    ring_positions = np.ravel_multi_index((ring_rows + hr0, ring_cols + hc0), img.shape[:2])
+
+    core = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+    return ret, markers[core], sure_fg[core] > 0, ring_labels, ring_positions
+
+
+def get_markers_tiles_chunk(tiles_chunk, img, min_threshold, tiles, halo):
+    return [get_markers_tile(img, min_threshold, tiles[i][0], tiles[i][1], halo) for i in tiles_chunk]
+
+
+def get_markers_tiled(img, min_threshold, img_name, tile_size=2048, halo=16, executor=None):
+    """
+    Get the impurities arranged with unique indices from an image (img, or a ScanReader, which reads each tile only
+    when it is processed), processing tile_size x tile_size tiles
+    (the chunks of the tiles by executor, serial if None), each one extended by halo pixels, and stitching the labels across the tile seams.
+    An impurity is stitched through the sure foreground pixels that a tile sees in the halo of its neighbours, so an
+    impurity crossing a seam keeps a single label.
+    The threshold, closing and dilation are local, so for halo >= 8 the sure foreground, the impurities and the
+    background are identical to the full-frame get_markers. Only the flooding of the unknown band (the ring of 3 pixels
+    around each impurity that watershed assigns) sees no more than halo pixels beyond its tile, so band pixels closer
+    than halo pixels to a seam may be assigned differently than in the full-frame run.
+    The labels are numbered in the same order as cv.connectedComponents numbers them in the full-frame run.
+    """
+    start = time.time()
+    tiles = [((r, min(r + tile_size, img.shape[0])), (c, min(c + tile_size, img.shape[1])))
+             for r in range(0, img.shape[0], tile_size) for c in range(0, img.shape[1], tile_size)]
+
+    if executor is None:
+        executor = Executor()
+    # a watershed of a tile takes about a second
+    tiles_chunks = executor.chunks(np.arange(len(tiles)), cost=1.)
+    tiles_out = [tile_out for chunk_out in executor.map(get_markers_tiles_chunk, tiles_chunks, img, min_threshold,
+                                                        tiles, halo) for tile_out in chunk_out]
+
+    # every tile gets its own range of labels, 2 + offset..
+    markers = np.zeros(img.shape[:2], dtype=np.int32)
+    sure_fg = np.zeros(img.shape[:2], dtype=bool)
+    offsets = []
+    labels_num = 0
+    for ((r0, r1), (c0, c1)), (tile_ret, tile_markers, tile_fg, _, _) in zip(tiles, tiles_out):
+        tile_markers[tile_markers >= 2] += labels_num
+        markers[r0:r1, c0:c1] = tile_markers
+        sure_fg[r0:r1, c0:c1] = tile_fg
+        offsets.append(labels_num)
+        labels_num += tile_ret - 1
+
+    # a sure foreground pixel in the halo of a tile has the same impurity in the neighbouring tile
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    flat_markers = markers.ravel()
+    for offset, (_, _, _, ring_labels, ring_positions) in zip(offsets, tiles_out):
+        neighbour_labels = flat_markers[ring_positions]
+        # watershed marks the border of the image with -1, also on sure foreground pixels
+        both = np.logical_and(ring_labels >= 2, neighbour_labels >= 2)
+        first.append(ring_labels[both].astype(np.int64) + offset - 2)
+        second.append(neighbour_labels[both].astype(np.int64) - 2)
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    graph = coo_matrix((np.ones(first.shape[0]), (first, second)), shape=(labels_num, labels_num))
+    _, components = connected_components(graph, directed=False)
+
+    # compact the labels to 2..ret. cv.connectedComponents scans the image in blocks of 2 rows, so the impurities are
+    # numbered by their first sure foreground pixel in that order
+    even_rows = markers.shape[0] // 2 * 2
+    blocks_markers = markers[:even_rows].reshape(-1, 2, markers.shape[1]).transpose(0, 2, 1)
+    blocks_fg = sure_fg[:even_rows].reshape(-1, 2, markers.shape[1]).transpose(0, 2, 1)
+    fg_labels = np.concatenate((blocks_markers[blocks_fg], markers[even_rows:][sure_fg[even_rows:]]))
+    fg_labels = fg_labels[fg_labels >= 2]
+    present, first_pixel = np.unique(components[fg_labels - 2], return_index=True)
+    ordered = present[np.argsort(first_pixel)]
+    is_impurity = markers >= 2
+    impurity_components = components[markers[is_impurity] - 2]
+    # impurities without sure foreground pixels in their own tiles (should not happen for halo >= 8) come last
+    ordered = np.concatenate((ordered, np.setdiff1d(np.unique(impurity_components), ordered)))
+    new_labels = np.zeros(max(labels_num, 1), dtype=np.int32)
+    new_labels[ordered] = np.arange(2, ordered.shape[0] + 2, dtype=np.int32)
+    markers[is_impurity] = new_labels[impurity_components]
+    ret = ordered.shape[0] + 1
+
+    end = time.time()
+    print("time get_markers_tiled: " + str(end - start))
+    print(img_name + ", number of impurities: " + str(ret))
+    return ret, markers
+
+
 def bbox(img):
     """
     Get the bounding box of an impurity in an image such that all of it is blank but the impurity itself.
@@ -69,132 +242,214 @@ def bbox(img):
     return int(rmin), int(rmax), int(cmin), int(cmax)
 
 
-@ray.remote
-def save_boxes_single(markers, impurities_list):
-    boxes = np.zeros((len(impurities_list), 4))  # impurities_num-1 elements, each with 4 features
-    for i in range(len(impurities_list)):
-        indx = markers == impurities_list[i]
-        rmin, rmax, cmin, cmax = bbox(indx)
-        boxes[i, :] = rmin, rmax, cmin, cmax
-    return boxes
-
-
 def save_boxes(markers, impurities_num):
     """
-    Saves the bounding boxes
+    Saves the bounding boxes of all the impurities in a single pass over the markers
     boxes[i-2] := (rmin, rmax, cmin, cmax) of impurity i
+    The boxes are padded by one pixel in each direction, the same as bbox does, and an impurity without any pixel gets
+    the box (0, 0, 0, 0).
     """
     start = time.time()
 
     boxes = np.zeros((impurities_num - 1, 4))  # impurities_num-1 elements, each with 4 features
 
-    impurities_list = range(2, impurities_num + 1)
-    impurities_chunks = np.array_split(impurities_list, num_threads)
-
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(save_boxes_single.remote(markers, impurities_chunks[i]))
-    for i in range(num_threads):
-        task_out = ray.get(tasks[i])
-        boxes[impurities_chunks[i] - 2, :] = task_out[:, :]
+    # find_objects ignores the non-positive labels (watershed boundaries), objects[j] is the slice of label j + 1
+    objects = ndimage.find_objects(markers, max_label=impurities_num)
+    for impurity in range(2, impurities_num + 1):
+        obj = objects[impurity - 1]
+        if obj is not None:
+            rows, cols = obj
+            boxes[impurity - 2, :] = rows.start - 1, rows.stop, cols.start - 1, cols.stop
 
     end = time.time()
-    print("time save_boxes parallel: " + str(end - start))
+    print("time save_boxes: " + str(end - start))
 
     return boxes
 
 
-def save_boxes_not_parallel(markers, impurities_num):
+def get_impurity_areas_and_significant_indices(imp_boxes, markers, min_area=3):
     """
-    Saves the bounding boxes
-    boxes[i-2] := (rmin, rmax, cmin, cmax) of impurity i
+    Counts the pixels of all the impurities with a single histogram of the markers.
+    imp_area[i] := area of impurity i (label i + 2)
+    indices := the sorted impurities with an area bigger than min_area
     """
     start = time.time()
+    impurities_num = imp_boxes.shape[0]
 
-    boxes = np.zeros((impurities_num - 1, 4))  # impurities_num-1 elements, each with 4 features
-
-    for impurity in range(2, impurities_num + 1):
-        indx = markers == impurity
-        rmin, rmax, cmin, cmax = bbox(indx)
-        boxes[impurity - 2, :] = rmin, rmax, cmin, cmax
+    # labels 0 (unknown) and -1 (watershed boundaries) are not counted, 1 is the background
+    labels = markers[markers >= 2]
+    imp_area = np.bincount(labels, minlength=impurities_num + 2)[2:impurities_num + 2].astype(float)
+    indices = np.flatnonzero(imp_area > min_area).tolist()
 
     end = time.time()
-    print("time save_boxes not parallel: " + str(end - start))
-    return boxes
-
-@ray.remote
-def get_impurity_areas_and_significant_indices_single(markers, impurities_chunks, min_area):
-    imp_area = np.zeros(len(impurities_chunks))
-    indices = []
-    for i in range(len(impurities_chunks)):
-        impurity = impurities_chunks[i]
-        impurity_shape = np.argwhere(markers == impurity + 2)
-        area = impurity_shape.shape[0]
-        imp_area[i] = area
-        if area > min_area:
-            indices.append(impurity)
+    print("time get_impurity_areas_and_significant_indices: " + str(end - start))
     return imp_area, indices
 
 
-def get_impurity_areas_and_significant_indices(imp_boxes, markers, min_area=3):
+def get_impurity_centroids(markers, imp_area):
+    """
+    Calculates the center of mass (row, column) of all the impurities with a single pass over the markers.
+    Impurities without any pixel get a nan centroid.
+    """
+    impurities_num = len(imp_area)
+    rows, cols = np.nonzero(markers >= 2)
+    labels = markers[rows, cols] - 2
+    sum_rows = np.bincount(labels, weights=rows, minlength=impurities_num)[:impurities_num]
+    sum_cols = np.bincount(labels, weights=cols, minlength=impurities_num)[:impurities_num]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroids = np.stack((sum_rows, sum_cols), axis=1) / np.asarray(imp_area, dtype=float)[:, None]
+    return centroids
+
+
+def get_impurity_perimeters(markers, impurities_num):
+    """
+    Counts the boundary pixels of all the impurities with a single pass over the markers. A pixel is on the boundary
+    of its impurity if one of its 4-neighbours has another label, or if it lies on the border of the image.
+    """
+    same = np.zeros(markers.shape, dtype=bool)
+    same[1:-1, 1:-1] = True
+    same[1:, :] &= markers[1:, :] == markers[:-1, :]
+    same[:-1, :] &= markers[:-1, :] == markers[1:, :]
+    same[:, 1:] &= markers[:, 1:] == markers[:, :-1]
+    same[:, :-1] &= markers[:, :-1] == markers[:, 1:]
+    boundary = np.logical_and(markers >= 2, ~same)
+    labels = markers[boundary] - 2
+    return np.bincount(labels, minlength=impurities_num)[:impurities_num]
+
+
+def get_impurity_pixel_index(markers, impurities_num):
+    """
+    Groups the pixels of all the impurities by their label (CSR layout), so the pixels of a single impurity can be
+    fetched without comparing the whole markers image.
+    :return: pixels - the flat indices of all the impurity pixels, sorted by impurity and row-major inside each one,
+             pixel_offsets - the pixels of impurity i are pixels[pixel_offsets[i]:pixel_offsets[i + 1]]
+    """
+    flat_markers = markers.ravel()
+    impurity_pixels = np.flatnonzero(flat_markers >= 2)
+    labels = flat_markers[impurity_pixels] - 2
+    # a stable sort keeps the row-major order inside each impurity
+    pixels = impurity_pixels[np.argsort(labels, kind='stable')]
+    counts = np.bincount(labels, minlength=impurities_num)[:impurities_num]
+    pixel_offsets = np.zeros(impurities_num + 1, dtype=np.int64)
+    np.cumsum(counts, out=pixel_offsets[1:])
+    return pixels, pixel_offsets
+
+
+def prune_small_impurities(markers, impurities_num, min_area=3, areas=None):
+    """
+    Removes the impurities with an area not bigger than min_area from the markers (their pixels become background),
+    and relabels the remaining impurities compactly, in the same order.
+    :param areas: the areas of the impurities, computed from the markers if not given
+    :return: the number of labels of the pruned markers, the pruned markers, and the ids of the remaining impurities
+             (their indices before the pruning)
+    """
     start = time.time()
-    imp_area = np.zeros(imp_boxes.shape[0])
-    indices = []
-
-    impurities_chunks = np.array_split(range(imp_boxes.shape[0]), num_threads)
-
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(get_impurity_areas_and_significant_indices_single.remote(markers, impurities_chunks[i], min_area))
-    for i in range(num_threads):
-        task_out_areas, task_out_indices = ray.get(tasks[i])
-        imp_area[impurities_chunks[i]] = task_out_areas[:]   # order is important
-        indices.extend(task_out_indices)   # order is not important
+    if areas is None:
+        labels = markers[markers >= 2]
+        areas = np.bincount(labels, minlength=impurities_num + 1)[2:impurities_num + 1]
+    ids = np.flatnonzero(np.asarray(areas) > min_area).astype(np.int32)
+
+    # lut[label + 1] := the label after the pruning, the boundaries, unknown and background (-1, 0, 1) stay the same
+    lut = np.ones(impurities_num + 2, dtype=np.int32)
+    lut[:3] = (-1, 0, 1)
+    lut[ids + 3] = np.arange(2, ids.shape[0] + 2, dtype=np.int32)
+    markers = lut[markers + 1]
+
     end = time.time()
-    print("time get_impurity_areas_and_significant_indices parallel: " + str(end - start))
-    return imp_area, indices
+    print("time prune_small_impurities: " + str(end - start))
+    return ids.shape[0] + 1, markers, ids
 
 
-def get_impurity_areas_and_significant_indices_not_parallel(imp_boxes, markers, min_area=3):
+def get_impurity_table(markers, impurities_num, min_area=3, imp_boxes=None, areas=None, centroids=None, ids=None):
+    """
+    Builds the ImpurityTable of all the impurities in the markers (impurities_num as returned by get_markers).
+    The boxes, areas and centroids are computed from the markers unless they are given (see get_markers_fast).
+    :param ids: the original ids of the impurities if the markers were pruned (see prune_small_impurities)
+    """
     start = time.time()
-    imp_area = []
-    indices = []
-    for impurity in range(imp_boxes.shape[0]):
-        impurity_shape = np.argwhere(markers == impurity + 2)
-        area = impurity_shape.shape[0]
-        imp_area.append(area)
-        if area > min_area:
-            indices.append(impurity)
+    if imp_boxes is None:
+        imp_boxes = save_boxes(markers, impurities_num)
+    if areas is None:
+        areas, indices = get_impurity_areas_and_significant_indices(imp_boxes, markers, min_area)
+    else:
+        indices = np.flatnonzero(areas > min_area).tolist()
+    if centroids is None:
+        centroids = get_impurity_centroids(markers, areas)
+    perimeters = get_impurity_perimeters(markers, imp_boxes.shape[0])
+    pixels, pixel_offsets = get_impurity_pixel_index(markers, imp_boxes.shape[0])
+    table = ImpurityTable(imp_boxes, areas, indices, centroids, perimeters, pixels, pixel_offsets, markers.shape, ids)
     end = time.time()
-    print("time get_impurity_areas_and_significant_indices not parallel: " + str(end - start))
-    return imp_area, indices
+    print("time get_impurity_table: " + str(end - start))
+    return table
 
 
-def normalize_all_impurities(dir_path):
+def normalize_all_impurities(dir_path, min_threshold=0, executor=None):
+    """
+    Prepares the training set of the autoencoder: the normalized images of the impurities of every scan in dir_path
+    with their circle scores, as a crop archive per scan in ./data/rescaled_extended/<scan name>/ (see
+    archive_training_set).
+    """
     scans_dir = os.listdir(dir_path)
     for img_path in scans_dir:
         img_name = os.path.splitext(os.path.basename(img_path))[0]
         img = cv.imread(dir_path + img_path)
-        ret, markers = get_markers(img)
-        imp_boxes = save_boxes(markers, ret)
-        areas, indices = get_impurity_areas_and_significant_indices(imp_boxes, markers)
-        scores = get_circle_impurity_score(markers, imp_boxes, areas, indices)
-        rescale_and_write_normalized_impurity(img, markers, imp_boxes, areas, indices, scores, scan_name=img_name,
-                                              dest_path_normal="./data/rescaled_extended/normal/",
-                                              dest_path_anomaly="./data/rescaled_extended/anomaly/"
-                                              )
-
-
-def extract_impurities(img_path, use_ray, min_threshold=0, black_background=True):
-    img = cv.imread(img_path)
-    if black_background:
-        img = 255 - img
+        ret, markers = get_markers(img, min_threshold, img_name)
+        table = get_impurity_table(markers, ret)
+        scores = get_circle_impurity_score(table, executor=executor)
+        write_impurity_crop_archive(img, table, scores, "./data/rescaled_extended/" + img_name, scan_name=img_name,
+                                    executor=executor)
+
+
+def extract_impurities(img_path, executor=None, min_threshold=0, black_background=True, tile_size=None, cache_dir=None,
+                       fast=False, prune_min_area=3):
+    """
+    Reads a scan and extracts its impurities.
+    :param prune_min_area: if not None, the impurities with an area not bigger than it are removed right after the
+                           labeling, so all the later stages work only on the significant impurities. The table keeps
+                           the original id of every impurity (table.ids).
+    :param executor: the Executor that runs the tiles of the watershed (if tile_size is given), serial if None
+    :param tile_size: if given, the watershed runs on tiles of this size, see get_markers_tiled
+    :param fast: label the impurities with connected components only, without the watershed (and without tiles),
+                 see get_markers_fast
+    :param cache_dir: if given, the markers and the table are loaded from this extraction cache when the scan was
+                      already extracted with the same parameters, and saved to it otherwise. Compressed scans are
+                      decoded once into its scans directory (see ScanReader).
+    :return: the (inverted) image, the number of labels, the markers and the ImpurityTable of the impurities
+    """
+    reader = ScanReader(img_path, invert=black_background,
+                        spool_dir=os.path.join(cache_dir, "scans") if cache_dir is not None else None)
     img_name = os.path.splitext(os.path.basename(img_path))[0]
-    ret, markers = get_markers(img, min_threshold, img_name)
-    if use_ray:
-        imp_boxes = save_boxes(markers, ret)
-        areas, indices = get_impurity_areas_and_significant_indices(imp_boxes, markers)
+
+    if cache_dir is not None:
+        file_sha = scan_file_sha(img_path)
+        key = extraction_cache_key(img_path, min_threshold, black_background, tile_size, fast, prune_min_area,
+                                   file_sha)
+        cached = load_extraction(cache_dir, key)
+        if cached is not None:
+            ret, markers, table = cached
+            print(img_name + ", number of impurities: " + str(ret) + " (from the extraction cache)")
+            return reader.read(), ret, markers, table
+
+    if fast:
+        img = reader.read()
+        ret, markers, imp_boxes, areas, centroids = get_markers_fast(img, min_threshold, img_name)
+        ids = None
+        if prune_min_area is not None:
+            ret, markers, ids = prune_small_impurities(markers, ret, prune_min_area, areas)
+            imp_boxes, areas, centroids = imp_boxes[ids], areas[ids], centroids[ids]
+        table = get_impurity_table(markers, ret, imp_boxes=imp_boxes, areas=areas, centroids=centroids, ids=ids)
     else:
-        imp_boxes = save_boxes_not_parallel(markers, ret)
-        areas, indices = get_impurity_areas_and_significant_indices_not_parallel(imp_boxes, markers)
-    return img, ret, markers, imp_boxes, areas, indices
+        # each tile reads only its own region of the scan, the whole scan is read after the labeling
+        scan = reader if tile_size is not None else reader.read()
+        ret, markers = get_markers(scan, min_threshold, img_name, tile_size=tile_size, executor=executor)
+        img = reader.read() if tile_size is not None else scan
+        ids = None
+        if prune_min_area is not None:
+            ret, markers, ids = prune_small_impurities(markers, ret, prune_min_area)
+        table = get_impurity_table(markers, ret, ids=ids)
+    if ids is not None:
+        print(img_name + ", number of impurities after pruning: " + str(ret))
+
+    if cache_dir is not None:
+        save_extraction(cache_dir, key, img_path, ret, markers, table, file_sha)
+    return img, ret, markers, table
@@ -0,0 +1,130 @@
+import os
+import json
+import numpy as np
+
+
+class ImpurityTable:
+    """
+    The per-impurity facts of a single scan, kept as columns (struct of arrays) so that they are computed once in
+    extract_impurities and then passed through all the pipeline stages.
+    Row i describes impurity i, which is labeled i + 2 in the markers.
+    """
+
+    def __init__(self, boxes, areas, indices, centroids, perimeters, pixels, pixel_offsets, image_shape, ids=None):
+        """
+        :param boxes: (rmin, rmax, cmin, cmax) of each impurity, as returned by save_boxes
+        :param areas: the number of pixels of each impurity
+        :param indices: the indices of the significant impurities (the ones with a not too-small size)
+        :param centroids: (row, column) of the center of mass of each impurity
+        :param perimeters: the number of boundary pixels of each impurity
+        :param pixels: the flat (raveled) indices of the pixels of all the impurities, grouped by impurity
+        :param pixel_offsets: the pixels of impurity i are pixels[pixel_offsets[i]:pixel_offsets[i + 1]]
+        :param image_shape: the (rows, columns) shape of the markers
+        :param ids: the original id of each impurity, when the small impurities were pruned during the labeling (the
+                    outputs are keyed by these ids). By default the id of impurity i is i.
+        """
+        if ids is None:
+            ids = np.arange(boxes.shape[0], dtype=np.int32)
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.boxes = np.asarray(boxes).astype(np.int32)
+        self.areas = np.asarray(areas, dtype=float)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.perimeters = np.asarray(perimeters, dtype=np.int32)
+        self.significant = np.zeros(boxes.shape[0], dtype=bool)
+        self.significant[indices] = True
+        self.pixels = pixels
+        self.pixel_offsets = pixel_offsets
+        self.image_shape = tuple(image_shape[:2])
+        self._labels = None
+
+        # score columns, filled by the anomaly detection stages
+        self.circle_scores = None
+        self.shape_scores = None
+        self.spatial_scores = {}  # k -> scores
+        self.spatial_score_bounds = {}  # k -> (lower, upper) bounds on the exact weighted kth nn of approximate scores
+        self.combined_scores = {}  # k -> scores
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __getstate__(self):
+        # the label image (4 bytes per pixel of the scan) is a cache, it is not sent to the workers of an executor
+        state = self.__dict__.copy()
+        state["_labels"] = None
+        return state
+
+    @property
+    def indices(self):
+        """
+        The indices of the significant impurities, sorted.
+        """
+        return np.flatnonzero(self.significant).tolist()
+
+    def impurity_pixels(self, impurity):
+        """
+        The flat (raveled) indices of the pixels of an impurity, in row-major order.
+        """
+        return self.pixels[self.pixel_offsets[impurity]:self.pixel_offsets[impurity + 1]]
+
+    def impurities_pixels(self, impurities):
+        """
+        The flat (raveled) indices of the pixels of several impurities at once, grouped by impurity (in the order of
+        impurities) and in row-major order in each.
+        :return: (pixels, owners) - owners[j] is the position in impurities of the impurity of pixels[j]
+        """
+        impurities = np.asarray(impurities, dtype=np.int64)
+        starts = self.pixel_offsets[impurities]
+        counts = self.pixel_offsets[impurities + 1] - starts
+        owners = np.repeat(np.arange(impurities.shape[0]), counts)
+        pixels = np.asarray(self.pixels)[np.repeat(starts - np.cumsum(counts) + counts, counts) +
+                                         np.arange(owners.shape[0])]
+        return pixels, owners
+
+    def impurity_coordinates(self, impurity):
+        """
+        The (row, column) coordinates of the pixels of an impurity, the same as np.argwhere(markers == impurity + 2).
+        """
+        return np.stack(np.unravel_index(self.impurity_pixels(impurity), self.image_shape), axis=1)
+
+    def labels(self):
+        """
+        The label image of the impurities: i at the pixels of impurity i, -1 elsewhere (markers - 2 for the impurities).
+        Calculated once per table.
+        """
+        if self._labels is None:
+            self._labels = np.full(self.image_shape, -1, dtype=np.int32)
+            self._labels.reshape(-1)[self.pixels] = np.repeat(np.arange(len(self), dtype=np.int32),
+                                                              np.diff(self.pixel_offsets))
+        return self._labels
+
+    def rows_of_ids(self, ids):
+        """
+        The rows (indices in the table) of impurities given by their original ids.
+        """
+        return np.searchsorted(self.ids, ids)
+
+    def save(self, dir_path):
+        """
+        Writes the columns of the table (without the scores) as .npy files into dir_path.
+        """
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        for column in ("ids", "boxes", "areas", "centroids", "perimeters", "significant", "pixels", "pixel_offsets"):
+            np.save(os.path.join(dir_path, column + ".npy"), getattr(self, column))
+        with open(os.path.join(dir_path, "table.json"), "w") as json_file:
+            json.dump({"image_shape": list(self.image_shape)}, json_file)
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        """
+        Reads a table written by save. The big columns (the pixel index) are memory-mapped by default, so they are read
+        from the disk only when accessed.
+        """
+        def column(name):
+            return np.load(os.path.join(dir_path, name + ".npy"), mmap_mode=mmap_mode)
+
+        with open(os.path.join(dir_path, "table.json"), "r") as json_file:
+            image_shape = json.load(json_file)["image_shape"]
+        table = cls(column("boxes"), column("areas"), np.flatnonzero(column("significant")), column("centroids"),
+                    column("perimeters"), column("pixels"), column("pixel_offsets"), image_shape, column("ids"))
+        return table
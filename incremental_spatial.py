@@ -0,0 +1,202 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import numpy as np
+    import time
+    from utils import impurity_dists, impurity_dists_pairs
+    from spatial_anomaly import weighted_kth_nn_sweep_values, normalize_spatial_scores
+    from spatial_index import BoxGrid, AreaBucketIndex
+
+
+class IncrementalSpatialScores:
+    """
+    The spatial scores of weighted_kth_nn (for all k up to max_k, as weighted_kth_nn_sweep) of impurities that are
+    edited, e.g. when mis-segmented impurities are merged, split or deleted, without calculating them all again.
+    The neighbor index is the max_k smallest weighted distances of every impurity (kth_values). An edited impurity x
+    may change the neighbors of an impurity i only if its weighted distance from i is at most the max_k-th one of i:
+    the impurities that lose such a neighbor are calculated again, and a new neighbor is merged into the neighbors of
+    the impurities it is near enough to. The scores are then normalized again from kth_values.
+    Both are found through indexes of the impurities (see _build_indexes), so an edit does not check all of them.
+    Row i is impurity i of the table, added impurities get the next rows. Removed impurities keep their rows, with a
+    score of 0.
+    """
+
+    def __init__(self, imp_boxes, imp_area, indices, max_k, min_dist=0.00001, memory_cap=2 ** 28, method="blocked",
+                 max_stale=256):
+        """
+        :param indices: the impurities to score (the significant ones)
+        :param method: how the impurities are calculated at first, see weighted_kth_nn_scores. The edits calculate
+                       them through the indexes (exactly), except for "approximate".
+        :param max_stale: the indexes are built again when more impurities than this (or a 16th of them) are stale
+        """
+        start = time.time()
+        self.boxes = np.array(imp_boxes, dtype=np.int64)
+        self.areas = np.array(imp_area, dtype=float)
+        self.active = np.zeros(self.boxes.shape[0], dtype=bool)
+        self.active[indices] = True
+        self.max_k = max_k
+        self.min_dist = min_dist
+        self.memory_cap = memory_cap
+        self.method = method
+        self.max_stale = max_stale
+
+        self.kth_values = np.zeros((self.boxes.shape[0], max_k))
+        self.kth_values[self.indices] = weighted_kth_nn_sweep_values(self.boxes, self.areas, self.indices,
+                                                                     self.indices, max_k, min_dist, memory_cap, method)
+        self._build_indexes()
+        end = time.time()
+        print("time IncrementalSpatialScores: " + str(end - start))
+
+    @classmethod
+    def from_table(cls, table, max_k, min_dist=0.00001, memory_cap=2 ** 28, method="blocked"):
+        return cls(table.boxes, table.areas, table.indices, max_k, min_dist, memory_cap, method)
+
+    @property
+    def indices(self):
+        """
+        The rows of the impurities that are not removed, sorted.
+        """
+        return np.flatnonzero(self.active)
+
+    def _build_indexes(self):
+        """
+        Indexes the current impurities for the edits:
+        - an AreaBucketIndex of the neighbor candidates, for calculating impurities again
+        - the impurities in buckets of similar reach kth_values[i, max_k - 1] / areas[i] ** 4 (a ratio of at most 2),
+          each one with its own BoxGrid. An impurity x with a weighted distance of at most the max_k-th one of i is at
+          distance at most reach[i] * areas[x] ** 4 from i, so only the impurities within that distance of x (for the
+          max reach of a bucket) may have x among their neighbors.
+        The impurities edited (or calculated again) after the indexes were built are stale, the indexes skip them and
+        they are checked one by one, until there are too many of them and the indexes are built again.
+        """
+        indices = self.indices
+        self.stale = np.zeros(self.boxes.shape[0], dtype=bool)
+        self.neighbor_index = None
+        self.reach_buckets = []
+        if indices.shape[0] == 0:
+            return
+        self.neighbor_index = AreaBucketIndex(self.boxes, self.areas, indices, self.min_dist)
+        reach = self.kth_values[indices, self.max_k - 1] / np.float_power(self.areas[indices], 4)
+        buckets = np.floor(np.log2(np.clip(reach, 1e-300, 1e300))).astype(int)
+        for bucket in np.unique(buckets):
+            members = indices[buckets == bucket]
+            self.reach_buckets.append((members, np.max(reach[buckets == bucket]), BoxGrid(self.boxes[members])))
+
+    def _stale_rows(self):
+        return np.flatnonzero(self.stale & self.active)
+
+    def _calculate(self, impurities, block_size=1024):
+        """
+        The max_k smallest weighted distances of the impurities, as weighted_kth_nn_sweep_values: the stale impurities
+        are checked one by one, and their max_k-th smallest weighted distance bounds the search of the neighbor index.
+        """
+        if self.method == "approximate" or self.neighbor_index is None:
+            return weighted_kth_nn_sweep_values(self.boxes, self.areas, self.indices, impurities, self.max_k,
+                                                self.min_dist, self.memory_cap, self.method)
+        stale = self._stale_rows()
+        skipped = self.stale[self.neighbor_index.indices]
+        kth_values = np.zeros((impurities.shape[0], self.max_k))
+        for block_start in range(0, impurities.shape[0], block_size):
+            block = impurities[block_start:block_start + block_size]
+            k_nn = np.full((block.shape[0], self.max_k), np.inf)
+            if stale.shape[0] > 0:
+                weights = np.float_power(self.areas[block, np.newaxis] / self.areas[np.newaxis, stale], 4) * \
+                    np.maximum(impurity_dists_pairs(self.boxes[block], self.boxes[stale]), self.min_dist)
+                # an impurity is not its own neighbor
+                weights[block[:, np.newaxis] == stale[np.newaxis, :]] = np.inf
+                k_nn = np.sort(np.concatenate((k_nn, weights), axis=1), axis=1)[:, :self.max_k]
+            found = self.neighbor_index.smallest_weighted_distances_of(
+                self.boxes[block], self.areas[block], block, self.max_k, bounds=k_nn[:, self.max_k - 1],
+                skipped=skipped)[0]
+            kth_values[block_start:block_start + block.shape[0]] = \
+                np.sort(np.concatenate((k_nn, found), axis=1), axis=1)[:, :self.max_k]
+        return kth_values
+
+    def _weighted_distances_to(self, impurity, impurities):
+        """
+        The weighted distances from impurities to impurity, as weighted_kth_nn_blocked calculates them.
+        """
+        return np.float_power(self.areas[impurities] / self.areas[impurity], 4) * \
+            np.maximum(impurity_dists(self.boxes[impurity], self.boxes[impurities]), self.min_dist)
+
+    def _neighbors_of(self, impurity):
+        """
+        The rows of the impurities that may have impurity (its current box and area) among their max_k neighbors:
+        the ones near enough to it in the reach buckets and the stale ones.
+        """
+        others = [self._stale_rows()]
+        box = self.boxes[impurity][np.newaxis]
+        area_weight = np.float_power(self.areas[impurity], 4)
+        for members, max_reach, grid in self.reach_buckets:
+            # a margin for the rounding, as in AreaBucketIndex
+            _, found = grid.query(box, [max_reach * area_weight * (1 + 1e-9) + 1])
+            found = members[found]
+            others.append(found[~self.stale[found]])
+        others = np.concatenate(others)
+        others = others[others != impurity]
+        near = self._weighted_distances_to(impurity, others) <= self.kth_values[others, self.max_k - 1]
+        return others[near]
+
+    def edit(self, removed=(), resized=None, added=None):
+        """
+        Applies the edits and updates the neighbor index.
+        :param removed: the rows of the removed impurities
+        :param resized: (rows, boxes, areas) of impurities with a new box and area
+        :param added: (boxes, areas) of new impurities, (rmin, rmax, cmin, cmax) boxes as returned by save_boxes
+        :return: the rows of the added impurities
+        """
+        start = time.time()
+        removed = np.asarray(removed, dtype=int)
+        resized_rows = np.zeros(0, dtype=int)
+        if resized is not None:
+            resized_rows = np.asarray(resized[0], dtype=int)
+        added_rows = np.zeros(0, dtype=int)
+
+        # the impurities that lose a neighbor (or may) are calculated again
+        recalculate = [resized_rows]
+        for impurity in np.concatenate((removed, resized_rows)):
+            recalculate.append(self._neighbors_of(impurity))
+
+        self.stale[removed] = True
+        self.stale[resized_rows] = True
+        self.active[removed] = False
+        self.kth_values[removed] = 0
+        if resized is not None:
+            self.boxes[resized_rows] = resized[1]
+            self.areas[resized_rows] = resized[2]
+        if added is not None:
+            added_rows = np.arange(self.boxes.shape[0], self.boxes.shape[0] + len(added[1]))
+            self.boxes = np.concatenate((self.boxes, np.asarray(added[0], dtype=np.int64).reshape(-1, 4)))
+            self.areas = np.concatenate((self.areas, np.asarray(added[1], dtype=float)))
+            self.active = np.concatenate((self.active, np.ones(added_rows.shape[0], dtype=bool)))
+            self.kth_values = np.concatenate((self.kth_values, np.zeros((added_rows.shape[0], self.max_k))))
+            self.stale = np.concatenate((self.stale, np.ones(added_rows.shape[0], dtype=bool)))
+        recalculate.append(added_rows)
+        recalculate = np.unique(np.concatenate(recalculate))
+        recalculate = recalculate[self.active[recalculate]]
+        self.kth_values[recalculate] = self._calculate(recalculate)
+        # their reach may grow, the merges below only shrink the reach of the others
+        self.stale[recalculate] = True
+
+        # the new and the resized impurities become neighbors of the impurities they are near enough to
+        calculated = np.zeros(self.boxes.shape[0], dtype=bool)
+        calculated[recalculate] = True
+        for impurity in np.concatenate((resized_rows, added_rows)):
+            near = self._neighbors_of(impurity)
+            near = near[~calculated[near]]
+            weights = self._weighted_distances_to(impurity, near)
+            self.kth_values[near] = np.sort(np.concatenate((self.kth_values[near], weights[:, np.newaxis]), axis=1),
+                                            axis=1)[:, :self.max_k]
+        if np.count_nonzero(self.stale) > max(self.max_stale, self.indices.shape[0] // 16):
+            self._build_indexes()
+        end = time.time()
+        print("time IncrementalSpatialScores edit: " + str(end - start) + ", impurities calculated again: " +
+              str(recalculate.shape[0]))
+        return added_rows
+
+    def scores(self):
+        """
+        The spatial scores of the impurities, the same as the ones of weighted_kth_nn_sweep for the edited impurities.
+        :return: (number of rows, max_k) array, column k - 1 for k
+        """
+        return normalize_spatial_scores(self.areas, self.indices, self.kth_values)
@@ -0,0 +1,81 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import os
+    import json
+    import numpy as np
+    import time
+    from spatial_anomaly import weighted_kth_nn_sweep_chunk, normalize_spatial_scores, area_bucket_index
+    from executor import Executor
+
+
+def read_mosaic_offsets(json_path):
+    """
+    Reads the offsets of the scans (tiles) of a mosaic: a JSON object {scan file name: [row, column]}, the position of
+    the top left pixel of each scan in the mosaic.
+    """
+    with open(json_path, "r") as json_file:
+        offsets = json.load(json_file)
+    return dict((os.path.basename(name), (int(offset[0]), int(offset[1]))) for name, offset in offsets.items())
+
+
+def mosaic_spatial_scores(tile_paths, offsets, k_list, load_table, executor=None, memory_cap=2 ** 30,
+                          method="index", window=2):
+    """
+    The spatial scores of weighted_kth_nn of the impurities of all the scans of a mosaic, each impurity scored against
+    the impurities of all the scans (in the coordinates of the mosaic), so that the impurities near the edges of a scan
+    get their real neighbors from the next scans. The scores are normalized over the whole mosaic. The scans are
+    expected not to overlap.
+    The scans are loaded one at a time, and only the boxes and areas of their impurities are kept: a big impurity far
+    away may be the weighted nearest neighbor, so no halo is small enough for exact scores, but the boxes and areas of
+    a whole mosaic are small. The k-th weighted distances are then calculated scan by scan against the boxes of all
+    the scans.
+    :param offsets: scan file name -> (row, column) of the scan in the mosaic, see read_mosaic_offsets
+    :param load_table: function of a scan path that returns its ImpurityTable (e.g. through extract_impurities)
+    :param executor: the Executor that runs the chunks of the impurities of each scan, serial if None
+    :return: dictionary scan path -> dictionary k -> the spatial scores of the impurities of the scan (rows of its
+             table)
+    """
+    start = time.time()
+    boxes = []
+    areas = []
+    significant = []
+    for path in tile_paths:
+        name = os.path.basename(path)
+        if name not in offsets:
+            raise ValueError("no mosaic offset for the scan " + path)
+        row, col = offsets[name]
+        table = load_table(path)
+        boxes.append(np.asarray(table.boxes, dtype=np.int64) + np.array([row, row, col, col]))
+        areas.append(np.asarray(table.areas))
+        significant.append(np.asarray(table.significant))
+        del table
+    tile_starts = np.cumsum([0] + [tile_boxes.shape[0] for tile_boxes in boxes])
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.int64)
+    areas = np.concatenate(areas) if areas else np.zeros(0)
+    indices = np.flatnonzero(np.concatenate(significant)) if significant else np.zeros(0, dtype=int)
+    end = time.time()
+    print("time mosaic_spatial_scores load: " + str(end - start) + ", impurities: " + str(indices.shape[0]))
+
+    if executor is None:
+        executor = Executor()
+    max_k = max(k_list)
+    kth_values = np.zeros((boxes.shape[0], max_k))
+    # the impurities of all the scans are the neighbor candidates of every scan, a single index for all of them
+    index = area_bucket_index(boxes, areas, indices, method)
+    for i, path in enumerate(tile_paths):
+        start = time.time()
+        tile_indices = indices[(indices >= tile_starts[i]) & (indices < tile_starts[i + 1])]
+        impurities_chunks = executor.chunks(tile_indices, cost=indices.shape[0] * 5e-8)
+        chunks_out = executor.map(weighted_kth_nn_sweep_chunk, impurities_chunks, boxes, areas, indices, max_k,
+                                  executor.memory_share(memory_cap), method, window, index)
+        for impurities_chunk, chunk_out in zip(impurities_chunks, chunks_out):
+            kth_values[impurities_chunk] = chunk_out
+        end = time.time()
+        print("time mosaic_spatial_scores " + os.path.basename(path) + ": " + str(end - start))
+
+    scores = normalize_spatial_scores(areas, indices, kth_values)
+    tile_scores = {}
+    for i, path in enumerate(tile_paths):
+        tile_scores[path] = dict((k, scores[tile_starts[i]:tile_starts[i + 1], k - 1]) for k in k_list)
+    return tile_scores
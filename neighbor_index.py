@@ -0,0 +1,127 @@
+import numpy as np
+import time
+from utils import impurity_dists, impurity_dists_aligned
+from spatial_index import BoxGrid
+
+
+class NeighborIndex:
+    """
+    The box distances (impurity_dist) between the impurities of a scan, shared by the spatial anomaly detection and
+    the auction pricing of MarketClustering:
+    - the k nearest neighbors of every significant impurity by box distance, stored sparsely with their distances
+      (neighbors[offsets[i]:offsets[i + 1]], sorted by distance), which bound the weighted kth nearest neighbors of
+      --knn_method=index and approximate. They are built on the first use, so the other methods do not build them.
+    - the distances from the impurity the auction currently prices against (the first impurity of a cluster) to all
+      the impurities, only the latest one is kept
+    The distances are calculated by the same kernel everywhere, so they are exactly the ones of impurity_dist.
+    The method "blocked" of the spatial anomaly detection checks all the pairs and does not use the index, and neither
+    do the diameters of the clusters (find_diameter_blocked): the farthest pairs are in none of the neighbors.
+    """
+
+    def __init__(self, imp_boxes, indices, k=50):
+        """
+        :param indices: the indices of the significant impurities, only they are in the neighbors graph
+        """
+        self.boxes = np.asarray(imp_boxes)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.k = max(min(k, self.indices.shape[0] - 1), 0)
+        self.rows = {}
+        self.neighbors = None
+        self.distances = None
+        self.offsets = None
+
+    def __getstate__(self):
+        # the workers of the auction only use the distances, a worker that needs the neighbors builds them again
+        state = self.__dict__.copy()
+        state["neighbors"] = state["distances"] = state["offsets"] = None
+        return state
+
+    def _build_graph(self):
+        if self.offsets is not None:
+            return
+        start = time.time()
+        self.neighbors = np.zeros(self.indices.shape[0] * self.k, dtype=np.int64)
+        self.distances = np.zeros(self.indices.shape[0] * self.k)
+        self.offsets = np.arange(self.indices.shape[0] + 1, dtype=np.int64) * self.k
+        if self.k > 0:
+            self._build_neighbors()
+        end = time.time()
+        print("time NeighborIndex: " + str(end - start))
+
+    def _build_neighbors(self):
+        boxes = self.boxes[self.indices]
+        boxes_per_cell = 4
+        grid = BoxGrid(boxes, boxes_per_cell)
+        # a radius that covers all the impurities
+        max_radius = np.hypot(*(boxes[:, [1, 3]].max(axis=0) - boxes[:, [0, 2]].min(axis=0))) + 1
+        pending = np.arange(self.indices.shape[0])
+        # about k impurities are within this radius of an impurity on average
+        radius = grid.cell_size * np.sqrt(self.k / float(boxes_per_cell))
+        while pending.shape[0] > 0:
+            queries, found = grid.query(boxes[pending], np.full(pending.shape[0], radius))
+            not_self = found != pending[queries]
+            queries, found = queries[not_self], found[not_self]
+            distances = impurity_dists_aligned(boxes[pending[queries]], boxes[found])
+            within = distances <= radius
+            queries, found, distances = queries[within], found[within], distances[within]
+
+            # the k nearest within the radius are the k nearest, farther impurities are out of the radius
+            done = np.bincount(queries, minlength=pending.shape[0]) >= self.k
+            if radius >= max_radius:
+                done[:] = True
+            keep = done[queries]
+            queries, found, distances = queries[keep], found[keep], distances[keep]
+            order = np.lexsort((found, distances, queries))
+            queries, found, distances = queries[order], found[order], distances[order]
+            ranks = np.arange(queries.shape[0]) - np.searchsorted(queries, queries)
+            keep = ranks < self.k
+            positions = self.offsets[pending[queries[keep]]] + ranks[keep]
+            self.neighbors[positions] = self.indices[found[keep]]
+            self.distances[positions] = distances[keep]
+
+            pending = pending[~done]
+            radius *= 2
+
+    def neighbors_of(self, impurity):
+        """
+        The k nearest neighbors of a significant impurity by box distance, and their distances (sorted).
+        """
+        self._build_graph()
+        position = np.searchsorted(self.indices, impurity)
+        return self.neighbors[self.offsets[position]:self.offsets[position + 1]], \
+            self.distances[self.offsets[position]:self.offsets[position + 1]]
+
+    def distances_from(self, impurity):
+        """
+        The box distances from an impurity to all the impurities. Only the distances from the latest impurity are kept
+        (the auction asks for a single impurity before sending the index to the workers), so they do not pile up.
+        """
+        if impurity not in self.rows:
+            self.rows = {impurity: impurity_dists(self.boxes[impurity], self.boxes)}
+        return self.rows[impurity]
+
+    def distance(self, impurity, other):
+        """
+        The box distance between two impurities, from the kept distances when there are ones.
+        """
+        if other in self.rows:
+            return self.rows[other][impurity]
+        if impurity in self.rows:
+            return self.rows[impurity][other]
+        return impurity_dists(self.boxes[impurity], self.boxes[other:other + 1])[0]
+
+    def weighted_kth_nn_bounds(self, imp_area, impurities, max_k, min_dist=0.00001):
+        """
+        Upper bounds on the max_k-th smallest weighted distance of weighted_kth_nn of the impurities: the max_k-th
+        smallest weighted distance to their k nearest neighbors by box distance (inf if k < max_k).
+        """
+        impurities = np.asarray(impurities, dtype=np.int64)
+        self._build_graph()
+        if self.k < max_k or impurities.shape[0] == 0:
+            return np.full(impurities.shape[0], np.inf)
+        positions = np.searchsorted(self.indices, impurities)
+        columns = self.offsets[positions, np.newaxis] + np.arange(self.k)
+        imp_area = np.asarray(imp_area, dtype=float)
+        weights = np.float_power(imp_area[impurities, np.newaxis] / imp_area[self.neighbors[columns]], 4) * \
+            np.maximum(self.distances[columns], min_dist)
+        return np.partition(weights, max_k - 1, axis=1)[:, max_k - 1]
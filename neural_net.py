@@ -6,6 +6,9 @@ from absl import flags, app
 FLAGS = flags.FLAGS
 flags.DEFINE_string("model_name", None, "Path for Autoencoder model without extension")
 flags.DEFINE_boolean("anomaly_blank_label", True, "True if the use of blank labels for anomalous impurity is desired")
+flags.DEFINE_string("crop_archives", None, "Pattern of the crop archives of the training set (written by "
+                                           "--prepare_data), e.g. 'data/rescaled_extended/*', instead of the "
+                                           "directories of PNG files")
 
 
 
@@ -16,6 +19,8 @@ from tensorflow.keras import backend as K
 # from keras.layers.normalization import BatchNormalization
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import TensorBoard
+from crop_archive import archive_training_set
+from glob import glob
 
 
 def conv_autoencoder(input_shape, WIDTH, HEIGHT):
@@ -164,6 +169,32 @@ def fixed_generator_none(generator):
 
 
 
+def archive_iterators(datagen, archive_dirs, anomaly_blank_label, batch_size, train_frac=0.6, val_frac=0.2, seed=0):
+    """
+    The iterators of the training, the validation and the test sets from crop archives (see archive_training_set),
+    split at random as split_to_classes splits the PNG files. With anomaly_blank_label the training and the validation
+    iterators yield (crops, labels) of both classes, as flow_from_directory with class_mode="binary", and otherwise
+    only the normal crops. The test set has both classes.
+    :return: (train_it, val_it, test_it_normal, test_it_anomaly)
+    """
+    crops, labels = archive_training_set(archive_dirs)
+    random = np.random.RandomState(seed).permutation(crops.shape[0])
+    train = random[:int(crops.shape[0] * train_frac)]
+    val = random[-int(crops.shape[0] * val_frac):] if int(crops.shape[0] * val_frac) > 0 else random[:0]
+    test = random[int(crops.shape[0] * train_frac):crops.shape[0] - val.shape[0]]
+
+    def flow(positions):
+        if anomaly_blank_label:
+            return datagen.flow(crops[positions], labels[positions], batch_size=batch_size)
+        positions = positions[labels[positions] == 1]
+        return datagen.flow(crops[positions], batch_size=batch_size)
+
+    test_normal = test[labels[test] == 1]
+    test_anomaly = test[labels[test] == 0]
+    return flow(train), flow(val), datagen.flow(crops[test_normal], batch_size=batch_size), \
+        datagen.flow(crops[test_anomaly], batch_size=batch_size)
+
+
 # Plot the training and validation loss + accuracy
 def plot_training(history):
     import matplotlib.pyplot as plt
@@ -203,7 +234,10 @@ def main(_):
     datagen = ImageDataGenerator(rescale=1. / 255, horizontal_flip=True, vertical_flip=True, rotation_range=360)
     # datagen = ImageDataGenerator()
     # prepare an iterators for each dataset
-    if FLAGS.anomaly_blank_label:
+    if FLAGS.crop_archives is not None:
+        train_it, val_it, test_it_normal, test_it_anomaly = archive_iterators(datagen, glob(FLAGS.crop_archives),
+                                                                              FLAGS.anomaly_blank_label, BATCH_SIZE)
+    elif FLAGS.anomaly_blank_label:
         train_it = datagen.flow_from_directory('data/rescaled_extended_2_classes/train/', target_size=(HEIGHT, WIDTH),
                                                class_mode="binary", batch_size=BATCH_SIZE, color_mode='grayscale')
         val_it = datagen.flow_from_directory('data/rescaled_extended_2_classes/validation/',
@@ -243,11 +277,13 @@ def main(_):
         #                               steps_per_epoch=16, workers=8, use_multiprocessing=True, callbacks=[tbCallBack])
 
 
-    test_it_normal = datagen.flow_from_directory('data/test_rescaled_extended/normal/', target_size=(HEIGHT, WIDTH),
-                                                 class_mode=None, batch_size=BATCH_SIZE, color_mode='grayscale')
+    if FLAGS.crop_archives is None:
+        test_it_normal = datagen.flow_from_directory('data/test_rescaled_extended/normal/', target_size=(HEIGHT, WIDTH),
+                                                     class_mode=None, batch_size=BATCH_SIZE, color_mode='grayscale')
 
-    test_it_anomaly = datagen.flow_from_directory('data/test_rescaled_extended/anomaly/', target_size=(HEIGHT, WIDTH),
-                                                  class_mode=None, batch_size=BATCH_SIZE, color_mode='grayscale')
+        test_it_anomaly = datagen.flow_from_directory('data/test_rescaled_extended/anomaly/',
+                                                      target_size=(HEIGHT, WIDTH), class_mode=None,
+                                                      batch_size=BATCH_SIZE, color_mode='grayscale')
 
     # test_it_combined = datagen.flow_from_directory('data/test_with_2_classes/', target_size=(HEIGHT, WIDTH),
     #                                       class_mode="binary", batch_size=BATCH_SIZE)
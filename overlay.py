@@ -0,0 +1,54 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import os
+    import numpy as np
+    import cv2 as cv
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+
+def score_colors(scores, cmap='jet'):
+    """
+    The RGB colors (uint8) of scores in a colormap, the same as (color[0] * 255, color[1] * 255, color[2] * 255) of
+    color = cmap(score) for every score.
+    """
+    if isinstance(cmap, str):
+        cmap = plt.get_cmap(cmap)
+    return (cmap(np.asarray(scores, dtype=float))[:, :3] * 255).astype(np.uint8)
+
+
+def render_overlay(table, impurities, colors, other_color=None, background=(255, 255, 255)):
+    """
+    Paints the impurities of a scan in their colors on a blank image, from a lookup table of a color per label, with a
+    single lut[labels] instead of painting the pixels of each impurity.
+    :param impurities: the impurities (rows of the table) to paint, a later impurity wins over an earlier one
+    :param colors: the RGB color of each of the impurities (e.g. from score_colors)
+    :param other_color: the color of the other impurities, background if None
+    :return: RGB image of the shape of the scan
+    """
+    lut = np.empty((len(table) + 1, 3), np.uint8)
+    lut[:] = background
+    if other_color is not None:
+        lut[1:] = other_color
+    lut[np.asarray(impurities, dtype=int) + 1] = colors
+    return lut[table.labels() + 1]
+
+
+def write_overlay(path, image, cmap=None, clim=(0, 1), ticks=None):
+    """
+    Writes an RGB overlay as a PNG of the size of the scan. If cmap is given, its colorbar (the only part drawn by
+    matplotlib) is written next to it, as <path without extension>_colorbar.png.
+    """
+    dir_path = os.path.dirname(path)
+    if dir_path != "" and not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    cv.imwrite(path, cv.cvtColor(image, cv.COLOR_RGB2BGR))
+    if cmap is not None:
+        if isinstance(cmap, str):
+            cmap = plt.get_cmap(cmap)
+        fig = plt.figure(figsize=(1.5, 6))
+        ax = fig.add_axes([0.1, 0.05, 0.3, 0.9])
+        matplotlib.colorbar.ColorbarBase(ax, cmap=cmap, norm=matplotlib.colors.Normalize(*clim), ticks=ticks)
+        fig.savefig(os.path.splitext(path)[0] + "_colorbar.png")
+        plt.close(fig)
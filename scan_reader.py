@@ -0,0 +1,229 @@
+import os
+import json
+import shutil
+import struct
+import hashlib
+import numpy as np
+import cv2 as cv
+from extraction_cache import remove_stale_tmp_dirs, remove_replaced_entries
+
+
+# TIFF tags needed for memory-mapping an image
+TIFF_WIDTH = 256
+TIFF_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_PHOTOMETRIC = 262
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_PLANAR_CONFIG = 284
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+
+# TIFF field type -> (struct format, size)
+TIFF_TYPES = {1: ("B", 1), 3: ("H", 2), 4: ("I", 4)}
+
+
+def read_tiff_layout(path):
+    """
+    Parses the first image of a (classic, not Big) TIFF file.
+    :return: (rows, columns, samples per pixel, blocks), where blocks are the (row, column, offset in the file, rows,
+             columns) of the strips or tiles of the image, or None if the image is not uncompressed 8-bit gray or RGB
+             (such images can not be memory-mapped)
+    """
+    with open(path, "rb") as tiff_file:
+        header = tiff_file.read(8)
+        if header[:4] == b"II*\x00":
+            order = "<"
+        elif header[:4] == b"MM\x00*":
+            order = ">"
+        else:
+            return None
+        tiff_file.seek(struct.unpack(order + "I", header[4:8])[0])
+        entries_num = struct.unpack(order + "H", tiff_file.read(2))[0]
+        entries = tiff_file.read(12 * entries_num)
+
+        tags = {}
+        for i in range(entries_num):
+            tag, field_type, count = struct.unpack(order + "HHI", entries[12 * i:12 * i + 8])
+            if field_type not in TIFF_TYPES:
+                continue
+            fmt, size = TIFF_TYPES[field_type]
+            if count * size <= 4:
+                data = entries[12 * i + 8:12 * i + 8 + count * size]
+            else:
+                position = tiff_file.tell()
+                tiff_file.seek(struct.unpack(order + "I", entries[12 * i + 8:12 * i + 12])[0])
+                data = tiff_file.read(count * size)
+                tiff_file.seek(position)
+            tags[tag] = struct.unpack(order + fmt * count, data)
+
+    samples = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+    if tags.get(TIFF_COMPRESSION, (1,))[0] != 1 or set(tags.get(TIFF_BITS_PER_SAMPLE, (1,))) != {8} \
+            or tags.get(TIFF_PLANAR_CONFIG, (1,))[0] != 1 or (samples, tags.get(TIFF_PHOTOMETRIC, (None,))[0]) \
+            not in ((1, 1), (3, 2)):
+        return None
+    rows, cols = tags[TIFF_LENGTH][0], tags[TIFF_WIDTH][0]
+
+    blocks = []
+    if TIFF_TILE_OFFSETS in tags:
+        tile_rows, tile_cols = tags[TIFF_TILE_LENGTH][0], tags[TIFF_TILE_WIDTH][0]
+        tiles_across = (cols + tile_cols - 1) // tile_cols
+        for i, offset in enumerate(tags[TIFF_TILE_OFFSETS]):
+            blocks.append((i // tiles_across * tile_rows, i % tiles_across * tile_cols, offset, tile_rows, tile_cols))
+    elif TIFF_STRIP_OFFSETS in tags:
+        strip_rows = min(tags.get(TIFF_ROWS_PER_STRIP, (rows,))[0], rows)
+        for i, offset in enumerate(tags[TIFF_STRIP_OFFSETS]):
+            blocks.append((i * strip_rows, 0, offset, min(strip_rows, rows - i * strip_rows), cols))
+        # strips that follow each other in the file are a single block
+        strip_size = strip_rows * cols * samples
+        if all(blocks[i][2] == blocks[0][2] + i * strip_size for i in range(len(blocks))):
+            blocks = [(0, 0, blocks[0][2], rows, cols)]
+    else:
+        return None
+    return rows, cols, samples, blocks
+
+
+class ScanReader:
+    """
+    Reads regions of a scan on demand, without loading the whole scan into memory.
+    Uncompressed 8-bit TIFF scans (strips or tiles) are memory-mapped as they are. Other scans (compressed TIFF, PNG)
+    are decoded once; with a spool_dir the decoded scan is written there as .npy and memory-mapped from then on. The
+    spooled copy of an older version of the scan (another size or modification time) is removed when it is replaced.
+    The inversion (of scans with a black background) and the conversion to BGR or to grayscale are applied to each
+    region when it is read, so a region of a gray scan that needs neither is a view of the memory-map (zero-copy).
+    The regions are the same as the regions of cv.imread(path) (or cv.imread(path, 0) if gray, up to the rounding of
+    the grayscale conversion of color scans), inverted if invert.
+    """
+
+    def __init__(self, path, invert=False, gray=False, spool_dir=None):
+        self.path = path
+        self.invert = invert
+        self.gray = gray
+        self.spool_dir = spool_dir
+        self._open()
+
+    def _open(self):
+        self.blocks = None
+        self.source = None
+        layout = read_tiff_layout(self.path) if os.path.splitext(self.path)[1].lower() in (".tif", ".tiff") else None
+        if layout is not None:
+            rows, cols, self.samples, blocks = layout
+            self.blocks = [(r, c, np.memmap(self.path, dtype=np.uint8, mode="r", offset=offset,
+                                            shape=(block_rows, block_cols, self.samples)))
+                           for r, c, offset, block_rows, block_cols in blocks]
+        else:
+            self.source = self._decode()
+            rows, cols = self.source.shape[:2]
+            self.samples = 1 if self.source.ndim == 2 else 3
+        self.shape = (rows, cols) if self.gray else (rows, cols, 3)
+
+    def _decode(self):
+        """
+        Decodes the scan (as gray if it is gray, BGR otherwise), through the spool if there is one.
+        """
+        spool_path = None
+        if self.spool_dir is not None:
+            stat = os.stat(self.path)
+            version = "{}:{}".format(stat.st_size, stat.st_mtime)
+            key = hashlib.sha1((os.path.abspath(self.path) + ":" + version).encode()).hexdigest()
+            entry_dir = os.path.join(self.spool_dir, key)
+            spool_path = os.path.join(entry_dir, "scan.npy")
+            # scan.json is written last, an entry without it is not complete
+            if os.path.exists(os.path.join(entry_dir, "scan.json")):
+                return np.load(spool_path, mmap_mode="r")
+
+        source = cv.imread(self.path, cv.IMREAD_UNCHANGED)
+        if source is None:
+            raise IOError("can not read the scan " + self.path)
+        if source.dtype != np.uint8 or (source.ndim == 3 and source.shape[2] != 3):
+            source = cv.imread(self.path)
+        if source.ndim == 3 and source.shape[2] == 1:
+            source = source[:, :, 0]
+
+        if spool_path is not None:
+            # as the entries of the extraction cache, the same eviction of older versions and interrupted runs
+            remove_stale_tmp_dirs(self.spool_dir)
+            remove_replaced_entries(self.spool_dir, self.path, version, "scan.json", "version")
+            tmp_dir = entry_dir + ".tmp" + str(os.getpid())
+            os.makedirs(tmp_dir)
+            np.save(os.path.join(tmp_dir, "scan.npy"), source)
+            with open(os.path.join(tmp_dir, "scan.json"), "w") as json_file:
+                json.dump({"img_path": os.path.abspath(self.path), "version": version}, json_file)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+            del source
+            return np.load(spool_path, mmap_mode="r")
+        return source
+
+    def __getstate__(self):
+        # the memory-maps are opened again after unpickling (e.g. in ray workers) instead of copying the scan
+        state = {"path": self.path, "invert": self.invert, "gray": self.gray, "spool_dir": self.spool_dir}
+        if self.source is not None and not isinstance(self.source, np.memmap):
+            state["source"] = self.source
+        return state
+
+    def __setstate__(self, state):
+        source = state.pop("source", None)
+        self.__dict__.update(state)
+        if source is None:
+            self._open()
+        else:
+            self.blocks = None
+            self.source = source
+            self.samples = 1 if source.ndim == 2 else 3
+            self.shape = source.shape[:2] if self.gray else source.shape[:2] + (3,)
+
+    def _raw_region(self, rows, cols):
+        """
+        The region as stored in the scan, gray (2D) or BGR.
+        """
+        r0, r1 = rows
+        c0, c1 = cols
+        if self.source is not None:
+            return self.source[r0:r1, c0:c1]
+        for r, c, block in self.blocks:
+            if r <= r0 and r1 <= r + block.shape[0] and c <= c0 and c1 <= c + block.shape[1]:
+                region = block[r0 - r:r1 - r, c0 - c:c1 - c]
+                break
+        else:
+            # the region spans several strips or tiles
+            region = np.empty((r1 - r0, c1 - c0, self.samples), dtype=np.uint8)
+            for r, c, block in self.blocks:
+                br0, br1 = max(r0, r), min(r1, r + block.shape[0])
+                bc0, bc1 = max(c0, c), min(c1, c + block.shape[1])
+                if br0 < br1 and bc0 < bc1:
+                    region[br0 - r0:br1 - r0, bc0 - c0:bc1 - c0] = block[br0 - r:br1 - r, bc0 - c:bc1 - c]
+        if self.samples == 1:
+            return region[:, :, 0]
+        # TIFF stores RGB, OpenCV works with BGR
+        return cv.cvtColor(np.ascontiguousarray(region), cv.COLOR_RGB2BGR)
+
+    def region(self, rows, cols):
+        """
+        The region [rows[0]:rows[1], cols[0]:cols[1]] of the scan.
+        """
+        region = self._raw_region(rows, cols)
+        if self.invert:
+            region = 255 - region
+        if self.gray and region.ndim == 3:
+            region = cv.cvtColor(np.ascontiguousarray(region), cv.COLOR_BGR2GRAY)
+        elif not self.gray and region.ndim == 2:
+            region = cv.cvtColor(np.ascontiguousarray(region), cv.COLOR_GRAY2BGR)
+        return region
+
+    def __getitem__(self, key):
+        """
+        reader[r0:r1, c0:c1] is reader.region((r0, r1), (c0, c1)).
+        """
+        rows, cols = key
+        return self.region(rows.indices(self.shape[0])[:2], cols.indices(self.shape[1])[:2])
+
+    def read(self):
+        """
+        The whole scan, the same as cv.imread (and inverted if invert).
+        """
+        return np.ascontiguousarray(self.region((0, self.shape[0]), (0, self.shape[1])))
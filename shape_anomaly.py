@@ -5,56 +5,220 @@ with warnings.catch_warnings():
     import numpy as np
     import matplotlib.pyplot as plt
     import matplotlib
-    from smallestenclosingcircle import make_circle
-
-
-def get_circle_impurity_score(markers, imp_boxes, areas, indices):
-    scores = np.full(imp_boxes.shape[0], np.infty)
-    for impurity in indices:
-        impurity_shape = np.argwhere(markers == impurity + 2)
-        circle = make_circle(impurity_shape)
-        circle_area = np.pi * circle[2] ** 2
-        scores[impurity] = (circle_area - areas[impurity]) / circle_area
+    import cv2 as cv
+    import time
+    from scipy.stats import spearmanr
+    from enclosing_circle import min_enclosing_circles
+    from executor import Executor
+    from overlay import score_colors, render_overlay, write_overlay
+
+
+def get_circle_impurity_score(table, seed=0, executor=None):
+    """
+    The circle score of every significant impurity: the share of its minimum enclosing circle that it does not cover.
+    :param seed: the seed of the random order in which the minimum enclosing circles are built
+    :param executor: the Executor that calculates the chunks of the circles, serial if None
+    """
+    scores = np.full(len(table), np.infty)
+    indices = np.asarray(table.indices, dtype=int)
+    circle_area = np.pi * min_enclosing_circles(table, indices, seed, executor) ** 2
+    scores[indices] = (circle_area - table.areas[indices]) / circle_area
     return scores
 
 
-def color_close_to_cirlce(img, markers, indices, scores, areas, save_dir_path):
-    blank_image = np.zeros(img.shape, np.uint8)
-    blank_image[:, :] = (255, 255, 255)
-    jet = plt.get_cmap('jet')
-
-    num_under_thresh = 0
-
-    for impurity in indices:
-
-        # show only under threshold:
-        # if scores[impurity] <= 0.3 and areas[impurity] > 50:
-        if areas[impurity] > 50:
-            num_under_thresh += 1
-            color = jet(scores[impurity])
-            blank_image[markers == impurity + 2] = (color[0] * 255, color[1] * 255, color[2] * 255)
-        else:
-            blank_image[markers == impurity + 2] = (0, 0, 0)
+descriptor_names = ["circle_deficit", "solidity", "convexity_defect", "eccentricity",
+                    "hu1", "hu2", "hu3", "hu4", "hu5", "hu6", "hu7"]
+
+
+def impurity_moments(table, impurities):
+    """
+    The central moments mu_pq (p + q <= 3, x is the column and y the row) of the pixels of the impurities, for all of
+    them in a single pass over their pixels, the same as cv.moments of the mask of each impurity.
+    :return: dictionary (p, q) -> array of the moments of the impurities
+    """
+    pixels, owners = table.impurities_pixels(impurities)
+    rows, cols = np.divmod(pixels, table.image_shape[1])
+    counts = np.bincount(owners, minlength=len(impurities)).astype(float)
+    dx = cols - (np.bincount(owners, cols, minlength=len(impurities)) / counts)[owners]
+    dy = rows - (np.bincount(owners, rows, minlength=len(impurities)) / counts)[owners]
+    dx2 = dx * dx
+    dy2 = dy * dy
+    dxy = dx * dy
+    moments = {(0, 0): counts}
+    for pq, weights in [((2, 0), dx2), ((1, 1), dxy), ((0, 2), dy2), ((3, 0), dx2 * dx), ((2, 1), dx2 * dy),
+                        ((1, 2), dxy * dy), ((0, 3), dy2 * dy)]:
+        moments[pq] = np.bincount(owners, weights, minlength=len(impurities))
+    return moments
+
+
+def hu_moments(moments):
+    """
+    The 7 Hu invariants of the moments of impurity_moments, the same as cv.HuMoments.
+    :return: (number of impurities, 7) array
+    """
+    m00 = moments[(0, 0)]
+    n = dict((pq, moments[pq] / m00 ** (1 + sum(pq) / 2.0)) for pq in moments if pq != (0, 0))
+    n20, n11, n02 = n[(2, 0)], n[(1, 1)], n[(0, 2)]
+    n30, n21, n12, n03 = n[(3, 0)], n[(2, 1)], n[(1, 2)], n[(0, 3)]
+    a = n30 + n12
+    b = n21 + n03
+    return np.stack((n20 + n02,
+                     (n20 - n02) ** 2 + 4 * n11 ** 2,
+                     (n30 - 3 * n12) ** 2 + (3 * n21 - n03) ** 2,
+                     a ** 2 + b ** 2,
+                     (n30 - 3 * n12) * a * (a ** 2 - 3 * b ** 2) + (3 * n21 - n03) * b * (3 * a ** 2 - b ** 2),
+                     (n20 - n02) * (a ** 2 - b ** 2) + 4 * n11 * a * b,
+                     (3 * n21 - n03) * a * (a ** 2 - 3 * b ** 2) - (n30 - 3 * n12) * b * (3 * a ** 2 - b ** 2)),
+                    axis=1)
+
+
+def contour_descriptors_chunk(positions_chunk, table, impurities):
+    """
+    The solidity (the area of the outer contour of an impurity over the area of its convex hull) and the depth of the
+    deepest convexity defect (the farthest contour point from its hull edge, over the square root of the area) of a
+    chunk of the impurities.
+    :return: (number of impurities in the chunk, 2) array
+    """
+    out = np.zeros((len(positions_chunk), 2))
+    out[:, 0] = 1
+    for i, position in enumerate(positions_chunk):
+        impurity = impurities[position]
+        rows, cols = np.divmod(np.asarray(table.impurity_pixels(impurity)), table.image_shape[1])
+        mask = np.zeros((rows.max() - rows.min() + 3, cols.max() - cols.min() + 3), np.uint8)
+        mask[rows - rows.min() + 1, cols - cols.min() + 1] = 1
+        contours = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)[-2]
+        contour = max(contours, key=len).reshape(-1, 2)
+        if contour.shape[0] < 3:
+            continue
+        hull = np.sort(cv.convexHull(contour, returnPoints=False).ravel())
+        hull_area = cv.contourArea(contour[hull])
+        if hull_area > 0:
+            out[i, 0] = cv.contourArea(contour) / hull_area
+        # every contour point between two successive hull vertices is measured from their edge
+        edges = np.searchsorted(hull, np.arange(contour.shape[0]), side='right') - 1
+        a = contour[hull[edges % hull.shape[0]]].astype(float)
+        b = contour[hull[(edges + 1) % hull.shape[0]]].astype(float)
+        lengths = np.hypot(*(b - a).T)
+        cross = np.abs((b[:, 0] - a[:, 0]) * (contour[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (contour[:, 0] - a[:, 0]))
+        depths = np.where(lengths > 0, cross / np.where(lengths > 0, lengths, 1), 0)
+        out[i, 1] = depths.max() / np.sqrt(table.areas[impurity])
+    return out
+
+
+def shape_descriptors(table, impurities=None, seed=0, executor=None):
+    """
+    The classic shape descriptors of the impurities (see descriptor_names): the circle deficit of
+    get_circle_impurity_score, the solidity and the convexity defect of contour_descriptors_chunk, the eccentricity
+    of the ellipse of the same second moments, and the Hu invariants (-log10 of their absolute values).
+    :param impurities: the impurities (rows of the table), the significant impurities if None
+    :param seed: the seed of the minimum enclosing circles
+    :param executor: the Executor that runs the chunks of the impurities, serial if None
+    :return: (number of impurities, number of descriptors) array
+    """
+    start = time.time()
+    if executor is None:
+        executor = Executor()
+    if impurities is None:
+        impurities = table.indices
+    impurities = np.asarray(impurities, dtype=int)
+    descriptors = np.zeros((impurities.shape[0], len(descriptor_names)))
+
+    circle_area = np.pi * min_enclosing_circles(table, impurities, seed, executor) ** 2
+    areas = table.areas[impurities]
+    descriptors[:, 0] = np.where(circle_area > 0, (circle_area - areas) / np.where(circle_area > 0, circle_area, 1), 0)
+
+    # findContours, about 50 microseconds per impurity
+    positions_chunks = executor.chunks(np.arange(impurities.shape[0]), cost=0.00005)
+    descriptors[:, 1:3] = np.concatenate([np.zeros((0, 2))] + executor.map(contour_descriptors_chunk,
+                                                                            positions_chunks, table, impurities))
+
+    moments = impurity_moments(table, impurities)
+    mu20, mu11, mu02 = moments[(2, 0)], moments[(1, 1)], moments[(0, 2)]
+    spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+    major = (mu20 + mu02) / 2 + spread
+    minor = (mu20 + mu02) / 2 - spread
+    descriptors[:, 3] = np.sqrt(np.clip(1 - minor / np.where(major > 0, major, 1), 0, 1))
+    descriptors[:, 4:] = -np.log10(np.maximum(np.abs(hu_moments(moments)), 1e-30))
+    end = time.time()
+    print("time shape_descriptors: " + str(end - start))
+    return descriptors
+
+
+def descriptor_shape_scores(table, seed=0, executor=None):
+    """
+    The shape anomaly of the significant impurities from their shape_descriptors, without the autoencoder: the root
+    mean square of the robust z-scores (by the median and the median absolute deviation over the scan) of their
+    descriptors.
+    :return: (scores, descriptors) - scores of all the impurities (infinity for the insignificant ones, as the loss of
+             predict_crops) and the descriptors of the significant ones
+    """
+    indices = np.asarray(table.indices, dtype=int)
+    descriptors = shape_descriptors(table, indices, seed, executor)
+    median = np.median(descriptors, axis=0)
+    mad = 1.4826 * np.median(np.abs(descriptors - median), axis=0)
+    z = (descriptors - median) / np.where(mad > 0, mad, 1)
+    scores = np.full(len(table), np.infty)
+    scores[indices] = np.sqrt(np.mean(z ** 2, axis=1))
+    return scores, descriptors
+
+
+def shape_calibration_report(scores, ae_scores, indices, descriptors=None, top=100, name=""):
+    """
+    Reports how the descriptor shape scores agree with the shape scores of the autoencoder, over the impurities that
+    have both: the spearman rank correlation of the scores (and of every descriptor, if given) with the autoencoder
+    scores, and the share of the top (most anomalous) impurities of the autoencoder that are in the top of the
+    descriptor scores.
+    :param descriptors: the descriptors of the impurities in indices, as returned by descriptor_shape_scores
+    :return: dictionary of the above
+    """
+    indices = np.asarray(indices, dtype=int)
+    both = np.isfinite(scores[indices]) & np.isfinite(ae_scores[indices])
+    scores = scores[indices][both]
+    ae_scores = ae_scores[indices][both]
+    top = min(top, scores.shape[0])
+    scores_top = np.argsort(-scores, kind='stable')[:top]
+    ae_top = np.argsort(-ae_scores, kind='stable')[:top]
+    report = {"impurities": scores.shape[0],
+              "rank_correlation": spearmanr(scores, ae_scores).correlation,
+              "top_overlap": np.intersect1d(scores_top, ae_top).shape[0] / float(max(top, 1))}
+    print("shape calibration {}: rank correlation with the autoencoder {:.4f}, top {} overlap {:.1%} ({} impurities)"
+          .format(name, report["rank_correlation"], top, report["top_overlap"], report["impurities"]))
+    if descriptors is not None:
+        report["descriptors"] = {}
+        for j, descriptor_name in enumerate(descriptor_names):
+            report["descriptors"][descriptor_name] = spearmanr(descriptors[both, j], ae_scores).correlation
+            print("    {}: rank correlation {:.4f}".format(descriptor_name, report["descriptors"][descriptor_name]))
+    return report
+
+
+def color_close_to_cirlce(img, table, scores, save_dir_path):
+    areas = table.areas
+    indices = np.asarray(table.indices, dtype=int)
+
+    # show only under threshold:
+    # indices = indices[(scores[indices] <= 0.3) & (areas[indices] > 50)]
+    colored = indices[areas[indices] > 50]
+    num_under_thresh = colored.shape[0]
+    # the other significant impurities are black
+    blank_image = render_overlay(table, np.concatenate((indices, colored)),
+                                 np.concatenate((np.zeros((indices.shape[0], 3), np.uint8),
+                                                 score_colors(scores[colored]))))
     print("under threshold: {}".format(num_under_thresh))
 
-    figure = plt.figure("Colored Circles")
+    plt.figure("Colored Circles")
     plt.imshow(blank_image, cmap='jet')
     plt.colorbar()
     plt.clim(0, 1)
     plt.title("The color is determined by " + r"$\frac{(S(circle) - S(impurity))}{S(circle)}$" + " , where circle is the minimal circle "
                                                                              "that covers the impurity")
-    if not os.path.exists(save_dir_path):
-        os.makedirs(save_dir_path)
-    # matplotlib.rcParams.update({'font.size': 100})
-    figure.set_size_inches(120, 80)
-    plt.savefig(save_dir_path + "/" + "circle_area_diff.png")
+    write_overlay(save_dir_path + "/" + "circle_area_diff.png", blank_image, cmap='jet')
 
     plt.show()
 
 
-def color_circle_diff_all_impurities(img, markers, imp_boxes, areas, indices, save_dir_path):
-    scores = get_circle_impurity_score(markers, imp_boxes, areas, indices)
-    indx = np.argwhere(areas>50)
+def color_circle_diff_all_impurities(img, table, save_dir_path):
+    scores = get_circle_impurity_score(table)
+    indx = np.argwhere(table.areas>50)
     # scores = np.minimum(scores, 1e6)
     # scores = np.maximum(scores, 1e-5)
     # normalized_scores = (scores - np.min(scores)) / np.ptp(scores)
@@ -64,18 +228,12 @@ def color_circle_diff_all_impurities(img, markers, imp_boxes, areas, indices, sa
     plt.hist(scores[indx], bins=refined_bins)
     plt.title("circle diff")
     plt.savefig(save_dir_path + "/circle_differences.png" , dpi=fig.dpi)
-    color_close_to_cirlce(img, markers, indices, scores, areas, save_dir_path)
-
+    color_close_to_cirlce(img, table, scores, save_dir_path)
 
-def color_shape_anomaly(img, markers, indices, scores, imp_boxes):
-    blank_image = np.zeros(img.shape, np.uint8)
-    blank_image[:, :] = (255, 255, 255)
 
-    jet = plt.get_cmap('jet')
-
-    for impurity in indices:
-        color = jet(scores[impurity])
-        blank_image[markers == impurity + 2] = (color[0] * 255, color[1] * 255, color[2] * 255)
+def color_shape_anomaly(img, table, scores):
+    indices = np.asarray(table.indices, dtype=int)
+    blank_image = render_overlay(table, indices, score_colors(np.asarray(scores)[indices]))
 
     plt.figure("Colored shape anomaly")
     plt.imshow(blank_image, cmap='jet')
@@ -83,5 +241,5 @@ def color_shape_anomaly(img, markers, indices, scores, imp_boxes):
     plt.clim(0, 1)
     plt.title("The color is determined by the neural network")
 
-    plt.show()
-    plt.savefig('colored_shape_anomaly.png')
\ No newline at end of file
+    write_overlay('colored_shape_anomaly.png', blank_image, cmap='jet')
+    plt.show()
\ No newline at end of file
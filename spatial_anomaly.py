@@ -3,164 +3,258 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=FutureWarning)
     # import os
     import numpy as np
-    import cv2 as cv
     import matplotlib.pyplot as plt
-    import scipy.spatial.distance as dist
-    from utils import num_threads, impurity_dist
-    import ray
+    from scipy.stats import spearmanr
+    from utils import impurity_dists_pairs
+    from spatial_index import AreaBucketIndex
+    from overlay import score_colors, render_overlay
+    from executor import Executor
     import time
 
 
-@ray.remote
-def weighted_kth_nn_single(imp_boxes, k_list, imp_area, indices, impurities_chunks):
+def weighted_distances_block(imp_boxes, imp_area, others_boxes, others_area, block, self_columns, min_dist):
+    """
+    The weighted distances (imp_area[impurity] / imp_area[x]) ** 4 * max(impurity_dist(impurity, x), min_dist) from
+    each impurity of the block to the others, inf to the impurity itself (at self_columns).
+    """
+    # float_power calculates each element with pow, exactly as the scalar ** (the array ** may differ in the last bit)
+    k_nn = np.float_power(imp_area[block, np.newaxis] / others_area[np.newaxis, :], 4) * \
+        np.maximum(impurity_dists_pairs(imp_boxes[block], others_boxes), min_dist)
+    # an impurity is not its own neighbor
+    k_nn[np.arange(block.shape[0]), self_columns] = np.inf
+    return k_nn
+
+
+def weighted_kth_nn_blocked(imp_boxes, imp_area, indices, impurities, k_list, min_dist=0.00001,
+                            memory_cap=2 ** 28):
+    """
+    Calculates the weighted kth nearest neighbor score of each impurity in impurities, for every k in k_list:
+    imp_area[impurity] * kth ** 2, where kth is the k-th smallest weighted distance
+    (imp_area[impurity] / imp_area[x]) ** 4 * max(impurity_dist(impurity, x), min_dist) to the other impurities x in
+    indices.
+    The weighted distances are calculated for blocks of impurities, so that the arrays of a block take at most
+    memory_cap bytes, and all the k are selected from a single np.partition of each block.
+    :param indices: the sorted indices of the neighbor candidates, impurities is a subset of them
+    :return: dictionary k -> the scores of the impurities
+    """
+    indices = np.asarray(indices)
+    impurities = np.asarray(impurities, dtype=int)
     impurity_neighbors_and_area = {}
-
-    # weighted kth nn calculation
     for k in k_list:
-        impurity_neighbors_and_area[k] = np.zeros(len(impurities_chunks))
-
-    for i in range(len(impurities_chunks)):
-        impurity = impurities_chunks[i]
-        k_nn = [(imp_area[impurity] / imp_area[x]) ** 4 *
-                np.maximum(impurity_dist(imp_boxes[impurity], imp_boxes[x]), 0.00001)
-                for x in indices if x != impurity]
-        # k_nn = [(imp_area[impurity] ** 6 + imp_area[x] ** 6) *
-        #         np.maximum(impurity_dist(imp_boxes[impurity], imp_boxes[x]), 0.00001)
-        #         for x in indices if x != impurity]
-        # k_nn = [
-        #         np.maximum(impurity_dist(imp_boxes[impurity], imp_boxes[x]), 0.00001)
-        #         for x in indices if x != impurity]
-        k_nn.sort()
+        impurity_neighbors_and_area[k] = np.zeros(impurities.shape[0])
+    kths = sorted(set(k - 1 for k in k_list))
+
+    others_boxes = imp_boxes[indices]
+    others_area = imp_area[indices]
+    self_columns = np.searchsorted(indices, impurities)
+    # about 6 float arrays of the size of the block are alive at a time (gaps, distances and weights)
+    block_size = max(1, int(memory_cap // (6 * 8 * max(indices.shape[0], 1))))
+    for block_start in range(0, impurities.shape[0], block_size):
+        block = impurities[block_start:block_start + block_size]
+        k_nn = weighted_distances_block(imp_boxes, imp_area, others_boxes, others_area, block,
+                                        self_columns[block_start:block_start + block_size], min_dist)
+        k_nn = np.partition(k_nn, kths, axis=1)
 
         for k in k_list:
-            # print("i: "+str(i))
-            # print("impurity: " + str(impurity))
-            impurity_neighbors_and_area[k][i] = imp_area[impurity] * k_nn[k - 1] ** 2
-            # impurity_neighbors_and_area[k][i] = k_nn[k - 1] ** 2
+            impurity_neighbors_and_area[k][block_start:block_start + block.shape[0]] = \
+                imp_area[block] * np.float_power(k_nn[:, k - 1], 2)
     return impurity_neighbors_and_area
 
 
-def weighted_kth_nn(imp_boxes, img, markers, k_list, imp_area, indices, need_plot=False):
-    # data structure that holds for each impurity it's k nearest neighbor
-    # it looks like this: first index: the k nearest neighbor (corresponding to k_list), second index is the impurity.
-    start = time.time()
+def weighted_kth_nn_indexed(imp_boxes, imp_area, indices, impurities, k_list, min_dist=0.00001, bounds=None,
+                            index=None):
+    """
+    Calculates the same scores as weighted_kth_nn_blocked, finding the k-th weighted nearest neighbors through an
+    AreaBucketIndex, which checks only the impurities near enough to be one of them. For dense scans with many
+    impurities.
+    :param bounds: upper bounds on the max(k_list)-th weighted distances of the impurities, if known (see
+                   NeighborIndex.weighted_kth_nn_bounds)
+    :param index: the AreaBucketIndex of the impurities in indices (see area_bucket_index), built here if None
+    :return: dictionary k -> the scores of the impurities
+    """
     impurity_neighbors_and_area = {}
-
     for k in k_list:
-        impurity_neighbors_and_area[k] = np.zeros(imp_boxes.shape[0])
-
-    # weighted kth nn calculation
-    impurities_chunks = np.array_split(indices, num_threads)
-
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(weighted_kth_nn_single.remote(imp_boxes, k_list, imp_area, indices, impurities_chunks[i]))
-    for i in range(num_threads):
-        task_out = ray.get(tasks[i])
-        for k in k_list:
-            impurity_neighbors_and_area[k][impurities_chunks[i]] = task_out[k][:]
-    end = time.time()
-    print("time weighted_kth_nn parallel: " + str(end - start))
-
+        impurity_neighbors_and_area[k] = np.zeros(len(impurities))
+    if len(impurities) == 0:
+        return impurity_neighbors_and_area
+
+    impurities = np.asarray(impurities, dtype=int)
+    if index is None:
+        index = AreaBucketIndex(imp_boxes, imp_area, indices, min_dist)
+    k_nn = index.kth_nn(impurities, k_list, bounds=bounds)
     for k in k_list:
-        data = impurity_neighbors_and_area[k][indices]
-        data[data == 0] = 0.00001
-        impurity_neighbors_and_area[k][indices] = np.log(data)
-        # impurity_neighbors_and_area[k][indices] = np.maximum(np.log(impurity_neighbors_and_area[k][indices]), 0.00001)
-
-        scores = impurity_neighbors_and_area[k][indices]
-        scores = (scores - np.min(scores)) / np.ptp(scores)
-        scores = np.maximum(scores - 2 * np.std(scores), 0.00001)
-
-        impurity_neighbors_and_area[k][indices] = (scores - np.min(scores)) / np.ptp(scores)
-
-        # uncomment to see histogram (hope for normal distribution)
-        # plt.figure(k)
-        # plt.hist(impurity_neighbors_and_area[k][indices])
-
-        max_val2 = max(impurity_neighbors_and_area[k])
-        impurity_neighbors_and_area[k] = list(map(lambda x: x / max_val2, impurity_neighbors_and_area[k]))
-
-    if need_plot:
-        blank_image2 = {}
-
-        for k in k_list:
-            blank_image2[k] = np.zeros(img.shape, np.uint8)
-            blank_image2[k][:, :] = (255, 255, 255)
-        jet = plt.get_cmap('jet')
-        for impurity in indices:
-            for k in k_list:
-                score = impurity_neighbors_and_area[k][impurity]
-                color = jet(score)
-                blank_image2[k][markers == impurity + 2] = (color[0] * 255, color[1] * 255, color[2] * 255)
-
-        for i in range(len(k_list)):
-            plt.figure(i)
-            plt.imshow(blank_image2[k_list[i]], cmap='jet')
-            plt.colorbar()
-            plt.clim(0, 1)
-            plt.title("the kthNN is taken from" + r"$imp$" + " , when the distance to each other impurity" + r"$oth$" +
-                      "is calculated in the following manner: " + r"$\log ((\frac{S(imp)}{S(oth)})^2 * box-dist(imp, oth))$"
-                      + ", with k = {}".format(k_list[i]))
-
-        plt.show()
-
+        impurity_neighbors_and_area[k] = imp_area[impurities] * np.float_power(k_nn[k], 2)
     return impurity_neighbors_and_area
 
 
-def weighted_kth_nn_not_parallel(imp_boxes, img, markers, k_list, imp_area, indices, need_plot=False):
-    # data structure that holds for each impurity it's k nearest neighbor
-    # it looks like this: first index: the k nearest neighbor (corresponding to k_list), second index is the impurity.
-
+def weighted_kth_nn_approximate(imp_boxes, imp_area, indices, impurities, k_list, min_dist=0.00001, window=2,
+                                bounds=None, index=None):
+    """
+    Approximates the scores of weighted_kth_nn_blocked in near-linear time: the k-th weighted nearest neighbors are
+    searched only within window cells of the grid of every area bucket of an AreaBucketIndex. The approximate scores
+    are upper bounds on the exact ones, and the impurities out of the window give lower bounds. Impurities with less
+    than k neighbors in the window are calculated exactly.
+    :param index: the AreaBucketIndex of the impurities in indices (see area_bucket_index), built here if None
+    :return: (scores, lower) - dictionaries k -> the approximate scores of the impurities, and lower bounds on their
+             exact scores
+    """
     impurity_neighbors_and_area = {}
-
-    # weighted kth nn calculation
+    lower_bounds = {}
     for k in k_list:
-        impurity_neighbors_and_area[k] = np.zeros(imp_boxes.shape[0])
-
-    for impurity in indices:
-        k_nn = [(imp_area[impurity] / imp_area[x]) ** 4 * impurity_dist(imp_boxes[impurity], imp_boxes[x])
-                for x in indices if x != impurity]
-        # k_nn = [impurity_dist(imp_boxes[impurity], imp_boxes[x]) for x in indices if x != impurity]
-        k_nn.sort()
-
+        impurity_neighbors_and_area[k] = np.zeros(len(impurities))
+        lower_bounds[k] = np.zeros(len(impurities))
+    if len(impurities) == 0:
+        return impurity_neighbors_and_area, lower_bounds
+
+    impurities = np.asarray(impurities, dtype=int)
+    if index is None:
+        index = AreaBucketIndex(imp_boxes, imp_area, indices, min_dist)
+    k_nn, k_nn_lower = index.kth_nn(impurities, k_list, window=window, bounds=bounds)
+    missing = np.flatnonzero(~np.isfinite(k_nn[max(k_list)]))
+    if missing.shape[0] > 0:
+        k_nn_missing = index.kth_nn(impurities[missing], k_list,
+                                    bounds=bounds[missing] if bounds is not None else None)
         for k in k_list:
-            impurity_neighbors_and_area[k][impurity] = imp_area[impurity] * k_nn[k - 1] ** 2
-            # impurity_neighbors_and_area[k][impurity] = k_nn[k - 1] ** 2
-    print("finished calculating ktn_nn")
-
+            k_nn[k][missing] = k_nn_missing[k]
+            k_nn_lower[k][missing] = k_nn_missing[k]
     for k in k_list:
-        impurity_neighbors_and_area[k][indices] = np.maximum(np.log(impurity_neighbors_and_area[k][indices]), 0.00001)
-
-        scores = impurity_neighbors_and_area[k][indices]
-        scores = (scores - np.min(scores)) / np.ptp(scores)
-        scores = np.maximum(scores - 2 * np.std(scores), 0.00001)
-
-        impurity_neighbors_and_area[k][indices] = (scores - np.min(scores)) / np.ptp(scores)
-
-        if need_plot:
-            plt.figure(k)
-            plt.hist(impurity_neighbors_and_area[k][indices])
+        impurity_neighbors_and_area[k] = imp_area[impurities] * np.float_power(k_nn[k], 2)
+        lower_bounds[k] = imp_area[impurities] * np.float_power(k_nn_lower[k], 2)
+    return impurity_neighbors_and_area, lower_bounds
+
+
+def weighted_kth_nn_scores(imp_boxes, imp_area, indices, impurities, k_list, min_dist=0.00001, memory_cap=2 ** 28,
+                           method="blocked", window=2, bounds=None, index=None):
+    """
+    The weighted kth nearest neighbor scores of the impurities, by weighted_kth_nn_blocked (method "blocked"), by
+    weighted_kth_nn_indexed (method "index") or by weighted_kth_nn_approximate (method "approximate"). The last two
+    start from bounds, if given, and search index, if given.
+    :return: (scores, lower) - dictionaries k -> the scores of the impurities, and lower bounds on their exact scores
+             (the same as the scores, except for the method "approximate")
+    """
+    if method == "approximate":
+        return weighted_kth_nn_approximate(imp_boxes, imp_area, indices, impurities, k_list, min_dist, window, bounds,
+                                           index)
+    if method == "index":
+        scores = weighted_kth_nn_indexed(imp_boxes, imp_area, indices, impurities, k_list, min_dist, bounds, index)
+    else:
+        scores = weighted_kth_nn_blocked(imp_boxes, imp_area, indices, impurities, k_list, min_dist, memory_cap)
+    return scores, scores
+
+
+def approximation_report(imp_boxes, imp_area, indices, k_list, scores, lower, min_dist=0.00001, sample_size=200,
+                         memory_cap=2 ** 28):
+    """
+    Reports how close the approximate scores of weighted_kth_nn_approximate (of all the impurities in indices) are to
+    the exact ones: the share of the impurities whose bounds meet (exact scores), the median ratio between the upper
+    and the lower bound of the k-th weighted distance of the others, and the spearman rank correlation between the
+    approximate and the exact scores of a random sample of sample_size impurities.
+    :return: dictionary k -> dictionary of the above
+    """
+    indices = np.asarray(indices)
+    sample = np.sort(np.random.RandomState(0).choice(indices.shape[0], min(sample_size, indices.shape[0]),
+                                                     replace=False))
+    exact = weighted_kth_nn_blocked(imp_boxes, imp_area, indices, indices[sample], k_list, min_dist, memory_cap)
+    report = {}
+    for k in k_list:
+        inexact = scores[k] > lower[k]
+        ratios = np.sqrt(scores[k][inexact] / np.maximum(lower[k][inexact], min_dist))
+        report[k] = {"exact_share": 1 - np.mean(inexact),
+                     "median_ratio": np.median(ratios) if ratios.shape[0] > 0 else 1.,
+                     "rank_correlation": spearmanr(scores[k][sample], exact[k]).correlation}
+        print("approximate weighted_kth_nn, k = {}: exact bounds for {:.1%} of the impurities, median upper / lower "
+              "bound {:.3f}, rank correlation {:.4f} (sample of {})".format(
+                k, report[k]["exact_share"], report[k]["median_ratio"], report[k]["rank_correlation"], sample.shape[0]))
+    return report
+
+
+def weighted_kth_nn_chunk(impurities_chunk, imp_boxes, imp_area, indices, k_list, memory_cap=2 ** 28,
+                          method="blocked", window=2, bounds=None, index=None):
+    """
+    weighted_kth_nn_scores of a chunk of the impurities, for the executor of weighted_kth_nn.
+    :param bounds: the bounds of all the impurities in indices (see neighbor_bounds), or None
+    :param index: the AreaBucketIndex shared by all the chunks (see area_bucket_index), or None
+    """
+    if bounds is not None:
+        bounds = bounds[np.searchsorted(indices, impurities_chunk)]
+    return weighted_kth_nn_scores(imp_boxes, imp_area, indices, impurities_chunk, k_list, memory_cap=memory_cap,
+                                  method=method, window=window, bounds=bounds, index=index)
+
+
+def area_bucket_index(imp_boxes, imp_area, indices, method, min_dist=0.00001):
+    """
+    The AreaBucketIndex of the significant impurities of a scan for the methods "index" and "approximate", built once
+    and shared by all the chunks of the impurities (and again only for another set of impurities), None for "blocked".
+    """
+    if method == "blocked" or len(indices) == 0:
+        return None
+    return AreaBucketIndex(imp_boxes, imp_area, indices, min_dist)
+
+
+def neighbor_bounds(neighbor_index, imp_area, impurities, k_list, method, min_dist=0.00001):
+    """
+    The bounds of the NeighborIndex of the scan for weighted_kth_nn_scores, None if there is no NeighborIndex or the
+    method checks all the pairs anyway.
+    """
+    if neighbor_index is None or method == "blocked":
+        return None
+    return neighbor_index.weighted_kth_nn_bounds(imp_area, impurities, max(k_list), min_dist)
+
+
+def weighted_kth_nn(table, img, k_list, need_plot=False, memory_cap=2 ** 30, method="blocked", window=2,
+                    neighbor_index=None, executor=None):
+    """
+    :param memory_cap: the bytes of the weighted distances calculated at a time, over all the chunks that run at a time
+    :param method: "blocked" (all the pairs of impurities), "index" (only the pairs near enough, for dense scans) or
+                   "approximate" (only the pairs within window grid cells), see weighted_kth_nn_scores. The bounds of
+                   the approximate scores are kept in table.spatial_score_bounds and reported by approximation_report.
+    :param neighbor_index: the NeighborIndex of the scan, if built, its nearest neighbors bound the search of the
+                           methods "index" and "approximate"
+    :param executor: the Executor that runs the chunks of the impurities, serial if None
+    :return: dictionary k -> the spatial scores of all the impurities (rows of the table)
+    """
+    # data structure that holds for each impurity it's k nearest neighbor
+    # it looks like this: first index: the k nearest neighbor (corresponding to k_list), second index is the impurity.
+    start = time.time()
+    if executor is None:
+        executor = Executor()
+    imp_boxes = table.boxes
+    imp_area = table.areas
+    indices = np.asarray(table.indices, dtype=int)
+
+    # weighted kth nn calculation, every impurity weighs its distances to all the significant impurities
+    impurities_chunks = executor.chunks(indices, cost=indices.shape[0] * 5e-8)
+    chunks_out = executor.map(weighted_kth_nn_chunk, impurities_chunks, imp_boxes, imp_area, indices, k_list,
+                              executor.memory_share(memory_cap), method, window,
+                              neighbor_bounds(neighbor_index, imp_area, indices, k_list, method),
+                              area_bucket_index(imp_boxes, imp_area, indices, method))
+    weighted_scores = np.zeros((imp_boxes.shape[0], len(k_list)))
+    lower_bounds = np.zeros((imp_boxes.shape[0], len(k_list)))
+    for j, k in enumerate(k_list):
+        weighted_scores[indices, j] = np.concatenate([chunk_out[k] for chunk_out, _ in chunks_out])
+        lower_bounds[indices, j] = np.concatenate([chunk_lower[k] for _, chunk_lower in chunks_out])
+    end = time.time()
+    print("time weighted_kth_nn (" + executor.backend + "): " + str(end - start))
 
-        max_val2 = max(impurity_neighbors_and_area[k])
-        impurity_neighbors_and_area[k] = list(map(lambda x: x / max_val2, impurity_neighbors_and_area[k]))
+    if method == "approximate":
+        for j, k in enumerate(k_list):
+            table.spatial_score_bounds[k] = (lower_bounds[:, j].copy(), weighted_scores[:, j].copy())
+        approximation_report(imp_boxes, imp_area, indices, k_list,
+                             dict((k, weighted_scores[indices, j]) for j, k in enumerate(k_list)),
+                             dict((k, lower_bounds[indices, j]) for j, k in enumerate(k_list)), memory_cap=memory_cap)
 
-    # fig = plt.figure(1)
+    scores = normalize_weighted_scores(indices, weighted_scores)
+    impurity_neighbors_and_area = dict((k, scores[:, j].copy()) for j, k in enumerate(k_list))
 
-    # plt.show()
+    # uncomment to see histogram (hope for normal distribution)
+    # plt.figure(k)
+    # plt.hist(impurity_neighbors_and_area[k][indices])
 
     if need_plot:
         blank_image2 = {}
 
         for k in k_list:
-            blank_image2[k] = np.zeros(img.shape, np.uint8)
-            blank_image2[k][:, :] = (255, 255, 255)
-        jet = plt.get_cmap('jet')
-        for impurity in indices:
-            for k in k_list:
-                score = impurity_neighbors_and_area[k][impurity]
-                color = jet(score)
-                blank_image2[k][markers == impurity + 2] = (color[0] * 255, color[1] * 255, color[2] * 255)
+            blank_image2[k] = render_overlay(table, indices, score_colors(impurity_neighbors_and_area[k][indices]))
 
         for i in range(len(k_list)):
             plt.figure(i)
@@ -173,4 +267,144 @@ def weighted_kth_nn_not_parallel(imp_boxes, img, markers, k_list, imp_area, indi
 
         plt.show()
 
-    return impurity_neighbors_and_area
\ No newline at end of file
+    return impurity_neighbors_and_area
+
+
+def weighted_kth_nn_sweep_values(imp_boxes, imp_area, indices, impurities, max_k, min_dist=0.00001,
+                                 memory_cap=2 ** 28, method="blocked", window=2, index=None):
+    """
+    The k-th smallest weighted distances (see weighted_kth_nn_blocked) of each impurity in impurities for all
+    k = 1..max_k at once, from a single partial sort of the weighted distances of each impurity.
+    :param method: "blocked", "index" or "approximate" (the upper bounds), see weighted_kth_nn_scores
+    :param index: the AreaBucketIndex of the impurities in indices for "index" and "approximate" (see
+                  area_bucket_index), built here if None
+    :return: (len(impurities), max_k) array, column k - 1 is the k-th smallest weighted distance, inf for the k
+             bigger than the number of the other impurities (by every method)
+    """
+    indices = np.asarray(indices)
+    impurities = np.asarray(impurities, dtype=int)
+    if impurities.shape[0] == 0:
+        return np.zeros((0, max_k))
+    # every impurity has indices.shape[0] - 1 neighbors
+    neighbors_k = max(min(max_k, indices.shape[0] - 1), 0)
+    if method != "blocked":
+        if index is None:
+            index = AreaBucketIndex(imp_boxes, imp_area, indices, min_dist)
+        if method == "index":
+            return index.nearest(impurities, max_k)[0]
+        k_nn = index.nearest(impurities, max_k, window=window)[0]
+        if neighbors_k > 0:
+            missing = np.flatnonzero(~np.isfinite(k_nn[:, neighbors_k - 1]))
+            if missing.shape[0] > 0:
+                k_nn[missing] = index.nearest(impurities[missing], max_k)[0]
+        return k_nn
+
+    kth_values = np.full((impurities.shape[0], max_k), np.inf)
+    if neighbors_k == 0:
+        return kth_values
+    others_boxes = imp_boxes[indices]
+    others_area = imp_area[indices]
+    self_columns = np.searchsorted(indices, impurities)
+    block_size = max(1, int(memory_cap // (6 * 8 * max(indices.shape[0], 1))))
+    for block_start in range(0, impurities.shape[0], block_size):
+        block = impurities[block_start:block_start + block_size]
+        k_nn = weighted_distances_block(imp_boxes, imp_area, others_boxes, others_area, block,
+                                        self_columns[block_start:block_start + block_size], min_dist)
+        k_nn = np.partition(k_nn, neighbors_k - 1, axis=1)
+        kth_values[block_start:block_start + block.shape[0], :neighbors_k] = np.sort(k_nn[:, :neighbors_k], axis=1)
+    return kth_values
+
+
+def normalize_weighted_scores(indices, weighted_scores):
+    """
+    The post-processing of weighted_kth_nn (log, normalization, clipping of 2 standard deviations) of the weighted
+    scores imp_area * kth ** 2, for all the columns (k) at once. The zero scores are clamped to 0.00001 before the log.
+    :param weighted_scores: (number of impurities, number of k) array of the weighted scores of the impurities
+    :return: (number of impurities, number of k) array of the spatial scores of the impurities
+    """
+    # (number of k, len(indices)), a row per k, so that the reductions are the same as the ones of a single k
+    data = weighted_scores[indices].T.copy()
+    data[data == 0] = 0.00001
+    data = np.log(data)
+    data = (data - np.min(data, axis=1)[:, np.newaxis]) / np.ptp(data, axis=1)[:, np.newaxis]
+    data = np.maximum(data - 2 * np.std(data, axis=1)[:, np.newaxis], 0.00001)
+    data = (data - np.min(data, axis=1)[:, np.newaxis]) / np.ptp(data, axis=1)[:, np.newaxis]
+
+    scores = np.zeros(weighted_scores.shape)
+    scores[indices] = data.T
+    return scores / np.max(scores, axis=0)
+
+
+def normalize_spatial_scores(imp_area, indices, kth_values):
+    """
+    normalize_weighted_scores of the scores imp_area * kth ** 2 of the k-th smallest weighted distances.
+    :param kth_values: (number of impurities, max_k) array of the k-th smallest weighted distances of the impurities,
+                       as returned by weighted_kth_nn_sweep
+    :return: (number of impurities, max_k) array of the spatial scores of the impurities for every k
+    """
+    weighted_scores = np.zeros(kth_values.shape)
+    weighted_scores[indices] = imp_area[indices, np.newaxis] * np.float_power(kth_values[indices], 2)
+    return normalize_weighted_scores(indices, weighted_scores)
+
+
+def rank_stability(scores, indices, k_values=None, top=100):
+    """
+    Reports how the ranks of the spatial scores of the impurities shift across k: for every two successive k of
+    k_values, the spearman rank correlation of the scores and the share of the top impurities (the most anomalous)
+    that are the same.
+    :param scores: (number of impurities, max_k) spatial scores, as returned by weighted_kth_nn_sweep
+    :param k_values: the k to compare, by default about 10 of 1..max_k spaced geometrically
+    :return: list of dictionaries, a dictionary for each two successive k
+    """
+    max_k = scores.shape[1]
+    if k_values is None:
+        k_values = np.unique(np.round(np.geomspace(1, max_k, 10)).astype(int)).tolist()
+    scores = scores[indices]
+    top = min(top, scores.shape[0])
+    rows = []
+    for previous_k, k in zip(k_values[:-1], k_values[1:]):
+        previous_top = np.argsort(-scores[:, previous_k - 1], kind='stable')[:top]
+        k_top = np.argsort(-scores[:, k - 1], kind='stable')[:top]
+        rows.append({"k": k, "previous_k": previous_k,
+                     "rank_correlation": spearmanr(scores[:, previous_k - 1], scores[:, k - 1]).correlation,
+                     "top_overlap": np.intersect1d(previous_top, k_top).shape[0] / float(max(top, 1))})
+        print("k = {} -> {}: rank correlation {:.4f}, top {} overlap {:.1%}".format(
+            previous_k, k, rows[-1]["rank_correlation"], top, rows[-1]["top_overlap"]))
+    return rows
+
+
+def weighted_kth_nn_sweep_chunk(impurities_chunk, imp_boxes, imp_area, indices, max_k, memory_cap=2 ** 28,
+                                method="blocked", window=2, index=None):
+    return weighted_kth_nn_sweep_values(imp_boxes, imp_area, indices, impurities_chunk, max_k,
+                                        memory_cap=memory_cap, method=method, window=window, index=index)
+
+
+def weighted_kth_nn_sweep(table, max_k, memory_cap=2 ** 30, method="blocked", window=2, executor=None):
+    """
+    The weighted kth nearest neighbor of weighted_kth_nn for all k = 1..max_k, from a single pass. max_k is at most
+    the number of the significant impurities - 1 (the neighbors of an impurity), a bigger one is lowered to it.
+    :param executor: the Executor that runs the chunks of the impurities, serial if None
+    :return: (kth_values, scores) - (number of impurities, max_k) arrays of the k-th smallest weighted distances and
+             of the spatial scores (the same as the ones of weighted_kth_nn) of the impurities, column k - 1 for k
+    """
+    start = time.time()
+    if executor is None:
+        executor = Executor()
+    imp_boxes = table.boxes
+    imp_area = table.areas
+    indices = np.asarray(table.indices, dtype=int)
+    if max_k > indices.shape[0] - 1:
+        print("warning: weighted_kth_nn_sweep with max_k = " + str(max_k) + " but only " + str(indices.shape[0]) +
+              " significant impurities, max_k is lowered to " + str(max(indices.shape[0] - 1, 0)))
+        max_k = max(indices.shape[0] - 1, 0)
+    kth_values = np.zeros((imp_boxes.shape[0], max_k))
+
+    impurities_chunks = executor.chunks(indices, cost=indices.shape[0] * 5e-8)
+    chunks_out = executor.map(weighted_kth_nn_sweep_chunk, impurities_chunks, imp_boxes, imp_area, indices, max_k,
+                              executor.memory_share(memory_cap), method, window,
+                              area_bucket_index(imp_boxes, imp_area, indices, method))
+    for impurities_chunk, chunk_out in zip(impurities_chunks, chunks_out):
+        kth_values[impurities_chunk] = chunk_out
+    end = time.time()
+    print("time weighted_kth_nn_sweep (" + executor.backend + "): " + str(end - start))
+    return kth_values, normalize_spatial_scores(imp_area, indices, kth_values)
@@ -0,0 +1,197 @@
+import numpy as np
+from utils import impurity_dists_aligned
+
+
+def concatenate_ranges(starts, ends):
+    """
+    np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) without the python loop.
+    """
+    lengths = ends - starts
+    total = int(np.sum(lengths))
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+def merge_smallest(k_nn, queries, weights):
+    """
+    Merges weights of queries into k_nn, where k_nn[q] are the smallest weights of query q so far (sorted), keeping
+    the k_nn.shape[1] smallest of every query.
+    """
+    max_k = k_nn.shape[1]
+    queries = np.concatenate((np.repeat(np.arange(k_nn.shape[0]), max_k), queries))
+    weights = np.concatenate((k_nn.ravel(), weights))
+    order = np.lexsort((weights, queries))
+    queries, weights = queries[order], weights[order]
+    ranks = np.arange(queries.shape[0]) - np.searchsorted(queries, queries)
+    keep = ranks < max_k
+    k_nn[queries[keep], ranks[keep]] = weights[keep]
+
+
+class BoxGrid:
+    """
+    A uniform grid over bounding boxes of impurities, for finding all the boxes within a distance from other boxes.
+    Each box is registered in the cell of its (rmin, cmin) corner, the cells keep their boxes in a CSR layout.
+    """
+
+    def __init__(self, boxes, boxes_per_cell=4):
+        self.boxes = np.asarray(boxes)
+        self.origin = self.boxes[:, [0, 2]].min(axis=0)
+        extent = self.boxes[:, [1, 3]].max(axis=0) - self.origin + 1
+        self.max_size = (self.boxes[:, [1, 3]] - self.boxes[:, [0, 2]]).max(axis=0)
+        self.cell_size = max(int(np.sqrt(float(extent[0]) * extent[1] * boxes_per_cell / self.boxes.shape[0])), 1)
+        self.grid_shape = (int(extent[0]) // self.cell_size + 1, int(extent[1]) // self.cell_size + 1)
+
+        cells = (self.boxes[:, [0, 2]] - self.origin) // self.cell_size
+        cell_ids = cells[:, 0] * self.grid_shape[1] + cells[:, 1]
+        self.order = np.argsort(cell_ids, kind='stable')
+        counts = np.bincount(cell_ids, minlength=self.grid_shape[0] * self.grid_shape[1])
+        self.offsets = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def query(self, boxes, radii):
+        """
+        Finds a superset of the boxes of the grid at distance (impurity_dist) at most radii[q] from boxes[q], for all q.
+        :return: (queries, positions) - the pairs of a query q and the position of a box in the boxes of the grid
+        """
+        boxes = np.asarray(boxes, dtype=float)
+        # an infinite radius covers the whole grid
+        radii = np.minimum(np.asarray(radii, dtype=float), 1e15)
+        # a box within the radius has its corner in this range of cells
+        low = np.stack((boxes[:, 0] - radii - self.max_size[0], boxes[:, 2] - radii - self.max_size[1]), axis=1)
+        high = np.stack((boxes[:, 1] + radii, boxes[:, 3] + radii), axis=1)
+        low = np.maximum((low - self.origin) // self.cell_size, 0)
+        high = np.minimum((high - self.origin) // self.cell_size, np.array(self.grid_shape) - 1)
+        rows_num = np.where(np.all(low <= high, axis=1), high[:, 0] - low[:, 0] + 1, 0).astype(np.int64)
+        low = low.astype(np.int64)
+        high = np.maximum(high, -1).astype(np.int64)
+
+        row_queries = np.repeat(np.arange(boxes.shape[0]), rows_num)
+        rows = concatenate_ranges(low[:, 0], low[:, 0] + rows_num)
+        starts = self.offsets[rows * self.grid_shape[1] + low[row_queries, 1]]
+        ends = self.offsets[rows * self.grid_shape[1] + high[row_queries, 1] + 1]
+        queries = np.repeat(row_queries, ends - starts)
+        return queries, self.order[concatenate_ranges(starts, ends)]
+
+
+class AreaBucketIndex:
+    """
+    A spatial index for the weighted kth nearest neighbor of spatial_anomaly, where the weighted distance from an
+    impurity i to an impurity x is (area[i] / area[x]) ** 4 * max(impurity_dist(i, x), min_dist).
+    The weight makes a plain spatial index useless, since far away big impurities may be the nearest ones, so the
+    impurities are grouped into buckets of similar areas (ratio of at most bucket_ratio between the areas of a bucket),
+    each one with its own BoxGrid. For a bucket with areas at most max_area, an impurity x of the bucket with a weighted
+    distance smaller than t is at distance smaller than t / (area[i] / max_area) ** 4 from i, so given an upper bound t
+    on the weighted kth nearest neighbor of i, only the impurities within that distance in the bucket are checked.
+    The buckets are checked from the biggest areas (the smallest weights) down, and the bound of every impurity is
+    tightened after every bucket (branch and bound). The result is exactly the same as checking all the impurities.
+    With a window, the search in every bucket is limited to window cells of its grid around the impurity, which makes
+    it near-linear but approximate. The approximation is the k-th weighted distance among the checked impurities,
+    which is an upper bound on the exact one. The unchecked impurities of a bucket are farther than the window, so
+    their weighted distances are at least (area[i] / max_area) ** 4 * window distance, and the exact k-th weighted
+    distance is at least the smaller of the approximation and these bounds.
+    """
+
+    def __init__(self, imp_boxes, imp_area, indices, min_dist=0.00001, bucket_ratio=2 ** 0.5):
+        """
+        :param indices: the sorted indices of the impurities in the index (the neighbor candidates)
+        """
+        self.indices = np.asarray(indices)
+        self.boxes = np.asarray(imp_boxes)[self.indices]
+        self.areas = np.asarray(imp_area, dtype=float)[self.indices]
+        self.min_dist = min_dist
+
+        buckets = np.floor(np.log(self.areas) / np.log(bucket_ratio)).astype(int)
+        self.buckets = []
+        for bucket in np.unique(buckets)[::-1]:
+            members = np.flatnonzero(buckets == bucket)
+            self.buckets.append((members, np.max(self.areas[members]), BoxGrid(self.boxes[members])))
+
+    def kth_nn(self, impurities, k_list, block_size=1024, window=None, bounds=None):
+        """
+        The k-th smallest weighted distance from each impurity (of the indices) to the other impurities, for every k
+        in k_list. The impurities are processed in blocks of block_size.
+        :param window: if given, the search is approximate, limited to this number of grid cells around each impurity
+        :param bounds: upper bounds on the max(k_list)-th weighted distances of the impurities, if known (e.g. from a
+                       NeighborIndex), the search starts from them
+        :return: dictionary k -> the k-th smallest weighted distances of the impurities, and if window is given, also
+                 dictionary k -> lower bounds on them
+        """
+        k_nn, lower = self.nearest(impurities, max(k_list), block_size, window, bounds)
+        if window is None:
+            return dict((k, k_nn[:, k - 1]) for k in k_list)
+        return dict((k, k_nn[:, k - 1]) for k in k_list), dict((k, lower[:, k - 1]) for k in k_list)
+
+    def nearest(self, impurities, max_k, block_size=1024, window=None, bounds=None):
+        """
+        The max_k smallest weighted distances (sorted) from each impurity (of the indices) to the other impurities,
+        and lower bounds on the exact ones (the same if window is None), as (len(impurities), max_k) arrays.
+        """
+        impurities = np.asarray(impurities, dtype=int)
+        if bounds is None:
+            bounds = np.full(impurities.shape[0], np.inf)
+        k_nn = np.empty((impurities.shape[0], max_k))
+        lower = np.empty((impurities.shape[0], max_k))
+        for block_start in range(0, impurities.shape[0], block_size):
+            positions = np.searchsorted(self.indices, impurities[block_start:block_start + block_size])
+            block = slice(block_start, block_start + positions.shape[0])
+            k_nn[block], lower[block] = self.smallest_weighted_distances(positions, max_k, window, bounds[block])
+        return k_nn, lower
+
+    def smallest_weighted_distances(self, positions, max_k, window=None, bounds=None):
+        """
+        The max_k smallest weighted distances (sorted) from each impurity at positions (in the index) to the others,
+        and lower bounds on the exact ones (the same if window is None).
+        :param bounds: upper bounds on the max_k-th weighted distances, if known
+        """
+        return self.smallest_weighted_distances_of(self.boxes[positions], self.areas[positions],
+                                                   self.indices[positions], max_k, window, bounds)
+
+    def smallest_weighted_distances_of(self, query_boxes, query_areas, query_ids, max_k, window=None, bounds=None,
+                                       skipped=None):
+        """
+        smallest_weighted_distances of impurities given by their boxes and areas, which may be out of the index or
+        edited since it was built.
+        :param query_ids: the indices of the impurities, an impurity is not its own neighbor
+        :param skipped: boolean array of the impurities of the index (by position) that are not neighbor candidates
+        """
+        query_boxes = np.asarray(query_boxes)
+        query_areas = np.asarray(query_areas, dtype=float)
+        query_ids = np.asarray(query_ids)
+        if bounds is None:
+            bounds = np.full(query_ids.shape[0], np.inf)
+        # k_nn[q] := the max_k smallest weighted distances of query q found so far
+        k_nn = np.full((query_ids.shape[0], max_k), np.inf)
+        # out_of_window[q] := the smallest weighted distance possible for the impurities out of the window of query q
+        out_of_window = np.full(query_ids.shape[0], np.inf)
+        for members, max_area, grid in self.buckets:
+            bound = k_nn[:, max_k - 1]
+            min_weights = np.float_power(query_areas / max_area, 4)
+            # a margin for the rounding, all the impurities with a weighted distance of at most the bound are found
+            radii = np.minimum(bound, bounds) / min_weights * (1 + 1e-9) + 1
+            if window is not None:
+                max_radius = window * grid.cell_size
+                capped = radii > max_radius
+                radii = np.minimum(radii, max_radius)
+            queries, found = grid.query(query_boxes, radii)
+
+            if window is not None:
+                # the impurities of the bucket that were not found are farther than max_radius
+                not_found = members.shape[0] > np.bincount(queries, minlength=query_ids.shape[0])
+                out_of_window = np.where(capped & not_found, np.minimum(
+                    out_of_window, min_weights * max(max_radius, self.min_dist)), out_of_window)
+
+            found = members[found]
+            candidates = self.indices[found] != query_ids[queries]
+            if skipped is not None:
+                candidates &= ~skipped[found]
+            queries, found = queries[candidates], found[candidates]
+
+            # calculated exactly as in weighted_kth_nn_blocked
+            weights = np.float_power(query_areas[queries] / self.areas[found], 4) * \
+                np.maximum(impurity_dists_aligned(query_boxes[queries], self.boxes[found]), self.min_dist)
+            below = (weights < bound[queries]) & (weights <= bounds[queries])
+            if np.any(below):
+                merge_smallest(k_nn, queries[below], weights[below])
+        return k_nn, np.minimum(k_nn, out_of_window[:, np.newaxis])
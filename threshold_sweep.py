@@ -0,0 +1,111 @@
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore",category=FutureWarning)
+    import os
+    import numpy as np
+    import cv2 as cv
+    import time
+    from impurity_extract import get_impurity_table
+    from scan_reader import ScanReader
+
+
+class ThresholdSweep:
+    """
+    The impurities of a scan for a list of thresholds (min_threshold of get_markers), all answered from a single
+    morphology pass over the grayscale scan.
+    Thresholding commutes with flat morphology, so for every threshold t the closed threshold image of get_markers
+    (sure foreground) is {opening(gray) <= t}, and its dilation (sure background) is {erode(opening(gray)) <= t}.
+    The components of the nested foregrounds form a hierarchy: every impurity of a threshold is contained in a single
+    impurity of the next (bigger) threshold.
+    """
+
+    def __init__(self, img, thresholds, min_area=3):
+        start = time.time()
+        self.img = img
+        self.thresholds = sorted(set(int(t) for t in thresholds))
+        self.min_area = min_area
+
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+        kernel = np.ones((3, 3), np.uint8)
+        # the threshold at which each pixel becomes sure foreground / leaves the sure background
+        self.fg_level = cv.morphologyEx(gray, cv.MORPH_OPEN, kernel, iterations=1)
+        self.bg_level = cv.erode(self.fg_level, kernel, iterations=3)
+
+        # per threshold, in the format of get_markers / save_boxes (impurity i is label i + 2)
+        self.impurities_num = {}
+        self.fg_boxes = {}
+        self.fg_areas = {}
+        # parents[t][i] := the impurity of the next threshold that contains impurity i of threshold t
+        self.parents = {}
+
+        previous_t, previous_pixels = None, None
+        for t in self.thresholds:
+            ret, labels, stats, _ = cv.connectedComponentsWithStats(self.sure_fg(t))
+            self.impurities_num[t] = ret
+            left, top = stats[1:, cv.CC_STAT_LEFT], stats[1:, cv.CC_STAT_TOP]
+            width, height = stats[1:, cv.CC_STAT_WIDTH], stats[1:, cv.CC_STAT_HEIGHT]
+            # the same padding as bbox
+            self.fg_boxes[t] = np.stack((top - 1, top + height, left - 1, left + width), axis=1)
+            self.fg_areas[t] = stats[1:, cv.CC_STAT_AREA]
+
+            if previous_t is not None:
+                self.parents[previous_t] = labels.ravel()[previous_pixels] - 1
+            # any pixel of each impurity, to find its parent in the next threshold
+            previous_pixels = np.zeros(ret, dtype=np.int64)
+            previous_pixels[labels.ravel()] = np.arange(labels.size)
+            previous_pixels = previous_pixels[1:]
+            previous_t = t
+
+        end = time.time()
+        print("time ThresholdSweep: " + str(end - start))
+
+    def sure_fg(self, threshold):
+        """
+        The closed threshold image of get_markers for this threshold.
+        """
+        return np.uint8(self.fg_level <= threshold) * 255
+
+    def get_markers(self, threshold):
+        """
+        The same (ret, markers) that get_markers returns for this threshold. Only the watershed runs again.
+        """
+        sure_fg = self.sure_fg(threshold)
+        ret, markers = cv.connectedComponents(sure_fg)
+        markers = markers + 1
+        markers[np.logical_and(self.bg_level <= threshold, sure_fg == 0)] = 0
+        markers = cv.watershed(self.img, markers)
+        return ret, markers
+
+    def get_impurity_table(self, threshold):
+        """
+        The markers and the ImpurityTable of the scan for this threshold, the same as extract_impurities.
+        """
+        ret, markers = self.get_markers(threshold)
+        return ret, markers, get_impurity_table(markers, ret, self.min_area)
+
+    def report(self):
+        """
+        The number of impurities for every threshold. The areas are of the sure foreground, before the watershed
+        adds the unknown band around each impurity.
+        """
+        rows = []
+        for t in self.thresholds:
+            rows.append({"threshold": t,
+                         "impurities": self.impurities_num[t] - 1,
+                         "significant": int(np.sum(self.fg_areas[t] > self.min_area)),
+                         "fg_area": int(np.sum(self.fg_areas[t]))})
+        return rows
+
+
+def threshold_sweep(img_path, thresholds, black_background=True, min_area=3):
+    """
+    Builds the ThresholdSweep of a scan and prints the number of impurities for every threshold.
+    """
+    img = ScanReader(img_path, invert=black_background).read()
+    img_name = os.path.splitext(os.path.basename(img_path))[0]
+    sweep = ThresholdSweep(img, thresholds, min_area)
+    print(img_name + ", threshold sweep:")
+    for row in sweep.report():
+        print("threshold: {}, impurities: {}, significant: {}, sure foreground area: {}".format(
+            row["threshold"], row["impurities"], row["significant"], row["fg_area"]))
+    return sweep
@@ -7,16 +7,15 @@ with warnings.catch_warnings():
     import tensorflow as tf
     from tensorflow.keras.preprocessing import image
     # from tensorflow.keras.preprocessing.image import ImageDataGenerator
-    from tensorflow.keras.preprocessing.image import array_to_img, save_img, ImageDataGenerator
+    from tensorflow.keras.preprocessing.image import array_to_img, save_img
     import matplotlib.pyplot as plt
     import numpy as np
     from sklearn.metrics import mean_squared_error
     from skimage import measure
     # from skimage.measure import structural_similarity as ssim
-    import re
     import cv2 as cv
-    import ray
-    from utils import num_threads
+    from executor import Executor
+    from crop_archive import CropArchive
     from glob import glob
 
 
@@ -30,13 +29,6 @@ def load_image(img_path, height=100, width=100):
     return img_tensor
 
 
-def fixed_generator_none(generator):
-    """
-    """
-    for batch in generator:
-        yield (batch, batch)
-
-
 def postprocess_prediction(prediction):
     image = np.array(prediction)
     image *= 255
@@ -57,11 +49,27 @@ def postprocess_prediction(prediction):
     # return thresh
 
 
-def test_prediction(model, img_path, height, width, img_name, out_path):
-    img = cv.imread(img_path)
-    save_img(out_path + img_name + '.jpg', img)
+def load_test_impurity(scan_name, impurity_id, height=100, width=100):
+    """
+    The image of an impurity of a scan and its input to the model, read by its id from the crop archive of the scan
+    (written with --write_crops) if there is one, or else from its PNG file.
+    :return: (image, img_tensor)
+    """
+    archive_dir = "./data/test_" + scan_name + "/crops"
+    if os.path.exists(os.path.join(archive_dir, "archive.json")):
+        archive = CropArchive(archive_dir)
+        return archive.image(impurity_id), archive.model_input([impurity_id])
+    img_path = glob("./data/test_" + scan_name + "/*/*impurity_" + str(impurity_id) + ".png")[0]
+    return cv.imread(img_path), load_image(img_path, height, width)
+
+
+def test_prediction(model, image, img, img_name, out_path):
+    """
+    :param image: the image of the impurity, saved next to its reconstructions
+    :param img: the input of the impurity to the model, see load_test_impurity
+    """
+    save_img(out_path + img_name + '.jpg', image)
 
-    img = load_image(img_path, height, width)
     pred = model.predict(img)
     pred_img = postprocess_prediction(pred[0, :, :, :])
 
@@ -83,36 +91,19 @@ def test_prediction(model, img_path, height, width, img_name, out_path):
 def test_impurities(model_name, height=100, width=100, out_path='./'):
     model = tf.keras.models.load_model(model_name)
 
-    normal_imp = glob("./data/test_scan3tag-48/*/*impurity_242.png")[0]
-
-    anomaly_imp = glob("./data/test_scan2tag-34/*/*impurity_875.png")[0]
-
-    anomaly_line = glob("./data/test_scan1tag-47/*/*impurity_1056.png")[0]
-
-    anomaly_imp717 = glob("./data/test_scan1tag-47/*/*impurity_717.png")[0]
-
-    anomaly_imp699 = glob("./data/test_scan1tag-47/*/*impurity_699.png")[0]
-
-    normal_imp2228 = glob("./data/test_scan1tag-47/*/*impurity_2228.png")[0]
-
-    normal_imp2345 = glob("./data/test_scan1tag-47/*/*impurity_2345.png")[0]
-
-    normal_imp2258 = glob("./data/test_scan1tag-47/*/*impurity_2258.png")[0]
-
-    normal_imp2131 = glob("./data/test_scan1tag-47/*/*impurity_2131.png")[0]
-
-    normal_imp2309 = glob("./data/test_scan1tag-47/*/*impurity_2309.png")[0]
-
-    test_prediction(model, normal_imp, height, width, "normal", out_path)
-    test_prediction(model, anomaly_imp, height, width, "anomaly", out_path)
-    test_prediction(model, anomaly_line, height, width, "anomaly_line", out_path)
-    test_prediction(model, anomaly_imp717, height, width, "anomaly_717", out_path)
-    test_prediction(model, anomaly_imp699, height, width, "anomaly_699", out_path)
-    test_prediction(model, normal_imp2228, height, width, "normal2228", out_path)
-    test_prediction(model, normal_imp2345, height, width, "normal2345", out_path)
-    test_prediction(model, normal_imp2258, height, width, "normal2258", out_path)
-    test_prediction(model, normal_imp2131, height, width, "normal2131", out_path)
-    test_prediction(model, normal_imp2309, height, width, "normal2309", out_path)
+    test_cases = [("scan3tag-48", 242, "normal"),
+                  ("scan2tag-34", 875, "anomaly"),
+                  ("scan1tag-47", 1056, "anomaly_line"),
+                  ("scan1tag-47", 717, "anomaly_717"),
+                  ("scan1tag-47", 699, "anomaly_699"),
+                  ("scan1tag-47", 2228, "normal2228"),
+                  ("scan1tag-47", 2345, "normal2345"),
+                  ("scan1tag-47", 2258, "normal2258"),
+                  ("scan1tag-47", 2131, "normal2131"),
+                  ("scan1tag-47", 2309, "normal2309")]
+    for scan_name, impurity_id, img_name in test_cases:
+        image, img = load_test_impurity(scan_name, impurity_id, height, width)
+        test_prediction(model, image, img, img_name, out_path)
 
 
     # Write the net summary
@@ -130,103 +121,51 @@ def get_score_from_prediction(input, prediction):
     # loss = measure.compare_ssim(input, prediction)
     return loss
 
-@ray.remote
-def get_scores_single(files_chunk, path, pred_chunk):
-    chunk_indices = []
-    impurity_anomaly_shape_scores = np.full(len(files_chunk), np.infty)
-    for i in range(len(files_chunk)):
-        img_name = os.path.splitext(os.path.basename(files_chunk[i]))[0]
-        img_name = img_name[img_name.find("_impurity_"):]
-        imp_num = int(re.search(r'\d+', img_name).group())
+def get_crop_scores_chunk(positions_chunk, crops, pred):
+    scores = np.zeros(len(positions_chunk))
+    for i, position in enumerate(positions_chunk):
+        post_pred = postprocess_prediction(pred[position][:, :, 0])
+        scores[i] = get_score_from_prediction(crops[position, :, :, 0], post_pred)
+    return scores
 
-        input_image = load_image(path + files_chunk[i])
-        post_pred = postprocess_prediction(pred_chunk[i][:,:,0])
-        impurity_anomaly_shape_scores[i] = get_score_from_prediction(input_image[0, :, :, 0], post_pred)
 
-        # if impurity_anomaly_shape_scores[i] is np.infty:
-        #     img = cv.imread(path + files_chunk[i])
-        #     save_img("/home/matanr/MLography/logs/shape/under_thresh/" + "imp" + str(imp_num) + ".png", img)
-        #     pred_img = np.expand_dims(post_pred, axis=2)
-        #     save_img("/home/matanr/MLography/logs/shape/under_thresh/" + "post_recon" + str(imp_num) + ".png", pred_img)
-        #     save_img("/home/matanr/MLography/logs/shape/under_thresh/" + "recon" + str(imp_num) + ".png", pred_chunk[i][:,:,:])
-
-        chunk_indices.append(imp_num)
-    return chunk_indices, impurity_anomaly_shape_scores
-
-
-def predict(path, impurities_num, model=None, model_name='./model_ae_extended.h5',
-            height=100, width=100, BATCH_SIZE=64):
+def predict_crops(crops, impurities, impurities_num, model=None, model_name='./model_ae_extended.h5', BATCH_SIZE=64,
+                  executor=None):
+    """
+    The shape anomaly scores of the impurities by the autoencoder, from their crops in memory (see
+    normalized_impurity_crops): the crops are predicted in batches, and the score of an impurity is the mean squared
+    error between its crop and its post-processed prediction (inf for the impurities without a crop).
+    :param crops: (number of crops, height, width, 1) float32 array of the crops, in [0, 1]
+    :param impurities: the impurity (row of the table) of every crop
+    :param executor: the Executor that scores the chunks of the predictions, serial if None
+    """
     if model is None:
         model = tf.keras.models.load_model(model_name)
+    if executor is None:
+        executor = Executor()
 
-    datagen = ImageDataGenerator(rescale=1. / 255)
-    test_it = datagen.flow_from_directory(path, target_size=(height, width), class_mode=None, shuffle=False,
-                                          batch_size=BATCH_SIZE,  color_mode='grayscale')
-    filenames = test_it.filenames
-    samples_num = len(filenames)
-    test_it.reset()
-    pred = model.predict_generator(fixed_generator_none(test_it), verbose=1, steps=samples_num/BATCH_SIZE)
+    pred = model.predict(crops, batch_size=BATCH_SIZE, verbose=1)
 
-    pred_chunks = np.array_split(pred, num_threads)
     impurity_anomaly_shape_scores = np.full(impurities_num, np.infty)
-
-    chunk_size = int(np.ceil(len(filenames) / num_threads))
-    files_chunks = np.array_split(filenames, num_threads)
-
-    tasks = list()
-    for i in range(num_threads):
-        tasks.append(get_scores_single.remote(files_chunks[i], path, pred_chunks[i]))
-    for i in range(num_threads):
-        chunk_indices, task_out = ray.get(tasks[i])
-        impurity_anomaly_shape_scores[chunk_indices] = task_out[:]
-
+    # every prediction is post-processed, about half a millisecond
+    positions_chunks = executor.chunks(np.arange(crops.shape[0]), cost=0.0005)
+    impurity_anomaly_shape_scores[impurities] = np.concatenate(
+        [np.zeros(0)] + executor.map(get_crop_scores_chunk, positions_chunks, crops, pred))
     return impurity_anomaly_shape_scores
 
 
-def predict_not_parallel(path, impurities_num, model_name='./model_ae_extended.h5', height=100, width=100, BATCH_SIZE=64):
-    model = load_model(model_name)
-
-    model.compile(loss='mse',
-                  optimizer='rmsprop',
-                  metrics=['accuracy'])
-
-    datagen = ImageDataGenerator(rescale=1. / 255)
-    test_it = datagen.flow_from_directory(path, target_size=(height, width), class_mode=None,
-                                          batch_size=BATCH_SIZE,  color_mode='grayscale')
-    filenames = test_it.filenames
-    samples_num = len(filenames)
-    test_it.reset()
-    pred = model.predict_generator(fixed_generator_none(test_it), verbose=1, steps=samples_num/BATCH_SIZE)
-    # evaluated_loss = model.evaluate_generator(fixed_generator_none(test_it), verbose=1, steps=samples_num/BATCH_SIZE)
-    # print("filenames: ", filenames)
-    # print(pred)
-
-    # labels = (train_it.class_indices)
-    # labels = dict((v, k) for k, v in labels.items())
-    # predictions = [labels[k] for k in predicted_class_indices]
-
-    # print(filenames)
-    impurity_anomaly_shape_scores = np.full(impurities_num, np.infty)
-    # impurity_anomaly_shape_reconstruct_loss = np.full(impurities_num, np.infty)
-
-    for i in range(len(filenames)):
-        img_name = os.path.splitext(os.path.basename(filenames[i]))[0]
-        img_name = img_name[img_name.find("_impurity_"):]
-        imp_num = int(re.search(r'\d+', img_name).group())
-
-        # print("input path: " + path + filenames[i])
-        input_image = load_image(path + filenames[i])
-        # print("input dim:" + str(input_image.shape))
-        # print("pred dim:" + str(pred[i].shape))
-        impurity_anomaly_shape_scores[imp_num] = get_score_from_prediction(input_image[0,:,:,0], pred[i][:,:,0])
-        # if imp_num == 717:
-        #     print("loss of impurity 717: "+str(impurity_anomaly_shape_scores[imp_num]))
-
-        # impurity_anomaly_shape_reconstruct_loss[imp_num] = evaluated_loss[i]
-    # print(impurity_anomaly_shape_scores)
-
-    # return impurity_anomaly_shape_reconstruct_loss
-    return impurity_anomaly_shape_scores
+def predict_archive(archive, impurities_num, model=None, model_name='./model_ae_extended.h5', BATCH_SIZE=64, table=None,
+                    executor=None):
+    """
+    The scores of predict_crops, from the CropArchive of a scan (written by write_impurity_crop_archive): its crops
+    are read by memory mapping and the impurities are taken from its index of ids.
+    :param table: the ImpurityTable of the scan, for mapping the impurity ids of the archive to the rows of the table
+    """
+    impurities = np.asarray(archive.ids)
+    if table is not None:
+        impurities = table.rows_of_ids(impurities)
+    return predict_crops(archive.model_input(), impurities, impurities_num, model=model, model_name=model_name,
+                         BATCH_SIZE=BATCH_SIZE, executor=executor)
 
 
 def check_post_process(img_path, out_dir):
@@ -264,6 +203,6 @@ if __name__ == "__main__":
     # test_impurities('./smaller_blank_label.h5',
     #                   out_path='/home/matanr/MLography/logs/shape/reconstructed_blank_label/')
 
-    # predict(path, impurities_num, model_name='./model.h5', height=600, width=600, BATCH_SIZE=64)
+    # predict_archive(CropArchive(path), impurities_num, model_name='./model.h5', BATCH_SIZE=64)
 
 
@@ -1,12 +1,10 @@
 import warnings
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=FutureWarning)
-    import ray
     import numpy as np
     import scipy.spatial.distance as dist
     import math
-
-num_threads = 50
+    from executor import Executor
 
 
 def sigmoid(x):
@@ -45,32 +43,69 @@ def impurity_dist(imp1, imp2):
         return 0.
 
 
-@ray.remote
-def find_diameter_single(imp_boxes_chunk, start_index,  imp_boxes):
-    max_dist = 0
-    for i, imp in enumerate(imp_boxes_chunk):
-        global_i = start_index + i
-        for other_imp in imp_boxes[global_i+1:]:
-            max_dist = max(max_dist, impurity_dist(imp, other_imp))
-    return max_dist
+def impurity_dists(imp, imp_boxes):
+    """
+    Calculates the distances between a bounding box of an impurity and an array of bounding boxes of impurities,
+    the same values as impurity_dist(imp, imp_boxes[i]) for each i.
+    """
+    return impurity_dists_pairs(np.asarray(imp)[np.newaxis], imp_boxes)[0]
 
 
-def find_diameter(imp_boxes):
-    imp_boxes_chunks = np.array_split(imp_boxes, num_threads)
-    tasks = list()
-    for i in range(num_threads):
-        start_index = i * len(imp_boxes_chunks[i-1])  # index offset from the whole array
-        tasks.append(find_diameter_single.remote(imp_boxes_chunks[i], start_index, imp_boxes))
+def impurity_dists_pairs(imp_boxes1, imp_boxes2):
+    """
+    Calculates the distances between every pair of bounding boxes of impurities from two arrays (a block of pairs):
+    dists[i, j] = impurity_dist(imp_boxes1[i], imp_boxes2[j]).
+    """
+    return impurity_dists_aligned(np.asarray(imp_boxes1)[:, np.newaxis], np.asarray(imp_boxes2)[np.newaxis, :])
+
+
+def impurity_dists_aligned(imp_boxes1, imp_boxes2):
+    """
+    Calculates the distances between the bounding boxes of impurities of two (broadcastable) arrays element by element:
+    dists[i] = impurity_dist(imp_boxes1[i], imp_boxes2[i]).
+    The distance is the length of the gap between the boxes, (gap in rows, gap in columns), where each gap is 0 if the
+    boxes overlap in that direction.
+    """
+    imp_boxes1 = np.asarray(imp_boxes1, dtype=float)
+    imp_boxes2 = np.asarray(imp_boxes2, dtype=float)
+    rmin1, rmax1, cmin1, cmax1 = [imp_boxes1[..., j] for j in range(4)]
+    rmin2, rmax2, cmin2, cmax2 = [imp_boxes2[..., j] for j in range(4)]
+
+    gap_r = np.maximum(np.maximum(rmin1 - rmax2, rmin2 - rmax1), 0.)
+    gap_c = np.maximum(np.maximum(cmin1 - cmax2, cmin2 - cmax1), 0.)
+    # sqrt of the sum of squares (and not hypot) to get exactly the values of dist.euclidean
+    return np.sqrt(gap_r * gap_r + gap_c * gap_c)
+
+
+def find_diameter_chunk(rows_chunk, imp_boxes):
     max_dist = 0
-    for i in range(num_threads):
-        max_dist = max(max_dist, ray.get(tasks[i]))
+    for i in rows_chunk:
+        if i + 1 < len(imp_boxes):
+            max_dist = max(max_dist, np.max(impurity_dists(imp_boxes[i], imp_boxes[i+1:])))
     return max_dist
 
 
-def find_diameter_not_parallel(imp_boxes):
+def find_diameter(imp_boxes, executor=None):
+    """
+    The maximal box distance between two of the impurities.
+    :param executor: the Executor that runs the chunks of the rows of imp_boxes, serial if None
+    """
+    if executor is None:
+        executor = Executor()
+    # the rows farther down have less pairs, so the cost of a row is about half of the impurities on average
+    rows_chunks = executor.chunks(np.arange(len(imp_boxes)), cost=len(imp_boxes) * 1e-8)
+    return max([0] + executor.map(find_diameter_chunk, rows_chunks, imp_boxes))
+
+
+def find_diameter_blocked(imp_boxes, block_size=1024):
+    """
+    The maximal box distance between two of the impurities, the same as find_diameter, calculated in blocks of
+    block_size rows at once (for the few impurities of a cluster).
+    """
+    imp_boxes = np.asarray(imp_boxes)
     max_dist = 0
-    for i, imp in enumerate(imp_boxes):
-        for other_imp in imp_boxes[i+1:]:
-            max_dist = max(max_dist, impurity_dist(imp, other_imp))
+    for block_start in range(0, imp_boxes.shape[0], block_size):
+        if block_start + 1 < imp_boxes.shape[0]:
+            max_dist = max(max_dist, np.max(impurity_dists_pairs(imp_boxes[block_start:block_start + block_size],
+                                                                 imp_boxes[block_start:])))
     return max_dist
-